@@ -5,6 +5,10 @@ from datetime import datetime
 mission_title = 'FOXSI-SMEX'
 launch_date = datetime(2022, 7, 1)
 
+# Pipeline Settings
+# floating point precision of the imaging pipeline, 'double' or 'single'
+precision = 'double'
+
 # DSI Parameters
 number_of_dsi_telescopes = 2
 
@@ -16,6 +20,20 @@ blanket_material = 'mylar'
 blanket_thickness = 0.5 * u.mm
 
 dsi_focal_length = 14 * u.m
+# the shells of an optics module, the 18 innermost shells of
+# shell_parameters.csv as in effective_area_per_module.csv
+shell_ids = list(range(1, 19))
+# assumed dependence of the psf width of a shell on its radius, the width
+# scaling as radius ** psf_shell_width_index with the inner shells worse
+psf_shell_width_index = -1.
+dsi_pixel_size = 3.4 * u.arcsec
+dsi_number_of_pixels = 160
+# assumed off-axis angle at which the optics area falls to half, placeholders
+# until the vignetting of the optics is measured or ray traced
+vignetting_energy = [10, 20, 30, 40, 50] * u.keV
+vignetting_half_angle = [11.52, 10.42, 6.14, 3.64, 2.75] * u.arcmin
+# assumed FWHM energy resolution of the CdTe detectors
+dsi_energy_resolution = 0.8 * u.keV
 
 # STC Parameters
 stc_aperture_area = {'Q': 1.0 * u.mm ** 2, 'F': 0.02 * u.mm ** 2}
@@ -23,3 +41,11 @@ stc_detector_material = 'Si'
 stc_detector_thickness = 0.5 * u.mm
 stc_filter_material = 'Be'
 stc_filter_thickness = {'Q': 15 * u.micron, 'F': 50 * u.micron}
+# assumed FWHM energy resolution of the Si detectors
+stc_energy_resolution = 0.2 * u.keV
+
+
+def main(argv=None):
+    """Run the pyfoxsi command line tool."""
+    from pyfoxsi.cli import main as cli_main
+    return cli_main(argv)
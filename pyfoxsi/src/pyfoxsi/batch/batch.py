@@ -0,0 +1,288 @@
+"""
+Batch is a module to run the FOXSI imaging simulation over many input maps
+"""
+
+from __future__ import absolute_import
+import os
+import glob
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import astropy.units as u
+from sunpy.map import Map
+
+from pyfoxsi.psf import psf, convolve
+from pyfoxsi.profiling import stage
+
+__all__ = ['find_inputs', 'CompletionManifest', 'simulate_file', 'run_batch']
+
+log = logging.getLogger(__name__)
+
+fits_extensions = ('.fits', '.fts', '.fit', '.fits.gz')
+
+# per process caches, filled once in each worker and reused for every file
+_psf_cache = {}
+_response_cache = {}
+
+
+def find_inputs(source):
+    """Return the list of input maps to simulate.
+
+    Parameters
+    ----------
+    source : str
+        Either a directory, which is searched recursively for FITS files, or
+        a manifest file listing one input path per line. Blank lines and lines
+        starting with # are ignored and relative paths are taken relative to
+        the manifest.
+
+    Returns
+    -------
+    inputs : list of str
+        The absolute paths of the inputs, sorted if found in a directory.
+    """
+    source = os.path.abspath(source)
+    if os.path.isdir(source):
+        inputs = []
+        for ext in fits_extensions:
+            inputs.extend(glob.glob(os.path.join(source, '**', '*' + ext),
+                                    recursive=True))
+        return sorted(set(inputs))
+    root = os.path.dirname(source)
+    inputs = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            inputs.append(os.path.normpath(os.path.join(root, line)))
+    return inputs
+
+
+class CompletionManifest(object):
+    """A record of the inputs which have been simulated.
+
+    The manifest is a file with one JSON record per line which is appended to
+    (and flushed to disk) as each input completes so that an interrupted
+    run loses at most the files which were in progress.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the manifest. It is created if it does not exist.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partially written last line from an interrupted run
+                        continue
+                    self.records[record['input']] = record
+
+    def is_done(self, input_path):
+        """Return True if an input completed and its output still exists."""
+        record = self.records.get(input_path)
+        if record is None or record.get('status') != 'done':
+            return False
+        return os.path.exists(record['output'])
+
+    def record(self, input_path, output_path, status='done', **kwargs):
+        """Append the outcome of one input to the manifest."""
+        record = {'input': input_path, 'output': output_path,
+                  'status': status, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        record.update(kwargs)
+        self.records[input_path] = record
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return record
+
+
+def output_filename(input_path, output_dir, root=None):
+    """Return the output path for an input map.
+
+    Parameters
+    ----------
+    input_path : str
+        The input map.
+    output_dir : str
+        The output directory.
+    root : str
+        A directory containing the input. The subdirectories of the input
+        below root are recreated in output_dir so that inputs of the same
+        name in different directories do not collide. Defaults to the
+        directory of the input.
+    """
+    if root is None:
+        root = os.path.dirname(input_path)
+    name = os.path.relpath(input_path, root)
+    for ext in fits_extensions:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.join(output_dir, name + '_foxsi.fits')
+
+
+def _get_psf(scale, oversample):
+    key = (scale.to_value('arcsec / pix'), oversample)
+    kernel = _psf_cache.get(key)
+    if kernel is None:
+        kernel = psf(0 * u.arcmin, 0 * u.arcmin, scale=scale,
+                     oversample=oversample)
+        _psf_cache[key] = kernel
+    return kernel
+
+
+def _get_response(shutter_state):
+    from pyfoxsi.response import DSIResponse
+    resp = _response_cache.get(shutter_state)
+    if resp is None:
+        resp = DSIResponse(shutter_state=shutter_state)
+        _response_cache[shutter_state] = resp
+    return resp
+
+
+def _init_worker(shutter_state, energy):
+    """Warm the response cache of a new worker process."""
+    if energy is not None:
+        _get_response(shutter_state)
+
+
+def simulate_file(input_path, output_path, oversample=1, shutter_state=0,
+                  energy=None):
+    """Simulate the FOXSI observation of one input map and save it to FITS.
+
+    Parameters
+    ----------
+    input_path : str
+        The input map, readable by `sunpy.map.Map`.
+    output_path : str
+        The FITS file to write. It is written to a temporary file first and
+        moved into place so that it never exists partially written.
+    oversample : int
+        The psf oversampling factor.
+    shutter_state : int
+        The DSI shutter state used for the response.
+    energy : tuple of float (keV) or None
+        If given, the convolved map is multiplied by the DSI effective area
+        averaged over this energy band (or at this energy if one value).
+
+    Returns
+    -------
+    output_path : str
+        The path of the written file.
+    """
+    with stage('batch.load'):
+        input_map = Map(input_path)
+    kernel = _get_psf(input_map.scale[0], oversample)
+    result = convolve(input_map, kernel=kernel)
+
+    meta = result.meta
+    if energy is not None:
+        energy = np.atleast_1d(energy).astype(float)
+        resp = _get_response(shutter_state)
+        if len(energy) > 1:
+            area = resp.bin_effective_area(energy[[0, -1]]).to_value('cm**2')[0]
+        else:
+            area = resp.effective_area(energy).to_value('cm**2')[0]
+        result = Map((result.data * area, meta))
+        meta = result.meta
+        meta['earea'] = area
+        meta['energylo'] = energy[0]
+        meta['energyhi'] = energy[-1]
+        meta['shutter'] = shutter_state
+    meta['simsrc'] = os.path.basename(input_path)
+    meta['psfovers'] = oversample
+    meta['simdate'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    meta['history'] = 'Simulated FOXSI-SMEX observation of {0}'.format(
+        os.path.basename(input_path))
+
+    tmp_path = output_path + '.part'
+    with stage('batch.save'):
+        result.save(tmp_path, filetype='fits', overwrite=True)
+        os.replace(tmp_path, output_path)
+    return output_path
+
+
+def run_batch(inputs, output_dir, processes=None, oversample=1,
+              shutter_state=0, energy=None, manifest=None, resume=True):
+    """Simulate many input maps in parallel.
+
+    Parameters
+    ----------
+    inputs : list of str or str
+        The input maps or a directory/manifest understood by `find_inputs`.
+    output_dir : str
+        The directory into which the outputs and the completion manifest are
+        written. The subdirectories of the inputs below their common
+        directory are recreated in it (see `output_filename`).
+    processes : int
+        The number of worker processes. Defaults to the number of CPUs.
+    oversample, shutter_state, energy
+        Passed to `simulate_file`.
+    manifest : str
+        The completion manifest. Defaults to manifest.jsonl in output_dir.
+    resume : bool
+        If True, inputs recorded as done in the manifest are skipped.
+
+    Returns
+    -------
+    records : list of dict
+        The manifest records of the inputs processed in this run.
+    """
+    if isinstance(inputs, str):
+        inputs = find_inputs(inputs)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if manifest is None:
+        manifest = os.path.join(output_dir, 'manifest.jsonl')
+    completed = CompletionManifest(manifest)
+
+    todo = [f for f in inputs if not (resume and completed.is_done(f))]
+    log.info('%i of %i inputs to simulate', len(todo), len(inputs))
+    # mirror the directories below the common directory of all of the inputs
+    # so that the outputs do not depend on which inputs are left to do
+    root = None
+    if inputs:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in inputs])
+    outputs = {}
+    for input_path in todo:
+        output_path = output_filename(input_path, output_dir, root=root)
+        other = outputs.setdefault(output_path, input_path)
+        if other != input_path:
+            raise ValueError('{0} and {1} would both be written to {2}'.format(
+                other, input_path, output_path))
+
+    records = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(shutter_state, energy)) as executor:
+        futures = {}
+        for output_path, input_path in outputs.items():
+            output_subdir = os.path.dirname(output_path)
+            if not os.path.isdir(output_subdir):
+                os.makedirs(output_subdir)
+            future = executor.submit(simulate_file, input_path, output_path,
+                                     oversample=oversample,
+                                     shutter_state=shutter_state,
+                                     energy=energy)
+            futures[future] = (input_path, output_path)
+        for future in as_completed(futures):
+            input_path, output_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error('Failed to simulate %s: %s', input_path, e)
+                records.append(completed.record(input_path, output_path,
+                                                status='failed', error=str(e)))
+            else:
+                records.append(completed.record(input_path, output_path))
+    return records
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+import sunpy.map
+from sunpy.coordinates import frames
+
+from pyfoxsi.batch import run_batch
+from pyfoxsi.batch.batch import output_filename
+
+
+def _write_map(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    coord = SkyCoord(0 * u.arcsec, 0 * u.arcsec, obstime='2020-01-01',
+                     observer='earth', frame=frames.Helioprojective)
+    header = sunpy.map.make_fitswcs_header(np.ones((16, 16)), coord,
+                                           scale=[2, 2] * u.arcsec / u.pix)
+    sunpy.map.Map(np.ones((16, 16)), header).save(path)
+
+
+def test_output_filename_mirrors_subdirectories(tmp_path):
+    root = str(tmp_path)
+    a = output_filename(os.path.join(root, 'a', 'map.fits'), 'out', root=root)
+    b = output_filename(os.path.join(root, 'b', 'map.fits'), 'out', root=root)
+    assert a == os.path.join('out', 'a', 'map_foxsi.fits')
+    assert b == os.path.join('out', 'b', 'map_foxsi.fits')
+    assert output_filename(os.path.join(root, 'map.fts'), 'out') == os.path.join('out', 'map_foxsi.fits')
+
+
+def test_inputs_with_the_same_name(tmp_path):
+    inputs = [str(tmp_path / 'in' / d / 'map.fits') for d in 'ab']
+    for path in inputs:
+        _write_map(path)
+    output_dir = str(tmp_path / 'out')
+    records = run_batch(str(tmp_path / 'in'), output_dir, processes=2)
+    assert sorted(r['status'] for r in records) == ['done', 'done']
+    for d in 'ab':
+        assert os.path.exists(os.path.join(output_dir, d, 'map_foxsi.fits'))
+    # nothing is left to do on resume
+    assert run_batch(str(tmp_path / 'in'), output_dir, processes=2) == []
@@ -0,0 +1,340 @@
+"""
+Cache is a module to store simulation products on disk between sessions
+
+Products are stored as .npy files named by a hash of everything that went
+into them (inputs, parameters and the versions of the data files used) so
+that a product is recomputed only if one of these changes. Files can be
+memory-mapped when read back. The total size of the cache is bounded by
+evicting the least recently used products.
+
+The cache is off unless it is turned on with `enable_cache` or by setting
+the PYFOXSI_CACHE_DIR environment variable (and optionally
+PYFOXSI_CACHE_SIZE in bytes).
+
+Examples
+--------
+>>> from pyfoxsi.cache import enable_cache
+>>> cache = enable_cache('/tmp/pyfoxsi_cache', max_size=10 * 1024 ** 3)
+>>> key = cache.make_key('psf', 2.0, 1)
+>>> kernel = cache.get_or_compute(key, lambda: np.ones((11, 11)))  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+import os
+import errno
+import hashlib
+import tempfile
+import numbers
+
+import numpy as np
+import astropy.units as u
+
+import pyfoxsi
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['DiskCache', 'enable_cache', 'disable_cache', 'get_cache',
+           'data_version']
+
+default_max_size = 2 * 1024 ** 3
+
+_cache = None
+_data_versions = {}
+
+
+def data_path(filename):
+    """Return the full path to a file in the pyfoxsi data directory."""
+    path = os.path.dirname(pyfoxsi.__file__)
+    for i in np.arange(3):
+        path = os.path.dirname(path)
+    path = os.path.join(path, 'data/')
+    return os.path.join(path, filename)
+
+
+def data_version(filename):
+    """Return a hash of the contents of a file in the pyfoxsi data directory.
+
+    The hash is remembered for as long as the file modification time and size
+    are unchanged so that the file is only read once per session.
+    """
+    path = data_path(filename)
+    stat = os.stat(path)
+    version_key = (path, stat.st_mtime, stat.st_size)
+    version = _data_versions.get(version_key)
+    if version is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        version = h.hexdigest()
+        _data_versions[version_key] = version
+    return version
+
+
+def _update_hash(h, obj):
+    """Feed a canonical representation of obj into the hash h."""
+    if isinstance(obj, u.Quantity):
+        h.update(b'Q' + obj.unit.to_string().encode())
+        _update_hash(h, obj.value)
+    elif isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        h.update(b'A' + obj.dtype.str.encode() + repr(obj.shape).encode())
+        h.update(obj.data if obj.dtype.kind != 'O' else repr(obj.tolist()).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'L' + str(len(obj)).encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update(b'D' + str(len(obj)).encode())
+        for k in sorted(obj, key=str):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (str, bytes, numbers.Number, bool)) or obj is None:
+        h.update(b'S' + repr(obj).encode())
+    elif hasattr(obj, 'array'):
+        # kernels
+        _update_hash(h, obj.array)
+    elif hasattr(obj, 'data') and hasattr(obj, 'meta'):
+        # maps
+        _update_hash(h, obj.data)
+        _update_hash(h, dict(obj.meta))
+    else:
+        h.update(b'R' + repr(obj).encode())
+
+
+class DiskCache(object):
+    """A size bounded, content addressed store of arrays on disk.
+
+    The cache is safe to share between processes on one node. Products are
+    written to a temporary file and atomically renamed into place and
+    eviction is serialized with a lock file.
+
+    Each process keeps a running total of the cache size rather than
+    scanning the directory on every write. The directory is only scanned,
+    and the oldest products evicted down to `low_water` of the maximum size,
+    once the total exceeds the maximum or after `rescan_writes` writes,
+    which bounds the drift from products written by other processes.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which the products are stored.
+    max_size : int
+        The maximum total size of the products in bytes.
+    """
+    # the fraction of max_size to which a write that overflows evicts
+    low_water = 0.9
+    # the number of writes after which the size is scanned again
+    rescan_writes = 256
+
+    def __init__(self, directory, max_size=default_max_size):
+        self.directory = os.path.abspath(directory)
+        self.max_size = int(max_size)
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._lock_file = os.path.join(self.directory, '.lock')
+        # the running size of the cache, unknown until the first scan
+        self._size = None
+        self._writes = 0
+
+    def make_key(self, *parts, **kwargs):
+        """Return the key of a product from everything it depends on.
+
+        Parameters
+        ----------
+        parts
+            Arrays, quantities, numbers, strings or nested lists/dicts of them.
+        data_files : list of str
+            Names of files in the pyfoxsi data directory the product depends
+            on. Their content hashes become part of the key.
+        """
+        data_files = kwargs.pop('data_files', [])
+        h = hashlib.sha256()
+        _update_hash(h, list(parts))
+        _update_hash(h, kwargs)
+        _update_hash(h, [data_version(f) for f in data_files])
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, mmap=True):
+        """Return a stored product or None if it is not in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key from `make_key`.
+        mmap : bool
+            If True, the array is memory-mapped read-only rather than read.
+        """
+        path = self._path(key)
+        try:
+            result = np.load(path, mmap_mode='r' if mmap else None)
+            # mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # missing, being evicted or partially written by a crashed writer
+            return None
+        return result
+
+    def set(self, key, array):
+        """Store a product.
+
+        Returns
+        -------
+        array : `~numpy.ndarray`
+            The array that was stored.
+        """
+        array = np.asanyarray(array)
+        if isinstance(array, u.Quantity):
+            array = array.value
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._writes += 1
+        if self._size is not None:
+            self._size += os.stat(path).st_size - replaced
+        if (self._size is None or self._size > self.max_size or
+                self._writes >= self.rescan_writes):
+            self._evict(self.max_size, int(self.low_water * self.max_size))
+        return array
+
+    def get_or_compute(self, key, func, mmap=True):
+        """Return a stored product, computing and storing it if it is missing."""
+        result = self.get(key, mmap=mmap)
+        if result is None:
+            result = self.set(key, func())
+        return result
+
+    def _entries(self):
+        entries = []
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for entry in os.listdir(subdir):
+                if not entry.endswith('.npy'):
+                    continue
+                path = os.path.join(subdir, entry)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    @property
+    def size(self):
+        """The total size of the stored products in bytes"""
+        return sum([e[1] for e in self._entries()])
+
+    def evict(self, max_size=None):
+        """Remove the least recently used products until the cache fits.
+
+        Parameters
+        ----------
+        max_size : int
+            The size to shrink to. Defaults to the maximum size of the cache.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        self._evict(max_size, max_size)
+
+    def _evict(self, limit, target):
+        """Scan the cache and, if it is larger than limit, shrink it to target."""
+        with open(self._lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = sorted(self._entries())
+                total = sum([e[1] for e in entries])
+                if total <= limit:
+                    target = total
+                for mtime, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    total -= size
+                self._size = total
+                self._writes = 0
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def clear(self):
+        """Remove all stored products."""
+        self.evict(max_size=0)
+
+    def __repr__(self):
+        return '<DiskCache {0} (max {1} bytes)>'.format(self.directory,
+                                                        self.max_size)
+
+
+def enable_cache(directory=None, max_size=None):
+    """Turn on the on-disk cache of simulation products.
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory. Defaults to PYFOXSI_CACHE_DIR or ~/.pyfoxsi/cache.
+    max_size : int
+        The maximum size in bytes. Defaults to PYFOXSI_CACHE_SIZE or 2 GB.
+
+    Returns
+    -------
+    cache : `DiskCache`
+    """
+    global _cache
+    if directory is None:
+        directory = os.environ.get('PYFOXSI_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'),
+                                                '.pyfoxsi', 'cache'))
+    if max_size is None:
+        max_size = int(os.environ.get('PYFOXSI_CACHE_SIZE', default_max_size))
+    _cache = DiskCache(directory, max_size=max_size)
+    return _cache
+
+
+def disable_cache():
+    """Turn off the on-disk cache. Stored products are kept."""
+    global _cache
+    _cache = False
+
+
+def get_cache():
+    """Return the active `DiskCache` or None if caching is off."""
+    if _cache is None and os.environ.get('PYFOXSI_CACHE_DIR'):
+        enable_cache()
+    return _cache or None
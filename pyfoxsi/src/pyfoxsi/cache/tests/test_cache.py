@@ -0,0 +1,37 @@
+import io
+
+import numpy as np
+
+from pyfoxsi.cache import DiskCache
+
+
+def _npy_size(array):
+    f = io.BytesIO()
+    np.save(f, array, allow_pickle=False)
+    return len(f.getvalue())
+
+
+def test_writes_do_not_scan_the_cache(tmp_path, monkeypatch):
+    cache = DiskCache(str(tmp_path), max_size=10 ** 9)
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, '_entries', lambda: scans.append(1) or entries())
+    for i in range(100):
+        cache.set(cache.make_key(i), np.zeros(10))
+    # only the first write scans to learn the size of the cache
+    assert len(scans) == 1
+    assert cache._size == cache.size
+
+
+def test_size_stays_bounded(tmp_path):
+    array = np.zeros(1000)
+    nbytes = _npy_size(array)
+    cache = DiskCache(str(tmp_path), max_size=10 * nbytes)
+    keys = [cache.make_key(i) for i in range(50)]
+    for key in keys:
+        cache.set(key, array)
+        assert cache.size <= 10 * nbytes
+    # the most recent products are kept
+    assert keys[-1] in cache
+    assert keys[0] not in cache
+
@@ -0,0 +1,91 @@
+"""
+The pyfoxsi command line tool
+"""
+
+from __future__ import absolute_import
+import sys
+import logging
+import argparse
+
+__all__ = ['main']
+
+
+def _batch(args):
+    from pyfoxsi.batch import run_batch
+    records = run_batch(args.inputs, args.output, processes=args.processes,
+                        oversample=args.oversample,
+                        shutter_state=args.shutter_state, energy=args.energy,
+                        manifest=args.manifest, resume=not args.no_resume)
+    failed = [r for r in records if r['status'] != 'done']
+    print('{0} simulated, {1} failed'.format(len(records) - len(failed),
+                                             len(failed)))
+    return 1 if failed else 0
+
+
+def _serve(args):
+    from pyfoxsi.server import serve
+    serve(args.address, batch_window=args.batch_window / 1000.,
+          shutter_states=args.shutter_state, stc_kinds=args.stc,
+          simulate_workers=args.simulate_workers)
+    return 0
+
+
+def build_parser():
+    """Return the argument parser of the pyfoxsi command."""
+    parser = argparse.ArgumentParser(prog='pyfoxsi',
+                                     description='FOXSI-SMEX simulation tools')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print progress messages')
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('batch',
+                                  help='simulate many input maps in parallel')
+    batch.add_argument('inputs',
+                       help='a directory of FITS maps or a manifest listing them')
+    batch.add_argument('output', help='the output directory')
+    batch.add_argument('-j', '--processes', type=int, default=None,
+                       help='number of worker processes (default: all CPUs)')
+    batch.add_argument('--oversample', type=int, default=1,
+                       help='psf oversampling factor')
+    batch.add_argument('--shutter-state', type=int, default=0,
+                       help='DSI shutter state used for the response')
+    batch.add_argument('--energy', type=float, nargs='+', default=None,
+                       help='energy or energy band [keV] at which to apply '
+                            'the effective area')
+    batch.add_argument('--manifest', default=None,
+                       help='completion manifest (default: OUTPUT/manifest.jsonl)')
+    batch.add_argument('--no-resume', action='store_true',
+                       help='redo inputs already recorded as done')
+    batch.set_defaults(func=_batch)
+
+    serve = subparsers.add_parser('serve',
+                                  help='run a local server which keeps responses '
+                                       'and psf kernels in memory')
+    serve.add_argument('--address', default='localhost:7625',
+                       help='Unix socket path or host:port (default: %(default)s)')
+    serve.add_argument('--batch-window', type=float, default=5.,
+                       help='time [ms] to wait for requests to compute together')
+    serve.add_argument('--shutter-state', type=int, nargs='*', default=[0],
+                       help='DSI shutter states whose responses are built at start')
+    serve.add_argument('--stc', nargs='*', default=[], choices=['Q', 'F'],
+                       help='STC detectors whose responses are built at start')
+    serve.add_argument('--simulate-workers', type=int, default=1,
+                       help='number of file simulations run at once (default: %(default)s)')
+    serve.set_defaults(func=_serve)
+    return parser
+
+
+def main(argv=None):
+    """Run the pyfoxsi command line tool."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
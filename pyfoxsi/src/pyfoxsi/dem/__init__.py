@@ -0,0 +1,6 @@
+from __future__ import absolute_import
+
+__author__ = "Steven D. Christe"
+__email__ = "steven.christe@nasa.gov"
+
+from pyfoxsi.dem.dem import *
@@ -0,0 +1,185 @@
+"""
+DEM is a module to synthesize X-ray source cubes from differential emission
+measure maps
+
+The thermal X-ray emission of every temperature bin into every energy bin is
+computed once as an emissivity matrix and the photon cube is then a single
+matrix product of this matrix with the emission measure of all pixels.
+Only the free-free continuum is included, in the approximation
+
+.. math:: F(E) = 8.1 \\times 10^{-39} \\frac{EM}{E T^{1/2}} e^{-E / kT}
+
+in ph / cm2 / s / keV at 1 AU with EM in cm^-3, T in K and E in keV (e.g.
+Tandberg-Hanssen & Emslie 1988), integrated exactly over each energy bin.
+
+Examples
+--------
+>>> from pyfoxsi.dem import dem_to_cube
+>>> t_edges = np.logspace(6, 7.5, 21) * u.K
+>>> dem = np.ones((20, 1024, 1024)) * 1e22 * u.cm ** -5 / u.K
+>>> cube = dem_to_cube(dem, t_edges, np.arange(4, 21) * u.keV, scale=2 * u.arcsec / u.pix)  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+import astropy.constants as const
+from scipy.special import exp1
+
+from pyfoxsi.psf import get_dtype
+from pyfoxsi.cache import get_cache
+from pyfoxsi.profiling import stage
+
+__all__ = ['thermal_emissivity', 'emission_measure', 'dem_to_cube']
+
+# the normalization of the free-free continuum (ph / cm2 / s / keV at 1 AU)
+bremsstrahlung_constant = 8.1e-39
+
+_emissivities = {}
+
+
+def _temperatures(temperature_edges):
+    """The geometric centres and widths (K) of the temperature bins."""
+    edges = temperature_edges.to_value(u.K, equivalencies=u.temperature_energy())
+    return np.sqrt(edges[:-1] * edges[1:]), np.diff(edges)
+
+
+def thermal_emissivity(temperature_edges, energy_edges):
+    """The photon flux from unit emission measure at each temperature.
+
+    The matrix is kept in memory and, if the cache is on, on disk so that it
+    is only computed once for each pair of grids.
+
+    Parameters
+    ----------
+    temperature_edges : `~astropy.units.Quantity` <K>
+        The n + 1 edges of the temperature bins. The emission of each bin is
+        that at its geometric centre.
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The m + 1 edges of the energy bins.
+
+    Returns
+    -------
+    emissivity : `~numpy.ndarray`
+        The (n, m) photon flux in each energy bin (ph / cm2 / s) at 1 AU from
+        an emission measure of 1 cm^-3.
+    """
+    temperature, _ = _temperatures(temperature_edges)
+    energy = energy_edges.to_value(u.keV)
+    key = (temperature.tobytes(), energy.tobytes())
+    emissivity = _emissivities.get(key)
+    if emissivity is not None:
+        return emissivity
+
+    def compute():
+        kt = (const.k_B * temperature * u.K).to_value(u.keV)
+        # the integral of exp(-E / kT) / E over each bin
+        x = energy[np.newaxis, :] / kt[:, np.newaxis]
+        integral = exp1(x[:, :-1]) - exp1(x[:, 1:])
+        return bremsstrahlung_constant * integral / np.sqrt(temperature)[:, np.newaxis]
+
+    with stage('dem.emissivity') as s:
+        cache = get_cache()
+        if cache is not None:
+            cache_key = cache.make_key('thermal_emissivity', temperature, energy,
+                                       bremsstrahlung_constant)
+            emissivity = np.array(cache.get_or_compute(cache_key, compute))
+        else:
+            emissivity = compute()
+        s.add_array(emissivity)
+    _emissivities[key] = emissivity
+    return emissivity
+
+
+def emission_measure(dem, temperature_edges, scale=None):
+    """The emission measure (cm^-3) of each temperature bin and pixel.
+
+    Parameters
+    ----------
+    dem : `~astropy.units.Quantity`
+        A (temperature, y, x) cube. Differential emission measures, in
+        cm^-5 K^-1 or cm^-3 K^-1, are multiplied by the width of the
+        temperature bins and column emission measures, in cm^-5 or
+        cm^-5 K^-1, by the area of a pixel on the Sun.
+    temperature_edges : `~astropy.units.Quantity` <K>
+        The edges of the temperature bins.
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel), needed for column emission
+        measures. The area is that seen from 1 AU.
+
+    Returns
+    -------
+    em : `~astropy.units.Quantity` <cm^-3>
+        The emission measure cube. It is the input without a copy if it is
+        already an emission measure.
+    """
+    _, width = _temperatures(temperature_edges)
+    unit = dem.unit
+    factor = 1.
+    if unit.is_equivalent(u.cm ** -5 / u.K) or unit.is_equivalent(u.cm ** -3 / u.K):
+        factor = width[:, np.newaxis, np.newaxis] * u.K
+        unit = unit * u.K
+    if unit.is_equivalent(u.cm ** -5):
+        if scale is None:
+            raise ValueError('The pixel scale is needed for a column emission measure')
+        side = (scale * u.pix).to_value(u.rad) * const.au
+        factor = factor * side ** 2
+    elif not unit.is_equivalent(u.cm ** -3):
+        raise ValueError('Not a valid emission measure unit: {0}'.format(dem.unit))
+    if np.isscalar(factor) and factor == 1.:
+        return dem.to(u.cm ** -3, copy=False)
+    return (dem * factor).to(u.cm ** -3)
+
+
+def dem_to_cube(dem, temperature_edges, energy_edges, scale=None,
+                chunk_size=None, precision=None):
+    """Synthesize the thermal photon flux cube of a DEM cube.
+
+    All pixels are computed at once as one matrix product of the
+    `thermal_emissivity` matrix with the emission measures, or in chunks of
+    pixels to bound the memory for very large maps.
+
+    Parameters
+    ----------
+    dem : `~astropy.units.Quantity`
+        A (temperature, y, x) cube of (differential) emission measures, see
+        `emission_measure`.
+    temperature_edges : `~astropy.units.Quantity` <K>
+        The n + 1 edges of the temperature bins.
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The m + 1 edges of the energy bins of the cube.
+    scale : `~astropy.units.Quantity`
+        The pixel scale, needed for column emission measures.
+    chunk_size : int
+        The number of pixels per chunk. Defaults to all pixels at once.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+
+    Returns
+    -------
+    cube : `~astropy.units.Quantity` <ph / cm2 / s>
+        The (energy, y, x) photon flux in each energy bin and pixel at 1 AU.
+    """
+    dtype = get_dtype(precision)
+    # the constant is moved onto the emission measure so that neither factor
+    # is out of the range of single precision
+    emissivity = (thermal_emissivity(temperature_edges, energy_edges) /
+                  bremsstrahlung_constant).astype(dtype)
+    em = emission_measure(dem, temperature_edges, scale=scale).value
+    nt, ny, nx = em.shape
+    if nt != emissivity.shape[0]:
+        raise ValueError('The dem has {0} temperature bins but there are {1} '
+                         'temperature edges'.format(nt, len(temperature_edges)))
+    em = em.reshape(nt, ny * nx)
+    with stage('dem.cube') as s:
+        if chunk_size is None:
+            cube = np.dot(emissivity.T, (em * bremsstrahlung_constant).astype(dtype, copy=False))
+        else:
+            cube = np.empty((emissivity.shape[1], ny * nx), dtype=dtype)
+            for start in range(0, ny * nx, chunk_size):
+                stop = min(start + chunk_size, ny * nx)
+                chunk = (em[:, start:stop] * bremsstrahlung_constant).astype(dtype, copy=False)
+                cube[:, start:stop] = np.dot(emissivity.T, chunk)
+        s.add_array(cube)
+    return u.Quantity(cube.reshape(-1, ny, nx), u.ph / u.cm ** 2 / u.s, copy=False)
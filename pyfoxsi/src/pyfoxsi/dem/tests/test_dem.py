@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import astropy.units as u
+import astropy.constants as const
+from scipy.integrate import quad
+
+from pyfoxsi.dem import dem_to_cube, emission_measure
+
+t_edges = np.logspace(6, 7.5, 16) * u.K
+e_edges = np.arange(4, 21, 2.) * u.keV
+
+
+def _isothermal(em, index=10, shape=(3, 4)):
+    cube = np.zeros((len(t_edges) - 1,) + shape)
+    cube[index] = em
+    return cube * u.cm ** -3
+
+
+def test_isothermal_free_free_spectrum():
+    em = np.arange(1, 13).reshape(3, 4) * 1e46
+    cube = dem_to_cube(_isothermal(em), t_edges, e_edges)
+    assert cube.shape == (len(e_edges) - 1, 3, 4)
+    assert cube.unit == u.ph / u.cm ** 2 / u.s
+    temperature = np.sqrt(t_edges[10] * t_edges[11]).to_value(u.K)
+    kt = (const.k_B * temperature * u.K).to_value(u.keV)
+
+    def spectrum(energy):
+        return 8.1e-39 * np.exp(-energy / kt) / (energy * np.sqrt(temperature))
+
+    expected = np.array([quad(spectrum, lo, hi)[0]
+                         for lo, hi in zip(e_edges.value[:-1], e_edges.value[1:])])
+    np.testing.assert_allclose(cube.value, expected[:, np.newaxis, np.newaxis] * em,
+                               rtol=1e-8)
+
+
+def test_chunks_and_precision_agree():
+    rng = np.random.RandomState(4)
+    dem = rng.rand(len(t_edges) - 1, 5, 7) * 1e45 * u.cm ** -3
+    cube = dem_to_cube(dem, t_edges, e_edges)
+    np.testing.assert_allclose(dem_to_cube(dem, t_edges, e_edges, chunk_size=6), cube,
+                               rtol=1e-12)
+    single = dem_to_cube(dem, t_edges, e_edges, precision='single')
+    assert single.dtype == np.float32
+    np.testing.assert_allclose(single, cube, rtol=1e-5)
+
+
+def test_emission_measure_units():
+    width = np.diff(t_edges.value)[:, np.newaxis, np.newaxis]
+    dem = np.ones((len(t_edges) - 1, 2, 2)) * 1e20 * u.cm ** -5 / u.K
+    scale = 2 * u.arcsec / u.pix
+    area = ((2 * u.arcsec).to_value(u.rad) * const.au) ** 2
+    em = emission_measure(dem, t_edges, scale=scale)
+    np.testing.assert_allclose(em.to_value(u.cm ** -3),
+                               (1e20 * width * area).to_value(u.cm ** 2) *
+                               np.ones((1, 2, 2)))
+    # the flux of a dem is that of its emission measure
+    np.testing.assert_allclose(dem_to_cube(dem, t_edges, e_edges, scale=scale),
+                               dem_to_cube(em, t_edges, e_edges))
+    with pytest.raises(ValueError, match='pixel scale'):
+        emission_measure(dem, t_edges)
+    with pytest.raises(ValueError, match='unit'):
+        emission_measure(dem.value * u.s, t_edges)
+    with pytest.raises(ValueError, match='temperature'):
+        dem_to_cube(em[1:], t_edges, e_edges)
@@ -0,0 +1,200 @@
+"""
+Exposure is a module to accumulate the exposure of pointing schedules on the
+Sun
+
+The field of view is sampled on a fixed grid of offsets from the optical axis
+whose vignetting is computed once. For every pointing the samples are
+rotated by the roll, projected onto the solar surface and deposited onto a
+heliographic grid with `~numpy.bincount`, many pointings at a time, so that
+no map is built per pointing.
+
+Examples
+--------
+>>> from pyfoxsi.exposure import raster, exposure_map
+>>> x, y = raster((0, 0) * u.arcsec, (8, 8), 8 * u.arcmin)
+>>> grid = exposure_map(x, y, dwell=600 * u.s, energy_band=[[4, 10], [10, 20]] * u.keV)  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+
+import pyfoxsi
+from pyfoxsi.profiling import stage
+
+__all__ = ['vignetting', 'raster', 'exposure_map']
+
+# the angular radius of the Sun used if no times are given
+default_solar_radius = 959.63 * u.arcsec
+
+# the largest number of samples projected at once
+_chunk_samples = 1 << 22
+
+
+def vignetting(offaxis_angle, energy):
+    """The fraction of the on-axis effective area at an off-axis angle.
+
+    The area is assumed to fall linearly with off-axis angle to half at
+    `pyfoxsi.vignetting_half_angle`, which is interpolated in log energy and
+    held constant beyond the tabulated energies. Both the linear falloff and
+    the half angles are placeholders, not a model of the optics.
+
+    Parameters
+    ----------
+    offaxis_angle : `~astropy.units.Quantity`
+        The angle from the optical axis.
+    energy : `~astropy.units.Quantity`
+        The photon energy. It is broadcast against offaxis_angle.
+
+    Returns
+    -------
+    vignetting : `~numpy.ndarray`
+    """
+    half = np.interp(np.log(energy.to_value(u.keV)),
+                     np.log(pyfoxsi.vignetting_energy.to_value(u.keV)),
+                     pyfoxsi.vignetting_half_angle.to_value(u.arcmin))
+    return np.clip(1. - 0.5 * offaxis_angle.to_value(u.arcmin) / half, 0., 1.)
+
+
+def raster(center, shape, step, roll=0 * u.deg):
+    """The pointings of a rectangular raster.
+
+    Parameters
+    ----------
+    center : `~astropy.units.Quantity`
+        The helioprojective (x, y) centre of the raster.
+    shape : tuple of int
+        The number of pointings along (x, y).
+    step : `~astropy.units.Quantity`
+        The spacing of the pointings.
+    roll : `~astropy.units.Quantity`
+        The rotation of the raster about its centre.
+
+    Returns
+    -------
+    x, y : `~astropy.units.Quantity` <arcsec>
+        The pointing centres, in raster order.
+    """
+    nx, ny = shape
+    step = step.to_value(u.arcsec)
+    u0, v0 = np.meshgrid((np.arange(nx) - (nx - 1) / 2.) * step,
+                         (np.arange(ny) - (ny - 1) / 2.) * step)
+    r = roll.to_value(u.rad)
+    cx, cy = u.Quantity(center, u.arcsec).value
+    x = cx + u0 * np.cos(r) - v0 * np.sin(r)
+    y = cy + u0 * np.sin(r) + v0 * np.cos(r)
+    return x.ravel() * u.arcsec, y.ravel() * u.arcsec
+
+
+def exposure_map(x, y, dwell, energy_band, roll=0 * u.deg, times=None,
+                 resolution=1 * u.deg, sampling=None, samples=16):
+    """Accumulate the vignetted exposure of a pointing schedule.
+
+    Parameters
+    ----------
+    x, y : `~astropy.units.Quantity`
+        The helioprojective position of the optical axis of each pointing.
+    dwell : `~astropy.units.Quantity`
+        The time spent at each pointing.
+    energy_band : `~astropy.units.Quantity` <keV>
+        The (lower, upper) edges of one band or an array of shape (n, 2).
+    roll : `~astropy.units.Quantity`
+        The roll of the detector for each pointing.
+    times : `~astropy.time.Time`
+        The time of each pointing. If given, the grid is in Carrington
+        coordinates using the solar B0, L0 and radius at these times.
+        Otherwise it is Stonyhurst, seen from B0 = 0.
+    resolution : `~astropy.units.Quantity`
+        The size of the grid cells in longitude and latitude.
+    sampling : `~astropy.units.Quantity`
+        The spacing of the samples of the field of view. Defaults to a third
+        of a grid cell at disk centre.
+    samples : int
+        The number of energies at which the vignetting is averaged per band.
+
+    Returns
+    -------
+    exposure : `~astropy.units.Quantity` <s>
+        The (band, latitude, longitude) time for which each cell was observed,
+        weighted by the mean vignetting over the band.
+    lon_edges, lat_edges : `~astropy.units.Quantity` <deg>
+        The edges of the grid cells.
+    """
+    xc = np.atleast_1d(x.to_value(u.arcsec))
+    yc = np.atleast_1d(y.to_value(u.arcsec))
+    npoint = len(xc)
+    dwell = np.broadcast_to(dwell.to_value(u.s), npoint)
+    roll = np.broadcast_to(roll.to_value(u.rad), npoint)
+    band = np.atleast_2d(energy_band.to_value(u.keV))
+    res = resolution.to_value(u.deg)
+    if times is None:
+        b0 = np.zeros(npoint)
+        l0 = np.zeros(npoint)
+        radius = np.full(npoint, default_solar_radius.to_value(u.arcsec))
+        lon0 = -180.
+    else:
+        from sunpy.coordinates import sun
+        b0 = np.broadcast_to(sun.B0(times).to_value(u.rad), npoint)
+        l0 = np.broadcast_to(sun.L0(times).to_value(u.deg), npoint)
+        radius = np.broadcast_to(sun.angular_radius(times).to_value(u.arcsec), npoint)
+        lon0 = 0.
+    nlon = int(round(360. / res))
+    nlat = int(round(180. / res))
+
+    with stage('exposure.samples') as s:
+        # sample the field of view at the centres of equal cells
+        if sampling is None:
+            sampling = np.deg2rad(res) * radius.max() / 3. * u.arcsec
+        width = (pyfoxsi.dsi_pixel_size * pyfoxsi.dsi_number_of_pixels).to_value(u.arcsec)
+        nsample = max(int(np.ceil(width / sampling.to_value(u.arcsec))), 1)
+        offsets = (np.arange(nsample) + 0.5) * width / nsample - width / 2.
+        du, dv = [a.ravel() for a in np.meshgrid(offsets, offsets)]
+        solid_angle = (width / nsample) ** 2
+        frac = (np.arange(samples) + 0.5) / samples
+        energy = band[:, :1] + frac * (band[:, 1:] - band[:, :1])
+        offaxis = np.hypot(du, dv) * u.arcsec
+        # the mean vignetting of each sample over each band, (band, sample)
+        vig = vignetting(offaxis[np.newaxis, np.newaxis, :],
+                         energy[:, :, np.newaxis] * u.keV).mean(axis=1)
+        s.add_array(vig)
+
+    exposure = np.zeros((len(band), nlat * nlon))
+    chunk = max(_chunk_samples // len(du), 1)
+    with stage('exposure.accumulate') as s:
+        for start in range(0, npoint, chunk):
+            p = slice(start, min(start + chunk, npoint))
+            cos_r = np.cos(roll[p])[:, np.newaxis]
+            sin_r = np.sin(roll[p])[:, np.newaxis]
+            r = radius[p][:, np.newaxis]
+            # the samples on the sky in solar radii
+            sx = (xc[p][:, np.newaxis] + du * cos_r - dv * sin_r) / r
+            sy = (yc[p][:, np.newaxis] + du * sin_r + dv * cos_r) / r
+            z2 = 1. - sx ** 2 - sy ** 2
+            on_disk = z2 > 0
+            z = np.sqrt(np.where(on_disk, z2, 0.))
+            # orthographic projection onto the sphere tilted by B0
+            cos_b = np.cos(b0[p])[:, np.newaxis]
+            sin_b = np.sin(b0[p])[:, np.newaxis]
+            sin_lat = np.clip(sy * cos_b + z * sin_b, -1., 1.)
+            lat = np.arcsin(sin_lat)
+            lon = np.rad2deg(np.arctan2(sx, z * cos_b - sy * sin_b)) + l0[p][:, np.newaxis]
+            ilon = np.floor((lon - lon0) / res).astype(int) % nlon
+            ilat = np.clip(np.floor((np.rad2deg(lat) + 90.) / res).astype(int), 0, nlat - 1)
+            # the time per unit area of the cell, from the sky area of a sample
+            # and the foreshortened area of the cell
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = (dwell[p][:, np.newaxis] * solid_angle /
+                          (r ** 2 * z * np.cos(lat) * np.deg2rad(res) ** 2))
+            keep = on_disk & np.isfinite(weight)
+            index = (ilat * nlon + ilon)[keep]
+            weight = weight[keep]
+            sample = np.broadcast_to(np.arange(len(du)), keep.shape)[keep]
+            for i in range(len(band)):
+                exposure[i] += np.bincount(index, weights=weight * vig[i][sample],
+                                           minlength=nlat * nlon)
+        s.add_array(exposure)
+
+    lon_edges = (lon0 + np.arange(nlon + 1) * res) * u.deg
+    lat_edges = (-90. + np.arange(nlat + 1) * res) * u.deg
+    return exposure.reshape(len(band), nlat, nlon) * u.s, lon_edges, lat_edges
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import astropy.units as u
+
+import pyfoxsi
+from pyfoxsi.exposure import vignetting, exposure_map, raster
+
+
+def test_vignetting_is_linear_to_half_and_clipped():
+    energy = pyfoxsi.vignetting_energy
+    half = pyfoxsi.vignetting_half_angle
+    np.testing.assert_allclose(vignetting(0 * u.arcmin, energy), 1.)
+    np.testing.assert_allclose(vignetting(half, energy), 0.5)
+    np.testing.assert_allclose(vignetting(half / 2, energy), 0.75)
+    np.testing.assert_allclose(vignetting(3 * half, energy), 0.)
+    # held constant beyond the tabulated energies
+    assert vignetting(half[-1], 2 * energy[-1]) == pytest.approx(0.5)
+
+
+def test_exposure_map_of_one_pointing(monkeypatch):
+    # a half angle inside the field of view, so the map reaches half and zero
+    monkeypatch.setattr(pyfoxsi, 'vignetting_half_angle', np.full(5, 2.) * u.arcmin)
+    dwell = 100 * u.s
+    exposure, lon_edges, lat_edges = exposure_map(0 * u.arcsec, 0 * u.arcsec, dwell,
+                                                  [10, 20] * u.keV)
+    assert exposure.shape == (1, 180, 360)
+    lon = 0.5 * (lon_edges[1:] + lon_edges[:-1])
+    lat = 0.5 * (lat_edges[1:] + lat_edges[:-1])
+    radius = 959.63 * u.arcsec
+    # the cells just north of disk centre, from on axis to beyond 2 half angles
+    for i in [180, 187, 195]:
+        x = radius * np.sin(lon[i]) * np.cos(lat[90])
+        offaxis = np.hypot(x, radius * np.sin(lat[90]))
+        expected = dwell * np.clip(1 - 0.5 * (offaxis / (2 * u.arcmin)).decompose(), 0, 1)
+        assert exposure[0, 90, i].to_value(u.s) == pytest.approx(expected.to_value(u.s),
+                                                                 rel=2e-2)
+    assert exposure[0, 90, 195] == 0
+
+
+def test_exposure_map_on_axis_is_the_dwell_time(monkeypatch):
+    monkeypatch.setattr(pyfoxsi, 'vignetting_half_angle', np.full(5, np.inf) * u.arcmin)
+    exposure, _, _ = exposure_map([0, 0] * u.arcsec, [0, 0] * u.arcsec, [100, 50] * u.s,
+                                  [[4, 10], [10, 20]] * u.keV)
+    np.testing.assert_allclose(exposure[:, 89:91, 179:181].to_value(u.s), 150., rtol=2e-2)
+
+
+def test_raster_is_centred():
+    x, y = raster((100, -50) * u.arcsec, (3, 2), 8 * u.arcmin)
+    assert len(x) == 6
+    assert x.mean().to_value(u.arcsec) == pytest.approx(100)
+    assert y.mean().to_value(u.arcsec) == pytest.approx(-50)
@@ -0,0 +1,193 @@
+"""
+Image is a module with the minimal image type used inside the pyfoxsi
+pipeline
+
+A sunpy Map parses and copies its metadata and builds coordinate objects,
+which costs far more than the numerics when many small maps are processed.
+An `Image` is only an array with the few numbers the pipeline needs (pixel
+scale, reference pixel and coordinate and an optional energy axis). Maps are
+converted to images without copying the data, and back only at the end of a
+public function that was given a map.
+
+Examples
+--------
+>>> from pyfoxsi.image import Image
+>>> from pyfoxsi.psf import convolve
+>>> image = Image(np.zeros((32, 32)), scale=(2., 2.))
+>>> result = convolve(image)  # doctest: +SKIP
+>>> smap = result.to_map()  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+from astropy.wcs import WCS
+from sunpy.map import GenericMap, Map
+
+__all__ = ['Image', 'as_image']
+
+_scale_unit = u.arcsec / u.pix
+_to_arcsec = {'arcsec': 1., 'arcmin': 60., 'deg': 3600., 'rad': 206264.80624709636}
+_cd_keys = ('cd1_1', 'cd1_2', 'cd2_1', 'cd2_2')
+
+
+class Image(object):
+    """An array with the pixel geometry of a helioprojective image.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        The (y, x) image or (energy, y, x) cube. It is not copied.
+    scale : tuple of float
+        The pixel scale along (x, y) in arcsec per pixel.
+    reference_pixel : tuple of float
+        The (x, y) position, in zero based pixels, of reference_coordinate.
+        Defaults to the centre of the image.
+    reference_coordinate : tuple of float
+        The helioprojective (x, y) coordinate of reference_pixel in arcsec.
+    energy : `~numpy.ndarray`
+        The edges (keV) of the energy bins of a cube.
+    meta : dict
+        The header of the map the image came from, kept (without a copy) for
+        `to_map`.
+    updates : dict
+        Header keywords to set in `to_map`.
+    """
+    __slots__ = ('data', 'scale', 'reference_pixel', 'reference_coordinate',
+                 'energy', 'meta', 'updates')
+
+    def __init__(self, data, scale=(1., 1.), reference_pixel=None,
+                 reference_coordinate=(0., 0.), energy=None, meta=None,
+                 updates=None):
+        self.data = data
+        self.scale = scale
+        if reference_pixel is None:
+            reference_pixel = ((data.shape[-1] - 1) / 2., (data.shape[-2] - 1) / 2.)
+        self.reference_pixel = reference_pixel
+        self.reference_coordinate = reference_coordinate
+        self.energy = energy
+        self.meta = meta
+        self.updates = updates or {}
+
+    @classmethod
+    def from_map(cls, sunpy_map):
+        """Wrap the data of a map without copying it.
+
+        The scale and reference pixel are those of the map, which handles
+        CDELT, PC and CD matrix headers alike. The reference coordinate is
+        read directly from the header, which is much cheaper than building
+        the coordinate. An `Image` is returned unchanged.
+        """
+        if isinstance(sunpy_map, Image):
+            return sunpy_map
+        meta = sunpy_map.meta
+        factor = [_to_arcsec[str(meta.get('cunit{0}'.format(i), 'arcsec')).lower()]
+                  for i in (1, 2)]
+        scale = sunpy_map.scale
+        reference_pixel = sunpy_map.reference_pixel
+        updates = {}
+        if any(key in meta for key in _cd_keys):
+            # the header is written with CDELT and the equivalent PC matrix
+            pc = sunpy_map.rotation_matrix
+            updates = {'pc1_1': pc[0, 0], 'pc1_2': pc[0, 1],
+                       'pc2_1': pc[1, 0], 'pc2_2': pc[1, 1]}
+        return cls(sunpy_map.data,
+                   scale=(scale[0].to_value(_scale_unit), scale[1].to_value(_scale_unit)),
+                   reference_pixel=(reference_pixel[0].to_value(u.pix),
+                                    reference_pixel[1].to_value(u.pix)),
+                   reference_coordinate=(meta.get('crval1', 0.) * factor[0],
+                                         meta.get('crval2', 0.) * factor[1]),
+                   meta=meta, updates=updates)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def pixel_scale(self):
+        """The x pixel scale as a `~astropy.units.Quantity`"""
+        return self.scale[0] * _scale_unit
+
+    def with_data(self, data, rebin=1, **updates):
+        """A new image with the same geometry and new data.
+
+        Parameters
+        ----------
+        data : `~numpy.ndarray`
+            The new data.
+        rebin : int
+            The factor by which the data has been rebinned, which scales the
+            pixel geometry.
+        updates
+            Header keywords to set in `to_map`.
+        """
+        scale = self.scale
+        reference_pixel = self.reference_pixel
+        if rebin != 1:
+            scale = (scale[0] * rebin, scale[1] * rebin)
+            reference_pixel = ((reference_pixel[0] + 0.5) / rebin - 0.5,
+                               (reference_pixel[1] + 0.5) / rebin - 0.5)
+        merged = dict(self.updates)
+        merged.update(updates)
+        return Image(data, scale, reference_pixel, self.reference_coordinate,
+                     self.energy, self.meta, merged)
+
+    def like(self, obj):
+        """Return the image as a map if obj is a map, or else unchanged."""
+        if isinstance(obj, GenericMap):
+            return self.to_map()
+        return self
+
+    def header(self):
+        """The FITS header of the image as a dict."""
+        header = dict(self.meta) if self.meta is not None else {
+            'ctype1': 'HPLN-TAN', 'ctype2': 'HPLT-TAN'}
+        for key in _cd_keys:
+            header.pop(key, None)
+        header.update({'cunit1': 'arcsec', 'cunit2': 'arcsec',
+                       'cdelt1': self.scale[0], 'cdelt2': self.scale[1],
+                       'crpix1': self.reference_pixel[0] + 1.,
+                       'crpix2': self.reference_pixel[1] + 1.,
+                       'crval1': self.reference_coordinate[0],
+                       'crval2': self.reference_coordinate[1],
+                       'naxis1': self.data.shape[-1], 'naxis2': self.data.shape[-2]})
+        header.update(self.updates)
+        return header
+
+    def to_map(self):
+        """Convert to a `~sunpy.map.GenericMap` sharing the data.
+
+        A cube is converted to a list of maps, one per energy bin.
+        """
+        header = self.header()
+        if self.data.ndim == 3:
+            maps = []
+            for i, data in enumerate(self.data):
+                slice_header = dict(header)
+                if self.energy is not None:
+                    slice_header['energylo'] = self.energy[i]
+                    slice_header['energyhi'] = self.energy[i + 1]
+                maps.append(Map((data, slice_header)))
+            return maps
+        return Map((self.data, header))
+
+    def to_wcs(self):
+        """The `~astropy.wcs.WCS` of the (spatial) image axes."""
+        wcs = WCS(naxis=2)
+        wcs.wcs.ctype = ['HPLN-TAN', 'HPLT-TAN']
+        wcs.wcs.cunit = ['arcsec', 'arcsec']
+        wcs.wcs.cdelt = self.scale
+        wcs.wcs.crpix = [self.reference_pixel[0] + 1., self.reference_pixel[1] + 1.]
+        wcs.wcs.crval = self.reference_coordinate
+        return wcs
+
+    def __repr__(self):
+        return '<Image {0} {1} at {2} arcsec/pix>'.format(self.data.shape,
+                                                          self.data.dtype,
+                                                          self.scale)
+
+
+def as_image(obj):
+    """Return a map or image as an `Image`, without copying the data."""
+    return Image.from_map(obj)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import astropy.units as u
+import sunpy.map
+
+from pyfoxsi.image import Image, as_image
+from pyfoxsi.psf import convolve
+
+
+def _header(**kwargs):
+    header = {'ctype1': 'HPLN-TAN', 'ctype2': 'HPLT-TAN', 'cunit1': 'arcsec',
+              'cunit2': 'arcsec', 'crpix1': 16.5, 'crpix2': 16.5,
+              'crval1': 10., 'crval2': 20., 'date-obs': '2020-01-01T00:00:00',
+              'naxis1': 32, 'naxis2': 32}
+    header.update(kwargs)
+    return header
+
+
+@pytest.mark.parametrize('keys', [{'cdelt1': 2., 'cdelt2': 2.},
+                                  {'cd1_1': 2., 'cd1_2': 0., 'cd2_1': 0., 'cd2_2': 2.},
+                                  {'cdelt1': 2., 'cdelt2': 2., 'pc1_1': 1.,
+                                   'pc1_2': 0., 'pc2_1': 0., 'pc2_2': 1.}])
+def test_from_map(keys):
+    smap = sunpy.map.Map(np.ones((32, 32)), _header(**keys))
+    image = as_image(smap)
+    assert image.scale == pytest.approx((2., 2.))
+    assert image.reference_pixel == pytest.approx((15.5, 15.5))
+    assert image.reference_coordinate == pytest.approx((10., 20.))
+
+    result = convolve(smap, method='separable')
+    assert u.allclose(result.scale[0], 2 * u.arcsec / u.pix)
+    assert u.allclose(result.reference_pixel[0], 15.5 * u.pix)
+
+
+def test_rebinned_cd_map():
+    smap = sunpy.map.Map(np.ones((32, 32)), _header(cd1_1=2., cd1_2=0., cd2_1=0., cd2_2=2.))
+    result = as_image(smap).with_data(np.ones((16, 16)), rebin=2).to_map()
+    assert u.allclose(result.scale[0], 4 * u.arcsec / u.pix)
+    assert u.allclose(result.reference_coordinate.Tx, 10 * u.arcsec)
+
+
+def test_image_is_unchanged():
+    image = Image(np.zeros((4, 4)), scale=(3., 3.))
+    assert as_image(image) is image
@@ -0,0 +1,268 @@
+"""
+Jitter is a module to simulate the effect of spacecraft pointing jitter and
+aspect drift on FOXSI observations
+
+The aspect is given as a time series of pointing offsets from the target.
+Following the convention of the IDL psf routines, pitch is the offset along
+the x axis and yaw the offset along the y axis.
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+from astropy.convolution import CustomKernel
+from scipy.signal import fftconvolve
+
+import pyfoxsi
+from pyfoxsi.psf import psf, get_dtype
+from pyfoxsi.profiling import stage
+from pyfoxsi.image import as_image
+
+__all__ = ['plate_scale', 'to_angle', 'interpolate_aspect', 'jitter_kernel',
+           'jitter_psf', 'jitter_convolve', 'apply_aspect', 'remove_aspect']
+
+plate_scale = (1 * u.rad / pyfoxsi.dsi_focal_length).to(u.arcsec / u.mm)
+
+
+def _seconds(t):
+    if isinstance(t, u.Quantity):
+        return t.to_value(u.s)
+    return np.asarray(t, dtype=float)
+
+
+def to_angle(offset):
+    """Convert an offset in the DSI focal plane to an angle on the sky.
+
+    Parameters
+    ----------
+    offset : `~astropy.units.Quantity`
+        An offset as an angle, which is returned unchanged, or as a length on
+        the detector, which is converted with the DSI focal length.
+
+    Returns
+    -------
+    angle : `~astropy.units.Quantity` <arcsec>
+    """
+    if offset.unit.physical_type == 'length':
+        return (offset * plate_scale).to(u.arcsec)
+    return offset.to(u.arcsec)
+
+
+def interpolate_aspect(time, aspect_time, pitch, yaw):
+    """Return the pointing offset at arbitrary times.
+
+    The aspect is linearly interpolated with a single vectorized
+    `~numpy.searchsorted` lookup and held at its first and last values
+    outside of the time series.
+
+    Parameters
+    ----------
+    time : array_like or `~astropy.units.Quantity`
+        The times at which to evaluate the aspect (s).
+    aspect_time : array_like or `~astropy.units.Quantity`
+        The increasing times of the aspect samples (s).
+    pitch : `~astropy.units.Quantity`
+        The x offset of each aspect sample (angle or focal plane length).
+    yaw : `~astropy.units.Quantity`
+        The y offset of each aspect sample (angle or focal plane length).
+
+    Returns
+    -------
+    pitch, yaw : `~astropy.units.Quantity` <arcsec>
+        The offsets at each time.
+    """
+    t = _seconds(time)
+    at = _seconds(aspect_time)
+    pitch = to_angle(pitch).value
+    yaw = to_angle(yaw).value
+    if len(at) == 1:
+        return (np.full(t.shape, pitch[0]) * u.arcsec,
+                np.full(t.shape, yaw[0]) * u.arcsec)
+    i = np.clip(np.searchsorted(at, t, side='right') - 1, 0, len(at) - 2)
+    frac = np.clip((t - at[i]) / (at[i + 1] - at[i]), 0., 1.)
+    return ((pitch[i] + frac * (pitch[i + 1] - pitch[i])) * u.arcsec,
+            (yaw[i] + frac * (yaw[i + 1] - yaw[i])) * u.arcsec)
+
+
+def jitter_kernel(aspect_time, pitch, yaw, scale=1 * u.arcsec / u.pix,
+                  start=None, end=None, relative=True):
+    """The time weighted distribution of pointing offsets as a kernel.
+
+    Each aspect sample is weighted by the time until the next sample and
+    deposited onto the pixel grid with bilinear (cloud in cell) weights using
+    a single `~numpy.bincount`, so hour long 100 Hz series need no Python
+    loop. As in `apply_aspect`, a pointing offset moves the image by minus
+    the offset, so the weight of each sample is deposited at minus its
+    offset.
+
+    Parameters
+    ----------
+    aspect_time : array_like or `~astropy.units.Quantity`
+        The increasing times of the aspect samples (s).
+    pitch : `~astropy.units.Quantity`
+        The x offset of each sample (angle or focal plane length).
+    yaw : `~astropy.units.Quantity`
+        The y offset of each sample (angle or focal plane length).
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel) of the map to be blurred.
+    start, end : float or `~astropy.units.Quantity`
+        Only use the aspect between these times (s), e.g. an integration.
+    relative : bool
+        If True, offsets are taken relative to the mean pointing so that the
+        kernel only blurs. If False, the mean drift also shifts the image.
+
+    Returns
+    -------
+    kernel : `~astropy.convolution.CustomKernel`
+        A normalized kernel with odd dimensions centred on zero offset.
+    """
+    at = _seconds(aspect_time)
+    x = to_angle(pitch).value
+    y = to_angle(yaw).value
+    pixel = scale.to_value(u.arcsec / u.pix)
+
+    with stage('jitter.kernel') as s:
+        dt = np.empty_like(at)
+        dt[:-1] = np.diff(at)
+        dt[-1] = np.median(dt[:-1]) if len(at) > 1 else 1.
+        keep = np.ones(len(at), dtype=bool)
+        if start is not None:
+            keep &= at >= _seconds(start)
+        if end is not None:
+            keep &= at < _seconds(end)
+        if not np.any(keep):
+            raise ValueError('There are no aspect samples between start and end')
+        # the image moves opposite to the pointing
+        x, y, dt = -x[keep] / pixel, -y[keep] / pixel, dt[keep]
+        if relative:
+            x = x - np.average(x, weights=dt)
+            y = y - np.average(y, weights=dt)
+
+        half = int(np.ceil(max(np.abs(x).max(), np.abs(y).max()))) + 1
+        size = 2 * half + 1
+        # bilinear deposition onto the pixel grid
+        x0 = np.floor(x)
+        y0 = np.floor(y)
+        fx = x - x0
+        fy = y - y0
+        ix = x0.astype(int) + half
+        iy = y0.astype(int) + half
+        index = np.concatenate([iy * size + ix, iy * size + ix + 1,
+                                (iy + 1) * size + ix, (iy + 1) * size + ix + 1])
+        weight = np.concatenate([(1 - fx) * (1 - fy), fx * (1 - fy),
+                                 (1 - fx) * fy, fx * fy]) * np.tile(dt, 4)
+        array = np.bincount(index, weights=weight,
+                            minlength=size * size).reshape(size, size)
+        array /= array.sum()
+        s.add_array(array)
+    return CustomKernel(array)
+
+
+def jitter_psf(aspect_time, pitch, yaw, scale=1 * u.arcsec / u.pix,
+               oversample=1, x=0 * u.arcmin, y=0 * u.arcmin, **kwargs):
+    """The effective psf of an observation blurred by pointing jitter.
+
+    Parameters
+    ----------
+    aspect_time, pitch, yaw
+        The aspect time series, see `jitter_kernel`.
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel).
+    oversample : int
+        The psf oversampling factor.
+    x, y : `~astropy.units.Quantity`
+        The position of the source from the optical axis.
+    kwargs
+        Passed to `jitter_kernel`.
+
+    Returns
+    -------
+    kernel : `~astropy.convolution.CustomKernel`
+        The normalized psf convolved with the jitter kernel.
+    """
+    jitter = jitter_kernel(aspect_time, pitch, yaw, scale=scale, **kwargs)
+    this_psf = psf(x, y, scale=scale, oversample=oversample)
+    with stage('jitter.psf') as s:
+        array = fftconvolve(this_psf.array, jitter.array, mode='full')
+        array = np.clip(array, 0., None)
+        array /= array.sum()
+        s.add_array(array)
+    return CustomKernel(array)
+
+
+def jitter_convolve(sunpy_map, aspect_time, pitch, yaw, oversample_psf=1,
+                    precision=None, **kwargs):
+    """Convolve an input map with the FOXSI psf blurred by pointing jitter.
+
+    Parameters
+    ----------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        An input map.
+    aspect_time, pitch, yaw
+        The aspect time series, see `jitter_kernel`.
+    oversample_psf : int
+        The psf oversampling factor.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+    kwargs
+        Passed to `jitter_kernel`.
+
+    Returns
+    -------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        The map convolved with the jittered FOXSI psf, of the type of the
+        input.
+    """
+    image = as_image(sunpy_map)
+    kernel = jitter_psf(aspect_time, pitch, yaw, scale=image.pixel_scale,
+                        oversample=oversample_psf, **kwargs)
+    dtype = get_dtype(precision)
+    with stage('jitter.convolve') as s:
+        smoothed_data = fftconvolve(np.asarray(image.data, dtype=dtype),
+                                    kernel.array.astype(dtype), mode='same')
+        s.add_array(smoothed_data)
+    result = image.with_data(smoothed_data, telescop=pyfoxsi.mission_title)
+    return result.like(sunpy_map)
+
+
+def apply_aspect(event_time, x, y, aspect_time, pitch, yaw):
+    """Move events from the sky into the instrument frame.
+
+    A source at sky position (x, y) appears offset by minus the pointing
+    offset at the arrival time of each event.
+
+    Parameters
+    ----------
+    event_time : array_like or `~astropy.units.Quantity`
+        The arrival time of each event (s).
+    x, y : `~astropy.units.Quantity`
+        The position of each event (angle or focal plane length).
+    aspect_time, pitch, yaw
+        The aspect time series, see `interpolate_aspect`.
+
+    Returns
+    -------
+    x, y : `~astropy.units.Quantity`
+        The shifted positions, in the units of the input positions.
+    """
+    return _shift_events(event_time, x, y, aspect_time, pitch, yaw, -1)
+
+
+def remove_aspect(event_time, x, y, aspect_time, pitch, yaw):
+    """Move events from the instrument frame back onto the sky.
+
+    This is the aspect correction, the inverse of `apply_aspect`.
+    """
+    return _shift_events(event_time, x, y, aspect_time, pitch, yaw, 1)
+
+
+def _shift_events(event_time, x, y, aspect_time, pitch, yaw, sign):
+    with stage('jitter.shift_events') as s:
+        dx, dy = interpolate_aspect(event_time, aspect_time, pitch, yaw)
+        if x.unit.physical_type == 'length':
+            dx = (dx / plate_scale).to(x.unit)
+            dy = (dy / plate_scale).to(y.unit)
+        result = (x + sign * dx, y + sign * dy)
+        s.add_array(result[0])
+    return result
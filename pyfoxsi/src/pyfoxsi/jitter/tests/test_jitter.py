@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from scipy.signal import fftconvolve
+
+from pyfoxsi.jitter import jitter_kernel, apply_aspect
+
+
+@pytest.mark.parametrize('pitch, yaw', [(10, 0), (0, -7), (4, 6)])
+def test_kernel_agrees_with_apply_aspect(pitch, yaw):
+    # a constant pointing offset, in pixels of 1 arcsec
+    aspect_time = np.arange(10.) * u.s
+    pitch = np.full(10, pitch) * u.arcsec
+    yaw = np.full(10, yaw) * u.arcsec
+    kernel = jitter_kernel(aspect_time, pitch, yaw, relative=False)
+
+    image = np.zeros((41, 41))
+    image[20, 20] = 1.
+    blurred = fftconvolve(image, kernel.array, mode='same')
+    y, x = np.unravel_index(np.argmax(blurred), blurred.shape)
+
+    event_x, event_y = apply_aspect([5.] * u.s, [0.] * u.arcsec, [0.] * u.arcsec,
+                                    aspect_time, pitch, yaw)
+    assert x - 20 == pytest.approx(event_x.to_value(u.arcsec)[0])
+    assert y - 20 == pytest.approx(event_y.to_value(u.arcsec)[0])
+
+
+def test_empty_window():
+    aspect_time = np.arange(10.) * u.s
+    offset = np.zeros(10) * u.arcsec
+    with pytest.raises(ValueError, match='no aspect samples'):
+        jitter_kernel(aspect_time, offset, offset, start=20 * u.s, end=30 * u.s)
@@ -0,0 +1,329 @@
+"""
+Profiling is a module to instrument the stages of the FOXSI simulation pipeline
+
+Instrumentation is off by default. When it is off every instrumented stage
+reduces to a single flag check so that the cost to the pipeline is negligible.
+
+Examples
+--------
+>>> import astropy.units as u
+>>> from pyfoxsi import profiling
+>>> from pyfoxsi.psf import psf
+>>> with profiling.profile() as report:
+...     p = psf(0 * u.arcmin, 0 * u.arcmin)
+>>> print(report)  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+import time
+import logging
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+__all__ = ['enable', 'disable', 'is_enabled', 'profile', 'stage', 'timed',
+           'get_report', 'StageStats', 'ProfileReport']
+
+log = logging.getLogger(__name__)
+
+_enabled = False
+_trace_memory = False
+# whether tracemalloc was started by this module rather than by the user
+_started_tracing = False
+_report = None
+_local = threading.local()
+
+
+class StageStats(object):
+    """The accumulated statistics of one instrumented pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, e.g. 'psf.kernel'.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.
+        self.max_wall_time = 0.
+        self.nbytes = 0
+        self.max_shape = None
+        self.peak_memory = 0
+
+    @property
+    def mean_wall_time(self):
+        """The mean wall time per call in seconds"""
+        if self.calls == 0:
+            return 0.
+        return self.wall_time / self.calls
+
+    def to_dict(self):
+        """Return the statistics as a dictionary"""
+        return {'name': self.name, 'calls': self.calls,
+                'wall_time': self.wall_time,
+                'mean_wall_time': self.mean_wall_time,
+                'max_wall_time': self.max_wall_time,
+                'nbytes': self.nbytes, 'max_shape': self.max_shape,
+                'peak_memory': self.peak_memory}
+
+    def __repr__(self):
+        return '<StageStats {0}: {1} calls, {2:.6f} s>'.format(self.name,
+                                                                self.calls,
+                                                                self.wall_time)
+
+
+class ProfileReport(object):
+    """A structured report of the time and memory spent in each pipeline stage.
+
+    Stages appear in the order in which they were first entered.
+    """
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, wall_time, nbytes=0, shape=None, peak_memory=0):
+        """Add one call of a stage to the report."""
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = StageStats(name)
+                self.stages[name] = stats
+            stats.calls += 1
+            stats.wall_time += wall_time
+            stats.max_wall_time = max(stats.max_wall_time, wall_time)
+            stats.nbytes += nbytes
+            if shape is not None:
+                if stats.max_shape is None or _size(shape) > _size(stats.max_shape):
+                    stats.max_shape = shape
+            stats.peak_memory = max(stats.peak_memory, peak_memory)
+
+    @property
+    def total_time(self):
+        """The summed wall time of all stages in seconds.
+
+        Nested stages are counted in both the inner and the outer stage.
+        """
+        return sum([s.wall_time for s in self.stages.values()])
+
+    def to_dict(self):
+        """Return the report as a dictionary of dictionaries keyed by stage"""
+        return dict([(name, s.to_dict()) for name, s in self.stages.items()])
+
+    def reset(self):
+        """Forget all recorded stages."""
+        with self._lock:
+            self.stages = {}
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __contains__(self, name):
+        return name in self.stages
+
+    def __str__(self):
+        lines = ['{0:<32} {1:>7} {2:>12} {3:>12} {4:>12} {5:>12}'.format(
+            'stage', 'calls', 'time [s]', 'mean [s]', 'size [B]', 'peak [B]')]
+        for s in self.stages.values():
+            lines.append('{0:<32} {1:>7d} {2:>12.6f} {3:>12.6f} {4:>12d} {5:>12d}'.format(
+                s.name, s.calls, s.wall_time, s.mean_wall_time, s.nbytes,
+                s.peak_memory))
+        return '\n'.join(lines)
+
+
+def _size(shape):
+    result = 1
+    for n in shape:
+        result *= n
+    return result
+
+
+class _NullStage(object):
+    """Stand-in returned by `stage` when instrumentation is disabled."""
+    def add_array(self, array):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    """A single timed entry into a pipeline stage."""
+    def __init__(self, name, report, trace_memory):
+        self.name = name
+        self.report = report
+        self.trace_memory = trace_memory
+        self.nbytes = 0
+        self.shape = None
+        self.peak = 0
+
+    def add_array(self, array):
+        """Record the size of an array produced or consumed by this stage.
+
+        Objects wrapping an array such as kernels (``.array``) or maps
+        (``.data``) are unwrapped.
+        """
+        for attr in ('array', 'data'):
+            if not hasattr(array, 'nbytes') and hasattr(array, attr):
+                array = getattr(array, attr)
+        if hasattr(array, 'nbytes'):
+            self.nbytes += array.nbytes
+            shape = getattr(array, 'shape', None)
+            if shape is not None and (self.shape is None or
+                                      _size(shape) > _size(self.shape)):
+                self.shape = tuple(shape)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = []
+            _local.stack = stack
+        if self.trace_memory and stack:
+            # keep the running peak of the enclosing stage before resetting it
+            stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        stack.append(self)
+        if self.trace_memory:
+            self._start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        peak_memory = 0
+        peak = self.peak
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.peak)
+            peak_memory = max(peak - self._start_memory, 0)
+        stack = _local.stack
+        stack.pop()
+        if stack and self.trace_memory:
+            # the peak counter was reset on entry so hand our peak outwards
+            stack[-1].peak = max(stack[-1].peak, peak)
+        self.report.record(self.name, elapsed, nbytes=self.nbytes,
+                           shape=self.shape, peak_memory=peak_memory)
+        log.debug('stage %s took %.6f s', self.name, elapsed,
+                  extra={'stage': self.name, 'wall_time': elapsed,
+                         'nbytes': self.nbytes, 'shape': self.shape,
+                         'peak_memory': peak_memory})
+        return False
+
+
+def enable(trace_memory=True, report=None):
+    """Turn on instrumentation of the simulation pipeline.
+
+    Parameters
+    ----------
+    trace_memory : bool
+        If True, track the peak allocation of each stage with `tracemalloc`.
+        This slows down allocation heavy code noticeably.
+    report : `ProfileReport`
+        The report to record into. A new one is created if not given.
+
+    Returns
+    -------
+    report : `ProfileReport`
+        The report into which stages are recorded.
+    """
+    global _enabled, _trace_memory, _report, _started_tracing
+    if report is None:
+        report = ProfileReport()
+    _report = report
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    _enabled = True
+    return report
+
+
+def disable():
+    """Turn off instrumentation and return the report that was recorded.
+
+    Memory tracing is only stopped if it was started by `enable`.
+    """
+    global _enabled, _trace_memory, _report, _started_tracing
+    report = _report
+    if _started_tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _started_tracing = False
+    _enabled = False
+    _trace_memory = False
+    _report = None
+    return report
+
+
+def is_enabled():
+    """Return True if instrumentation is turned on."""
+    return _enabled
+
+
+def get_report():
+    """Return the active `ProfileReport` or None if instrumentation is off."""
+    return _report
+
+
+@contextmanager
+def profile(trace_memory=True):
+    """Instrument the pipeline for the duration of a with block.
+
+    Yields
+    ------
+    report : `ProfileReport`
+        The report, filled in as the block runs.
+    """
+    global _enabled, _trace_memory, _report, _started_tracing
+    previous = (_enabled, _trace_memory, _report, _started_tracing)
+    was_tracing = tracemalloc.is_tracing()
+    report = enable(trace_memory=trace_memory)
+    try:
+        yield report
+    finally:
+        if trace_memory and not was_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _enabled, _trace_memory, _report, _started_tracing = previous
+
+
+def stage(name):
+    """Return a context manager which times a stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage. By convention this is prefixed by the module,
+        e.g. 'psf.kernel'.
+
+    Examples
+    --------
+    >>> with stage('psf.kernel') as s:
+    ...     kernel = np.ones((11, 11))
+    ...     s.add_array(kernel)  # doctest: +SKIP
+    """
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, _report, _trace_memory)
+
+
+def timed(name):
+    """Decorator which records every call of a function as a pipeline stage.
+
+    The returned value is recorded as the array size of the stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name, _report, _trace_memory) as s:
+                result = func(*args, **kwargs)
+                s.add_array(result)
+            return result
+        return wrapper
+    return decorator
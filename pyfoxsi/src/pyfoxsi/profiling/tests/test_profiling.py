@@ -0,0 +1,42 @@
+import tracemalloc
+
+import numpy as np
+
+from pyfoxsi import profiling
+from pyfoxsi.profiling import stage
+
+
+def test_outer_stage_keeps_peak_before_inner_stage():
+    with profiling.profile() as report:
+        with stage('outer'):
+            big = np.ones(10 * 1024 * 1024)
+            del big
+            with stage('inner'):
+                small = np.ones(10)
+    assert report['outer'].peak_memory >= 80 * 1024 * 1024
+    assert report['inner'].peak_memory < 1024 * 1024
+
+
+def test_outer_stage_includes_inner_peak():
+    with profiling.profile() as report:
+        with stage('outer'):
+            with stage('inner'):
+                big = np.ones(10 * 1024 * 1024)
+                del big
+    assert report['outer'].peak_memory >= 80 * 1024 * 1024
+
+
+def test_disable_leaves_user_tracing_on():
+    tracemalloc.start()
+    try:
+        profiling.enable()
+        profiling.disable()
+        assert tracemalloc.is_tracing()
+        with profiling.profile():
+            pass
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    profiling.enable()
+    profiling.disable()
+    assert not tracemalloc.is_tracing()
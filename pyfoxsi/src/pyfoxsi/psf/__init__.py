@@ -4,3 +4,4 @@ __author__ = "Steven D. Christe"
 __email__ = "steven.christe@nasa.gov"
 
 from pyfoxsi.psf.psf import *
+from pyfoxsi.psf.tiling import *
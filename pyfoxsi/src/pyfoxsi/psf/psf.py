@@ -8,13 +8,54 @@ import pyfoxsi
 import numpy as np
 import sunpy.map
 import astropy.units as u
-from astropy.convolution import Gaussian2DKernel
+from astropy.convolution import Gaussian2DKernel, CustomKernel
 from astropy.convolution import convolve as astropy_convolve
 from sunpy.map import Map
+from pyfoxsi.profiling import stage
+from pyfoxsi.cache import get_cache
+from pyfoxsi.image import as_image
+from pyfoxsi.telescope import Optic
 
-__all__ = ['psf', 'convolve']
+__all__ = ['get_dtype', 'psf', 'psf_width_scale', 'psf_components', 'psf_otf',
+           'otf_convolve', 'pixel_integrated_gaussian', 'separable_convolve',
+           'convolve', 'energy_groups', 'convolve_cube']
 
-def gauss2d((x,y), amplitude, xo, yo, sigma_x, sigma_y, theta) :
+_precisions = {'single': np.float32, 'double': np.float64,
+               'float32': np.float32, 'float64': np.float64}
+
+# psf_components by position, which are reused by every convolution
+_components = {}
+_on_axis = 0 * u.arcmin
+# the optic whose shells set the energy dependence of the psf, loaded once
+_optic = None
+
+
+def get_dtype(precision=None):
+    """Return the floating point type of a precision setting.
+
+    Single precision halves the memory and much of the FFT cost of the
+    imaging pipeline. Totals such as normalizations and rebinned sums are
+    still accumulated in double precision to conserve flux.
+
+    Parameters
+    ----------
+    precision : str
+        'single' (float32) or 'double' (float64). Defaults to the global
+        setting `pyfoxsi.precision`.
+
+    Returns
+    -------
+    dtype : `~numpy.dtype`
+    """
+    if precision is None:
+        precision = pyfoxsi.precision
+    try:
+        return np.dtype(_precisions[precision])
+    except KeyError:
+        raise ValueError('Not a valid precision. Must be single or double')
+
+
+def gauss2d(xy, amplitude, xo, yo, sigma_x, sigma_y, theta, precision=None):
     r"""A two-dimensional eliptical Gaussian function of the form
 
     amplitude * np.exp( - (((x-xo)**2) / sigma**2))
@@ -23,8 +64,8 @@ def gauss2d((x,y), amplitude, xo, yo, sigma_x, sigma_y, theta) :
 
     Parameters
     ----------
-    (x,y) : array_like
-        Array_like means all those objects -- lists, nested lists, etc. --
+    xy : tuple of array_like
+        The (x, y) coordinates. Array_like means all those objects -- lists, nested lists, etc. --
         that can be converted to an array.  We can also refer to
         variables like `var1`.
     amplitude : float
@@ -39,6 +80,8 @@ def gauss2d((x,y), amplitude, xo, yo, sigma_x, sigma_y, theta) :
         The width in the unrotated y-direction.
     theta : float (radian)
         The rotation angle.
+    precision : str
+        'single' or 'double', see `get_dtype`.
 
     Returns
     -------
@@ -52,13 +95,18 @@ def gauss2d((x,y), amplitude, xo, yo, sigma_x, sigma_y, theta) :
     >>> x, y = np.meshgrid(np.arange(-10,10,1), np.arange(-10,10,1))
     >>> data = gauss2d((x, y), 1, 0, 0, 1, 5, np.pi/4.)
     """
+    dtype = get_dtype(precision)
+    x, y = xy
+    x = np.asarray(x, dtype=dtype) - dtype.type(xo)
+    y = np.asarray(y, dtype=dtype) - dtype.type(yo)
 
     a = (np.cos(theta)**2)/(2*sigma_x**2) + (np.sin(theta)**2)/(2*sigma_y**2)
     b = -(np.sin(2*theta))/(4*sigma_x**2) + (np.sin(2*theta))/(4*sigma_y**2)
     c = (np.sin(theta)**2)/(2*sigma_x**2) + (np.cos(theta)**2)/(2*sigma_y**2)
-    return amplitude*np.exp( - (a*((x-xo)**2) + 2*b*(x-xo)*(y-yo) + c*((y-yo)**2)))
+    a, b, c = dtype.type(a), dtype.type(b), dtype.type(c)
+    return dtype.type(amplitude)*np.exp( - (a*(x**2) + 2*b*x*y + c*(y**2)))
 
-def multi_gauss2d((x,y), amplitude, center, sigma_x, sigma_y, theta):
+def multi_gauss2d(xy, amplitude, center, sigma_x, sigma_y, theta, precision=None):
     r"""A sum of multiple two-dimensional eliptical Gaussian function of the form
 
     amplitude * np.exp( - (((x-xo)**2) / sigma**2))
@@ -70,8 +118,8 @@ def multi_gauss2d((x,y), amplitude, center, sigma_x, sigma_y, theta):
 
     Parameters
     ----------
-    (x,y) : array_like
-        Array_like means all those objects -- lists, nested lists, etc. --
+    xy : tuple of array_like
+        The (x, y) coordinates. Array_like means all those objects -- lists, nested lists, etc. --
         that can be converted to an array.  We can also refer to
         variables like `var1`.
     amplitude : array_like
@@ -86,6 +134,8 @@ def multi_gauss2d((x,y), amplitude, center, sigma_x, sigma_y, theta):
         The width in the unrotated y-direction.
     theta : float (radian)
         The rotation angle for each gaussian.
+    precision : str
+        'single' or 'double', see `get_dtype`.
 
     See Also
     --------
@@ -101,11 +151,13 @@ def multi_gauss2d((x,y), amplitude, center, sigma_x, sigma_y, theta):
     These are written in doctest format, and should illustrate how to
     use the function.
     >>> x, y = np.meshgrid(np.arange(-10,10,1), np.arange(-10,10,1))
-    >>> data = multi_gauss2d((x, y), (100,10,1), 0, 0, (1,2,3), (5,6,7), np.pi/4.)
+    >>> data = multi_gauss2d((x, y), (100,10,1), (0, 0), (1,2,3), (5,6,7), np.pi/4.)
     """
+    x, y = xy
     i = 0
     for amp, sig_x, sig_y in zip(amplitude, sigma_x, sigma_y):
-        g = gauss2d((x, y), amp, center[0], center[1], sig_x, sig_y, theta)
+        g = gauss2d((x, y), amp, center[0], center[1], sig_x, sig_y, theta,
+                    precision=precision)
         if i == 0:
             result = g
         else:
@@ -113,7 +165,347 @@ def multi_gauss2d((x,y), amplitude, center, sigma_x, sigma_y, theta):
         i += 1
     return result
 
-def psf(x, y, scale=1 * u.arcsec / u.pix, oversample=1, size=None):
+def _data_file(filename):
+    path = os.path.dirname(pyfoxsi.__file__)
+    for i in np.arange(3):
+        path = os.path.dirname(path)
+    path = os.path.join(path, 'data/')
+    return os.path.join(path, filename)
+
+
+def psf_width_scale(energy):
+    r"""The broadening of the psf with energy.
+
+    The psf parameters are fitted to the psf of the whole module at low
+    energy, where all of the shells reflect. With increasing energy the outer
+    shells stop reflecting first (see
+    `~pyfoxsi.telescope.Optic.shell_effective_area`) and the psf is that of
+    the inner shells. The width of each shell is taken to scale as
+    :math:`r^k` with its radius, with k set by `pyfoxsi.psf_shell_width_index`,
+    and the psf widths are scaled by the ratio of the rms shell width,
+    weighted by the effective area of the shells, to its low energy value.
+
+    Parameters
+    ----------
+    energy : `~astropy.units.Quantity`
+        The photon energies.
+
+    Returns
+    -------
+    scale : `~numpy.ndarray`
+        The factor by which the widths of the psf components are multiplied
+        at each energy.
+    """
+    global _optic
+    if _optic is None:
+        _optic = Optic()
+    radius = _optic.radius.value
+    width2 = (radius / radius.max()) ** (2 * pyfoxsi.psf_shell_width_index)
+    area = np.atleast_2d(_optic.shell_effective_area(energy).value)
+    # above the highest critical energy only the innermost shell is left
+    area[area.sum(axis=-1) <= 0] = radius == radius.min()
+    geometric_area = _optic.geometric_area.value
+    reference = np.average(width2, weights=geometric_area)
+    result = np.sqrt(np.dot(area, width2) / area.sum(axis=-1) / reference)
+    return result.reshape(np.shape(energy))
+
+
+def _single_energy(energy):
+    """Reduce an energy given as a scalar or an array of one element to a scalar."""
+    if energy is None:
+        return None
+    if energy.size != 1:
+        raise ValueError('The psf takes a single energy, see energy_groups')
+    return energy.reshape(())
+
+
+def psf_components(x, y, wings=False, energy=None):
+    r"""The components of the psf model at a position in the field of view.
+
+    The core of the psf is a sum of three elliptical Gaussians. If wings is
+    set, the fit of `psf_parameters_with_wings.txt` is used, which adds a
+    fourth, wide component for the wings. The fitted wing is a 2-D Lorentzian
+    which falls off as r^-2 and so has no finite integral. It is therefore
+    represented here by the bivariate Cauchy profile with the same peak and
+    half width
+
+    .. math:: A (1 + (x / \gamma_x)^2 + (y / \gamma_y)^2)^{-3/2}
+
+    which is normalizable and has a closed form Fourier transform. Its half
+    width at half maximum is :math:`\gamma \sqrt{2^{2/3} - 1}`, and
+    :math:`\gamma` is chosen so that this equals the half width of the
+    fitted Lorentzian. The IDL model also multiplies the Lorentzian by
+    :math:`1 - \exp(-r^2 / (2 \cdot 10^2))` (r in arcsec), which removes it
+    within about 10 arcsec of the centre where the Gaussians dominate. That
+    cutoff is not included here, so the wing adds some flux to the core.
+
+    Parameters
+    ----------
+    x : `~astropy.units.Quantity` <deg>
+        The angle of the source from the optical axis in the horizontal direction.
+    y : `~astropy.units.Quantity` <deg>
+        The angle of the source from the optical axis in the vertical direction.
+    wings : bool
+        If True, include the Lorentzian wing component.
+    energy : `~astropy.units.Quantity`
+        A single photon energy, as a scalar or an array of one element. If
+        given, all widths are scaled by `psf_width_scale`. Use
+        `energy_groups` to find the energies at which the psf of many
+        energies needs to be built.
+
+    Returns
+    -------
+    components : dict
+        'weight' the integrated flux fraction of each Gaussian, 'sigma_x' and
+        'sigma_y' their widths in arcsec, 'theta' their rotation angle in
+        radians and, if wings is set, 'wing_weight', 'wing_gamma_x' and
+        'wing_gamma_y' (arcsec) describing the wing. The weights sum to one.
+        The components are remembered for each position and must not be
+        modified.
+    """
+    energy = _single_energy(energy)
+    key = (x.to_value(u.arcmin), y.to_value(u.arcmin), wings,
+           None if energy is None else energy.to_value(u.keV))
+    result = _components.get(key)
+    if result is not None:
+        return result
+    offaxis_angle = np.sqrt(y ** 2 + x ** 2)
+    polar_angle = np.arctan2(y, x).to_value(u.rad)
+    if wings:
+        params = np.loadtxt(_data_file('psf_parameters_with_wings.txt'))
+        amplitude = params[0:3]
+        sigma_x = params[[6, 8, 10]]
+        sigma_y = params[[7, 9, 11]]
+        # the IDL model is amp / pi / (2 + (x / w_x)^2 + (y / w_y)^2)
+        # which has a peak of amp / (2 pi) and a half width of sqrt(2) w,
+        # matched by the Cauchy profile with gamma = sqrt(2) w / sqrt(2^(2/3) - 1)
+        wing_peak = params[3] / (2 * np.pi)
+        hwhm_factor = np.sqrt(2) / np.sqrt(2 ** (2. / 3) - 1)
+        wing_gamma_x = hwhm_factor * params[12]
+        wing_gamma_y = hwhm_factor * params[13]
+        wing_flux = 2 * np.pi * wing_peak * wing_gamma_x * wing_gamma_y
+    else:
+        params = np.loadtxt(_data_file('psf_parameters.txt'))
+        poly_params = [np.poly1d(g)(offaxis_angle.to_value(u.arcmin)) for g in params]
+        amplitude = np.array(poly_params[0:3])
+        sigma_x = np.array(poly_params[3:6])
+        sigma_y = np.array(poly_params[6:9])
+        wing_flux = 0.
+    flux = 2 * np.pi * amplitude * sigma_x * sigma_y
+    total = flux.sum() + wing_flux
+    if energy is not None:
+        # broadening leaves the flux of each component unchanged
+        width_scale = psf_width_scale(energy)
+        sigma_x = sigma_x * width_scale
+        sigma_y = sigma_y * width_scale
+        if wings:
+            wing_gamma_x = wing_gamma_x * width_scale
+            wing_gamma_y = wing_gamma_y * width_scale
+    result = {'weight': flux / total, 'sigma_x': sigma_x, 'sigma_y': sigma_y,
+              'theta': polar_angle}
+    if wings:
+        result.update({'wing_weight': wing_flux / total,
+                       'wing_gamma_x': wing_gamma_x,
+                       'wing_gamma_y': wing_gamma_y})
+    _components[key] = result
+    return result
+
+
+def psf_otf(shape, x=0 * u.arcmin, y=0 * u.arcmin, scale=1 * u.arcsec / u.pix,
+            wings=True, energy=None, precision=None):
+    r"""The optical transfer function (the Fourier transform of the psf).
+
+    The transfer function is evaluated in closed form from the model
+    components so no spatial kernel is built, however wide the wings. The
+    psf is integrated over the pixel area by the sinc of the pixel box.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The (ny, nx) shape of the (padded) array to which it will be applied.
+    x : `~astropy.units.Quantity` <deg>
+        The horizontal position of the source from the optical axis.
+    y : `~astropy.units.Quantity` <deg>
+        The vertical position of the source from the optical axis.
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel).
+    wings : bool
+        If True, include the Lorentzian wing component.
+    energy : `~astropy.units.Quantity`
+        A single photon energy, see `psf_components`. If not given the psf
+        of the whole module is used.
+    precision : str
+        'single' or 'double', see `get_dtype`. The transfer function is
+        evaluated in double precision and then converted.
+
+    Returns
+    -------
+    otf : `~numpy.ndarray`
+        The transfer function on the grid of `numpy.fft.rfft2` for an array
+        of the given shape, with otf[0, 0] equal to 1.
+    """
+    ny, nx = shape
+    pixel = scale.to_value(u.arcsec / u.pix)
+    comp = psf_components(x, y, wings=wings, energy=energy)
+    # spatial frequencies in cycles per pixel
+    fy = np.fft.fftfreq(ny)[:, np.newaxis]
+    fx = np.fft.rfftfreq(nx)[np.newaxis, :]
+    fx2, fy2, fxy = fx ** 2, fy ** 2, fx * fy
+
+    with stage('psf.otf') as s:
+        cos, sin = np.cos(comp['theta']), np.sin(comp['theta'])
+        otf = np.zeros((ny, nx // 2 + 1))
+        for w, sig_x, sig_y in zip(comp['weight'], comp['sigma_x'] / pixel,
+                                   comp['sigma_y'] / pixel):
+            # covariance of the rotated Gaussian as defined in gauss2d
+            var_xx = (sig_x * cos) ** 2 + (sig_y * sin) ** 2
+            var_yy = (sig_x * sin) ** 2 + (sig_y * cos) ** 2
+            var_xy = (sig_y ** 2 - sig_x ** 2) * sin * cos
+            otf += w * np.exp(-2 * np.pi ** 2 * (var_xx * fx2 + 2 * var_xy * fxy +
+                                                 var_yy * fy2))
+        if wings:
+            gamma_x = comp['wing_gamma_x'] / pixel
+            gamma_y = comp['wing_gamma_y'] / pixel
+            otf += comp['wing_weight'] * np.exp(-2 * np.pi * np.sqrt(
+                (gamma_x ** 2) * fx2 + (gamma_y ** 2) * fy2))
+        # integrate over the pixel
+        otf *= np.sinc(fx) * np.sinc(fy)
+        otf = otf.astype(get_dtype(precision), copy=False)
+        s.add_array(otf)
+    return otf
+
+
+def otf_convolve(data, otf, pad=None, precision=None):
+    """Convolve an array with a psf given by its transfer function.
+
+    The cost is one forward and one inverse real FFT of the (padded) array.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        The 2-D array to convolve.
+    otf : `~numpy.ndarray` or callable
+        The transfer function on the rfft2 grid of the padded array, or a
+        function which returns it given the padded shape (e.g.
+        ``lambda shape: psf_otf(shape, scale=scale)``).
+    pad : int or tuple of int
+        The number of zero pixels added after the data along (y, x) to stop
+        flux from wrapping around the edges. Defaults to half the array size.
+        Set to 0 for periodic boundaries.
+    precision : str
+        'single' or 'double', see `get_dtype`.
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        The convolved array, with the shape of data.
+    """
+    from scipy import fft
+    dtype = get_dtype(precision)
+    data = np.asarray(data, dtype=dtype)
+    ny, nx = data.shape
+    if pad is None:
+        pad = (ny // 2, nx // 2)
+    pad = np.broadcast_to(pad, 2)
+    shape = (fft.next_fast_len(int(ny + pad[0]), real=True),
+             fft.next_fast_len(int(nx + pad[1]), real=True))
+    if callable(otf):
+        otf = otf(shape)
+    otf = np.asarray(otf)
+    otf = otf.astype(dtype if otf.dtype.kind == 'f' else np.result_type(dtype, np.complex64),
+                     copy=False)
+    with stage('psf.otf_convolve') as s:
+        result = fft.irfft2(fft.rfft2(data, s=shape, workers=-1) * otf,
+                            s=shape, workers=-1)[:ny, :nx]
+        s.add_array(result)
+    return result
+
+
+def pixel_integrated_gaussian(sigma, half_size=None, truncate=4.0):
+    """A normalized 1-D Gaussian integrated exactly over each pixel.
+
+    Parameters
+    ----------
+    sigma : float
+        The width of the Gaussian in pixels.
+    half_size : int
+        The kernel has 2 * half_size + 1 pixels. Defaults to truncate * sigma.
+    truncate : float
+        The number of sigma covered by the kernel on each side if half_size
+        is not given.
+
+    Returns
+    -------
+    kernel : `~numpy.ndarray`
+        The fraction of the Gaussian falling in each pixel, normalized to sum
+        to one.
+    """
+    from scipy.special import erf
+    if half_size is None:
+        half_size = int(np.ceil(truncate * sigma))
+    edges = (np.arange(-half_size, half_size + 2) - 0.5) / (np.sqrt(2) * sigma)
+    kernel = 0.5 * np.diff(erf(edges))
+    return kernel / kernel.sum()
+
+
+def separable_convolve(data, weight, sigma_x, sigma_y, theta=0., truncate=4.0,
+                       precision=None):
+    """Convolve an array with a mixture of axis aligned Gaussians.
+
+    Each Gaussian is integrated exactly over the pixels (see
+    `pixel_integrated_gaussian`) and applied as two 1-D passes so the cost per
+    pixel is O(K) rather than the O(K^2) of a 2-D kernel of size K. The result
+    agrees with the accurately integrated 2-D kernel from
+    ``psf(oversample=40)`` to better than 1e-4 of the peak of the convolved
+    map for pixel scales from 0.5 to 3 arcsec. It is more accurate than the
+    kernel from ``psf(oversample=10)``, which is off by up to 1.2e-3 of the
+    peak at 3 arcsec.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        The 2-D array to convolve. Pixels outside of it are taken to be zero.
+    weight : array_like
+        The integrated flux of each Gaussian.
+    sigma_x : array_like
+        The widths in the x direction in pixels.
+    sigma_y : array_like
+        The widths in the y direction in pixels.
+    theta : float (radian)
+        The rotation angle. Only components which are circular can be rotated.
+    truncate : float
+        The kernels extend to truncate * sigma on each side.
+    precision : str
+        'single' or 'double', see `get_dtype`.
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        The convolved array.
+    """
+    from scipy.ndimage import convolve1d
+    weight = np.atleast_1d(weight)
+    sigma_x = np.atleast_1d(sigma_x)
+    sigma_y = np.atleast_1d(sigma_y)
+    if not np.isclose(np.sin(2 * theta), 0) and np.any(~np.isclose(sigma_x, sigma_y)):
+        raise ValueError('Rotated elliptical Gaussians are not separable')
+    if np.sin(theta) ** 2 > 0.5:
+        # rotated by close to 90 degrees so the axes swap
+        sigma_x, sigma_y = sigma_y, sigma_x
+    dtype = get_dtype(precision)
+    data = np.asarray(data, dtype=dtype)
+    result = np.zeros_like(data)
+    with stage('psf.separable_convolve') as s:
+        for w, sig_x, sig_y in zip(weight, sigma_x, sigma_y):
+            kx = pixel_integrated_gaussian(sig_x, truncate=truncate).astype(dtype)
+            ky = pixel_integrated_gaussian(sig_y, truncate=truncate).astype(dtype)
+            tmp = convolve1d(data, kx, axis=1, mode='constant', cval=0.)
+            result += dtype.type(w) * convolve1d(tmp, ky, axis=0, mode='constant', cval=0.)
+        s.add_array(result)
+    return result
+
+
+def psf(x, y, scale=1 * u.arcsec / u.pix, oversample=1, size=None, energy=None):
     r"""The point spread function.
 
     .. warning: implement the x and y keywords are not yet implemented.
@@ -129,6 +521,9 @@ def psf(x, y, scale=1 * u.arcsec / u.pix, oversample=1, size=None):
         with which it will be convolved.
     oversample : int
         The number of subpixels to average over to produce a more accurate PSF
+    energy : `~astropy.units.Quantity`
+        A single photon energy, see `psf_components`. If not given the psf
+        of the whole module is used.
 
     Returns
     -------
@@ -140,12 +535,24 @@ def psf(x, y, scale=1 * u.arcsec / u.pix, oversample=1, size=None):
     >>> p = psf(0 * u.arcmin, 0 * u.arcmin)
     >>> p = psf(0 * u.arcmin, 0 * u.arcmin, 2 * u.arcsec)
     """
+    energy = _single_energy(energy)
+    cache = get_cache()
+    if cache is not None:
+        if energy is None:
+            key = cache.make_key('psf', x, y, scale, oversample, size,
+                                 data_files=['psf_parameters.txt'])
+        else:
+            key = cache.make_key('psf', x, y, scale, oversample, size, energy,
+                                 pyfoxsi.shell_ids, pyfoxsi.psf_shell_width_index,
+                                 data_files=['psf_parameters.txt', 'shell_parameters.csv',
+                                             'effective_area_per_module.csv'])
+        array = cache.get(key)
+        if array is not None:
+            return CustomKernel(np.array(array))
+
     # load the PSF parameters
-    path = os.path.dirname(pyfoxsi.__file__)
-    for i in np.arange(3):
-        path = os.path.dirname(path)
-    path = os.path.join(path, 'data/')
-    params = np.loadtxt(os.path.join(path, 'psf_parameters.txt'))
+    with stage('psf.load_parameters'):
+        params = np.loadtxt(_data_file('psf_parameters.txt'))
 
     offaxis_angle = np.sqrt(y ** 2 + x ** 2)
     polar_angle = np.arctan2(y, x)
@@ -153,41 +560,228 @@ def psf(x, y, scale=1 * u.arcsec / u.pix, oversample=1, size=None):
     poly_params = []
     for g in params:
         f = np.poly1d(g)
-        poly_params.append(f(offaxis_angle))
+        poly_params.append(f(offaxis_angle.to_value(u.arcmin)))
 
     amplitude = (poly_params[0], poly_params[1], poly_params[2])
     width = u.Quantity([poly_params[3], poly_params[4], poly_params[5]], 'arcsec')
     width = width / scale
-    print(width)
+    if energy is not None:
+        width = width * psf_width_scale(energy)
     # add 90 deg to the polar angle to make the rotation angle perpendicular
     # to the polar angle
-    kernel = amplitude[0] * Gaussian2DKernel(width[0].value, mode='oversample', factor=oversample, x_size=size) * width[0].value ** 2 +\
-             amplitude[1] * Gaussian2DKernel(width[1].value, mode='oversample', factor=oversample, x_size=size) * width[1].value ** 2  +\
-             amplitude[2] * Gaussian2DKernel(width[2].value, mode='oversample', factor=oversample, x_size=size) * width[2].value ** 2
-    kernel.normalize()
+    with stage('psf.kernel') as s:
+        kernel = amplitude[0] * Gaussian2DKernel(width[0].value, mode='oversample', factor=oversample, x_size=size) * width[0].value ** 2 +\
+                 amplitude[1] * Gaussian2DKernel(width[1].value, mode='oversample', factor=oversample, x_size=size) * width[1].value ** 2  +\
+                 amplitude[2] * Gaussian2DKernel(width[2].value, mode='oversample', factor=oversample, x_size=size) * width[2].value ** 2
+        kernel.normalize()
+        s.add_array(kernel)
+    if cache is not None:
+        cache.set(key, kernel.array)
     return kernel
 
-def convolve(sunpy_map, oversample_psf=1):
+
+def convolve(sunpy_map, oversample_psf=1, kernel=None, wings=False,
+             method='kernel', energy=None, precision=None):
     """Convolve the FOXSI psf with an input map
 
     Parameters
     ----------
-    sunpy_map : `~sunpy.map.GenericMap`
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
         An input map.
     oversample_psf : int
         The number of subpixels to average over to produce a more accurate PSF
+    kernel : `~astropy.convolution.Kernel2D`
+        A precomputed psf kernel matching the map scale. If not given it is
+        built with `psf`.
+    wings : bool
+        If True, include the psf wings. The convolution is then done in
+        Fourier space with the transfer function from `psf_otf` and
+        oversample_psf and kernel are ignored.
+    method : str
+        'kernel' convolves with the 2-D kernel from `psf`. 'separable'
+        convolves with each exactly pixel integrated Gaussian of the psf as
+        1-D passes (see `separable_convolve`), which is much faster for wide
+        kernels and makes oversample_psf unnecessary.
+    energy : `~astropy.units.Quantity`
+        The photon energy of the map, see `psf_width_scale`. If not given
+        the psf of the whole module is used.
+    precision : str
+        'single' or 'double', see `get_dtype`. With 'kernel' the convolution
+        itself is always done in double precision by astropy.
 
     Returns
     -------
-    sunpy_map : `~sunpy.map.GenericMap`
-        The map convolved with the FOXSI psf.
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        The map convolved with the FOXSI psf, of the type of the input.
     """
 
-    this_psf = psf(0 * u.arcmin, 0 * u.arcmin, scale=sunpy_map.scale.x, oversample=oversample_psf)
+    if method not in ('kernel', 'separable'):
+        raise ValueError('Not a valid method. Must be kernel or separable')
+    image = as_image(sunpy_map)
+    scale = image.pixel_scale
+    dtype = get_dtype(precision)
+    if wings or method == 'separable':
+        this_psf = None
+    elif kernel is None:
+        this_psf = psf(0 * u.arcmin, 0 * u.arcmin, scale=scale, oversample=oversample_psf,
+                       energy=energy)
+    else:
+        this_psf = kernel
 
-    smoothed_data = astropy_convolve(sunpy_map.data, this_psf)
-    meta = sunpy_map.meta.copy()
-    meta['telescop'] = 'FOXSI-SMEX'
-    result = Map((smoothed_data, meta))
+    cache = get_cache()
+    if cache is not None:
+        # the energy dependence is only part of the key if it is used
+        shells = [] if energy is None else [energy, pyfoxsi.shell_ids,
+                                            pyfoxsi.psf_shell_width_index]
+        shell_files = [] if energy is None else ['shell_parameters.csv',
+                                                 'effective_area_per_module.csv']
+        if wings:
+            key = cache.make_key('convolve_wings', image.data, scale, dtype.str, *shells,
+                                 data_files=['psf_parameters_with_wings.txt'] + shell_files)
+        elif method == 'separable':
+            key = cache.make_key('convolve_separable', image.data, scale, dtype.str, *shells,
+                                 data_files=['psf_parameters.txt'] + shell_files)
+        else:
+            key = cache.make_key('convolve', image.data, this_psf.array, dtype.str)
+        smoothed_data = cache.get(key, mmap=False)
+    if cache is None or smoothed_data is None:
+        if wings:
+            smoothed_data = otf_convolve(image.data,
+                                         lambda shape: psf_otf(shape, scale=scale,
+                                                               energy=energy,
+                                                               precision=precision),
+                                         precision=precision)
+        elif method == 'separable':
+            comp = psf_components(_on_axis, _on_axis, energy=energy)
+            pixel = image.scale[0]
+            smoothed_data = separable_convolve(image.data, comp['weight'],
+                                               comp['sigma_x'] / pixel,
+                                               comp['sigma_y'] / pixel,
+                                               theta=comp['theta'],
+                                               precision=precision)
+        else:
+            with stage('psf.convolve') as s:
+                smoothed_data = astropy_convolve(image.data, this_psf)
+                smoothed_data = smoothed_data.astype(dtype, copy=False)
+                s.add_array(smoothed_data)
+        if cache is not None:
+            cache.set(key, smoothed_data)
+    result = image.with_data(smoothed_data, telescop=pyfoxsi.mission_title)
+    return result.like(sunpy_map)
 
-    return result
+
+def energy_groups(energy, tolerance=0.01):
+    """Group energies at which the psf is nearly the same.
+
+    The energies are sorted by their `psf_width_scale` and split into the
+    fewest runs whose widths differ by at most tolerance, so that one kernel
+    can serve a whole group.
+
+    Parameters
+    ----------
+    energy : `~astropy.units.Quantity`
+        The photon energies.
+    tolerance : float
+        The largest relative difference of the psf widths within a group. The
+        kernel of a group is that of the member in the middle of its range of
+        widths, so each kernel is within about tolerance / 2 of the exact
+        width. Set to 0 to build a kernel for every distinct energy.
+
+    Returns
+    -------
+    groups : list of tuple
+        For each group, the energy at which its kernel is built and the
+        (increasing) indices of its members.
+    """
+    energy = np.atleast_1d(energy)
+    width_scale = psf_width_scale(energy)
+    order = np.argsort(width_scale, kind='stable')
+    sorted_scale = width_scale[order]
+    groups = []
+    start = 0
+    while start < len(order):
+        stop = np.searchsorted(sorted_scale, sorted_scale[start] * (1 + tolerance),
+                               side='right')
+        middle = np.sqrt(sorted_scale[start] * sorted_scale[stop - 1])
+        representative = order[start + np.argmin(np.abs(sorted_scale[start:stop] - middle))]
+        groups.append((energy[representative], np.sort(order[start:stop])))
+        start = stop
+    return groups
+
+
+def convolve_cube(cube, energy=None, scale=None, wings=False, tolerance=0.01,
+                  pad=None, precision=None):
+    """Convolve each energy slice of a cube with the psf at its energy.
+
+    The slices are grouped with `energy_groups` and the transfer function of
+    each group is built once (see `psf_otf`) and applied to all of its slices
+    with one batched FFT, so the cost is close to that of an energy
+    independent psf.
+
+    Parameters
+    ----------
+    cube : `~numpy.ndarray` or `~pyfoxsi.image.Image`
+        The (energy, y, x) cube.
+    energy : `~astropy.units.Quantity`
+        The energy of each slice or the edges of the energy bins, whose
+        centres are then used. Defaults to the energy edges of an image.
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel). Defaults to that of an image.
+    wings : bool
+        If True, include the psf wings.
+    tolerance : float
+        The largest relative difference of the psf widths of slices which
+        share a kernel, see `energy_groups`.
+    pad : int or tuple of int
+        The number of zero pixels added along (y, x), see `otf_convolve`.
+    precision : str
+        'single' or 'double', see `get_dtype`.
+
+    Returns
+    -------
+    cube : `~numpy.ndarray` or `~pyfoxsi.image.Image`
+        The convolved cube, of the type of the input.
+
+    Examples
+    --------
+    >>> cube = np.random.poisson(10, size=(100, 256, 256)).astype(float)
+    >>> edges = np.linspace(4, 54, 101) * u.keV
+    >>> result = convolve_cube(cube, edges, scale=2 * u.arcsec / u.pix)  # doctest: +SKIP
+    """
+    from scipy import fft
+    image = None
+    data = cube
+    if not isinstance(cube, np.ndarray):
+        image = as_image(cube)
+        data = image.data
+        if energy is None and image.energy is not None:
+            energy = u.Quantity(image.energy, u.keV)
+        if scale is None:
+            scale = image.pixel_scale
+    if energy is None or scale is None:
+        raise ValueError('The energy and scale of an array must be given')
+    dtype = get_dtype(precision)
+    data = np.asarray(data, dtype=dtype)
+    nslice, ny, nx = data.shape
+    energy = energy.to(u.keV)
+    if len(energy) == nslice + 1:
+        energy = 0.5 * (energy[1:] + energy[:-1])
+    elif len(energy) != nslice:
+        raise ValueError('There must be one energy per slice or one more edge')
+    if pad is None:
+        pad = (ny // 2, nx // 2)
+    pad = np.broadcast_to(pad, 2)
+    shape = (fft.next_fast_len(int(ny + pad[0]), real=True),
+             fft.next_fast_len(int(nx + pad[1]), real=True))
+
+    result = np.empty_like(data)
+    with stage('psf.convolve_cube') as s:
+        for group_energy, index in energy_groups(energy, tolerance=tolerance):
+            otf = psf_otf(shape, scale=scale, wings=wings, energy=group_energy,
+                          precision=precision)
+            result[index] = fft.irfft2(fft.rfft2(data[index], s=shape, workers=-1) * otf,
+                                       s=shape, workers=-1)[:, :ny, :nx]
+        s.add_array(result)
+    if image is None:
+        return result
+    return image.with_data(result, telescop=pyfoxsi.mission_title).like(cube)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyfoxsi.psf import psf_components
+from pyfoxsi.psf.psf import _data_file
+
+
+def test_wing_matches_idl_peak_and_half_width():
+    params = np.loadtxt(_data_file('psf_parameters_with_wings.txt'))
+    amp, w = params[3], params[12]
+
+    def idl(r):
+        # the IDL lorentz_2d without its cutoff, along the x axis
+        return amp / np.pi / (2 + (r / w) ** 2)
+
+    comp = psf_components(0 * u.arcmin, 0 * u.arcmin, wings=True)
+    gamma = comp['wing_gamma_x']
+
+    def cauchy(r):
+        return (1 + (r / gamma) ** 2) ** -1.5
+
+    hwhm = np.sqrt(2) * w
+    assert idl(hwhm) == pytest.approx(idl(0) / 2)
+    assert cauchy(hwhm) == pytest.approx(cauchy(0) / 2)
+    # the flux of the wing is that of the Cauchy profile with the IDL peak
+    total = (2 * np.pi * params[:3] * params[[6, 8, 10]] * params[[7, 9, 11]]).sum()
+    wing_flux = 2 * np.pi * idl(0) * gamma ** 2
+    assert comp['wing_weight'] == pytest.approx(wing_flux / (total + wing_flux))
+
+
+@pytest.mark.parametrize('scale', [0.5, 1., 2., 3.])
+def test_separable_convolve_matches_oversampled_kernel(scale):
+    from astropy.convolution import convolve as astropy_convolve
+    from pyfoxsi.psf import psf, separable_convolve
+
+    rng = np.random.RandomState(1)
+    image = np.zeros((96, 96))
+    image[20:70, 30:60] = rng.rand(50, 30)
+    image[48, 48] = 20.
+    comp = psf_components(0 * u.arcmin, 0 * u.arcmin)
+    result = separable_convolve(image, comp['weight'], comp['sigma_x'] / scale,
+                                comp['sigma_y'] / scale)
+    kernel = psf(0 * u.arcmin, 0 * u.arcmin, scale=scale * u.arcsec / u.pix,
+                 oversample=40)
+    reference = astropy_convolve(image, kernel, boundary='fill')
+    assert np.abs(result - reference).max() < 1e-4 * reference.max()
+
+
+def _psf_sigma(energy):
+    from pyfoxsi.psf import psf
+    return psf(0 * u.arcmin, 0 * u.arcmin, energy=energy).array
+
+
+def _otf(energy):
+    from pyfoxsi.psf import psf_otf
+    return psf_otf((32, 32), wings=False, energy=energy)
+
+
+def _sigma(energy):
+    return psf_components(0 * u.arcmin, 0 * u.arcmin, energy=energy)['sigma_x']
+
+
+@pytest.mark.parametrize('function', [_sigma, _psf_sigma, _otf])
+def test_psf_takes_a_single_energy(function):
+    scalar = function(60 * u.keV)
+    np.testing.assert_allclose(function([60.] * u.keV), scalar)
+    with pytest.raises(ValueError, match='single energy'):
+        function([10., 60.] * u.keV)
+
+
+def test_psf_broadens_with_energy():
+    assert np.all(_sigma(60 * u.keV) > _sigma(None))
+
+
+def test_energy_groups():
+    from pyfoxsi.psf import energy_groups, psf_width_scale
+
+    energy = np.linspace(60, 4, 57) * u.keV
+    width_scale = psf_width_scale(energy)
+    exact = energy_groups(energy, tolerance=0)
+    assert len(exact) == len(np.unique(width_scale))
+
+    groups = energy_groups(energy, tolerance=0.01)
+    assert 1 < len(groups) < len(exact)
+    members = np.concatenate([index for _, index in groups])
+    np.testing.assert_array_equal(np.sort(members), np.arange(len(energy)))
+    for group_energy, index in groups:
+        widths = width_scale[index]
+        assert widths.max() <= widths.min() * 1.01
+        assert group_energy in energy[index]
+        assert widths.min() <= psf_width_scale(group_energy) <= widths.max()
+
+
+@pytest.mark.parametrize('wings', [False, True])
+def test_convolve_cube_matches_each_slice(wings):
+    from pyfoxsi.psf import convolve_cube, otf_convolve, psf_otf
+
+    rng = np.random.RandomState(2)
+    cube = rng.rand(6, 40, 48)
+    edges = np.linspace(4, 64, 7) * u.keV
+    scale = 2 * u.arcsec / u.pix
+    result = convolve_cube(cube, edges, scale=scale, wings=wings, tolerance=0)
+    centres = 0.5 * (edges[1:] + edges[:-1])
+    for data, energy, actual in zip(cube, centres, result):
+        expected = otf_convolve(data, lambda shape: psf_otf(shape, scale=scale, wings=wings,
+                                                            energy=energy))
+        np.testing.assert_allclose(actual, expected, atol=1e-12)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyfoxsi.image import Image
+from pyfoxsi.psf import (psf_components, separable_convolve, tile_slices,
+                         tiled_apply, tiled_convolve)
+
+
+def test_tile_slices_cover_the_array_once():
+    shape = (100, 70)
+    count = np.zeros(shape, dtype=int)
+    for inner, outer, local in tile_slices(shape, 32, (3, 5)):
+        count[inner] += 1
+        window = np.arange(np.prod(shape)).reshape(shape)
+        assert np.array_equal(window[outer][local], window[inner])
+        assert outer[0].start == max(inner[0].start - 3, 0)
+        assert outer[1].stop == min(inner[1].stop + 5, shape[1])
+    assert np.all(count == 1)
+
+
+def _image():
+    rng = np.random.RandomState(3)
+    data = rng.rand(200, 152)
+    data[100, 64] = 50.
+    return Image(data, scale=(2., 2.))
+
+
+def _separable(data, scale):
+    comp = psf_components(0 * u.arcmin, 0 * u.arcmin)
+    return separable_convolve(data, comp['weight'], comp['sigma_x'] / scale,
+                              comp['sigma_y'] / scale, theta=comp['theta'])
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_tiled_convolve_matches_whole_map(processes):
+    image = _image()
+    result = tiled_convolve(image, tile_size=64, processes=processes)
+    expected = _separable(image.data, 2.)
+    np.testing.assert_allclose(result.data, expected, rtol=0, atol=1e-12 * expected.max())
+
+
+def test_tiled_convolve_rebins_and_applies_the_response():
+    image = _image()
+    result = tiled_convolve(image, tile_size=64, processes=1, rebin=4,
+                            response=3 * u.cm ** 2)
+    expected = 3 * _separable(image.data, 2.).reshape(50, 4, 38, 4).sum(axis=(1, 3))
+    assert result.data.shape == (50, 38)
+    np.testing.assert_allclose(result.data, expected, rtol=1e-12)
+    assert tuple(result.scale) == (8., 8.)
+    assert result.updates['earea'] == 3.
+
+
+def test_tiled_apply_drops_partial_blocks_and_checks_rebin():
+    data = np.ones((10, 9))
+    result = tiled_apply(data, np.asarray, tile_size=4, processes=1, rebin=2)
+    assert result.shape == (5, 4)
+    assert np.all(result == 4.)
+    with pytest.raises(ValueError):
+        tiled_apply(data, np.asarray, tile_size=5, rebin=2)
@@ -0,0 +1,231 @@
+"""
+Tiling is a module to simulate maps too large to convolve in one piece
+
+The map is split into tiles which are extended by a halo wide enough to hold
+the psf so that each tile can be processed independently and the tiles
+stitched back together without seams. Tiles are processed in parallel and at
+most a few tiles per worker are in flight at once, so the peak memory is set
+by the tile size and the number of workers rather than by the size of the map.
+"""
+
+from __future__ import absolute_import
+import os
+import functools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import astropy.units as u
+
+import pyfoxsi
+from pyfoxsi.psf.psf import (get_dtype, psf_components, psf_otf,
+                             otf_convolve, separable_convolve)
+from pyfoxsi.profiling import stage
+from pyfoxsi.image import as_image
+
+__all__ = ['tile_slices', 'tiled_apply', 'tiled_convolve']
+
+
+def tile_slices(shape, tile_size, halo):
+    """Split a 2-D array into tiles with halos.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The (ny, nx) shape of the array.
+    tile_size : int or tuple of int
+        The size of the tiles along (y, x), without halo.
+    halo : int or tuple of int
+        The number of extra pixels read around each tile along (y, x).
+
+    Returns
+    -------
+    tiles : list of tuple
+        For each tile, the slices (into the array) of the tile, the slices
+        (into the array) of the tile with its halo, and the slices of the tile
+        within the tile with its halo.
+    """
+    tile_size = np.broadcast_to(tile_size, 2)
+    halo = np.broadcast_to(halo, 2)
+    tiles = []
+    for y0 in range(0, shape[0], tile_size[0]):
+        for x0 in range(0, shape[1], tile_size[1]):
+            inner = []
+            outer = []
+            local = []
+            for start, size, h, n in zip((y0, x0), tile_size, halo, shape):
+                stop = min(start + size, n)
+                lo = max(start - h, 0)
+                hi = min(stop + h, n)
+                inner.append(slice(start, stop))
+                outer.append(slice(lo, hi))
+                local.append(slice(start - lo, stop - lo))
+            tiles.append((tuple(inner), tuple(outer), tuple(local)))
+    return tiles
+
+
+def _rebin(array, factor):
+    """Sum blocks of factor x factor pixels, accumulating in double precision."""
+    if factor == 1:
+        return array
+    ny, nx = array.shape
+    blocks = array.reshape(ny // factor, factor, nx // factor, factor)
+    return blocks.sum(axis=(1, 3), dtype=np.float64).astype(array.dtype, copy=False)
+
+
+def _process_tile(func, tile, local, factor):
+    result = func(tile)[local]
+    return _rebin(result, factor)
+
+
+def tiled_apply(data, func, tile_size=512, halo=0, processes=None, rebin=1,
+                out=None, precision=None):
+    """Apply a function to a large array tile by tile.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        The 2-D array. It can be a `~numpy.memmap` so that the full array is
+        never in memory.
+    func : callable
+        Applied to each tile with its halo and returning an array of the same
+        shape. It must be picklable (a module level function or a
+        `functools.partial` of one) if processes is not 1.
+    tile_size : int
+        The size of the tiles without halo. It must be a multiple of rebin.
+    halo : int or tuple of int
+        The number of pixels around each tile which func needs to compute the
+        tile exactly, e.g. the half width of a convolution kernel.
+    processes : int
+        The number of worker processes. Defaults to the number of CPUs. If 1,
+        the tiles are processed in this process.
+    rebin : int
+        Sum the result over blocks of rebin x rebin pixels. Rows and columns
+        beyond a whole number of blocks are dropped.
+    out : `~numpy.ndarray`
+        The array into which the result is written, e.g. a `~numpy.memmap`.
+    precision : str
+        The precision of the result if out is not given, 'single' or
+        'double' (see `~pyfoxsi.psf.get_dtype`).
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        The stitched result.
+    """
+    if tile_size % rebin != 0:
+        raise ValueError('tile_size must be a multiple of rebin')
+    ny, nx = data.shape
+    ny, nx = (ny // rebin) * rebin, (nx // rebin) * rebin
+    if out is None:
+        out = np.zeros((ny // rebin, nx // rebin), dtype=get_dtype(precision))
+    tiles = tile_slices((ny, nx), tile_size, halo)
+
+    def out_slices(inner):
+        return tuple([slice(s.start // rebin, s.stop // rebin) for s in inner])
+
+    with stage('tiling.apply') as s:
+        if processes == 1:
+            for inner, outer, local in tiles:
+                out[out_slices(inner)] = _process_tile(func, np.asarray(data[outer]),
+                                                       local, rebin)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                max_pending = 2 * (processes or os.cpu_count() or 1)
+                pending = {}
+                todo = list(tiles)
+                while todo or pending:
+                    # only a few tiles per worker are in memory at once
+                    while todo and len(pending) < max_pending:
+                        inner, outer, local = todo.pop(0)
+                        future = executor.submit(_process_tile, func,
+                                                 np.asarray(data[outer]), local,
+                                                 rebin)
+                        pending[future] = inner
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        inner = pending.pop(future)
+                        out[out_slices(inner)] = future.result()
+        s.add_array(out)
+    return out
+
+
+def _convolve_tile(tile, weight, sigma_x, sigma_y, theta, factor, precision):
+    result = separable_convolve(tile, weight, sigma_x, sigma_y, theta=theta,
+                                precision=precision)
+    result *= result.dtype.type(factor)
+    return result
+
+
+def _convolve_tile_wings(tile, scale, factor, precision):
+    result = otf_convolve(tile, lambda shape: psf_otf(shape, scale=scale,
+                                                      precision=precision),
+                          precision=precision)
+    result *= result.dtype.type(factor)
+    return result
+
+
+def tiled_convolve(sunpy_map, tile_size=512, processes=None, wings=False,
+                   halo=None, response=1., rebin=1, precision=None):
+    """Convolve a large map with the FOXSI psf tile by tile.
+
+    Each tile is convolved with `~pyfoxsi.psf.separable_convolve` (or, with
+    wings, `~pyfoxsi.psf.otf_convolve`), multiplied by the response and
+    rebinned before being stitched into the output.
+
+    Parameters
+    ----------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        An input map, e.g. a full disk AIA image.
+    tile_size : int
+        The size of the tiles without halo.
+    processes : int
+        The number of worker processes. Defaults to the number of CPUs.
+    wings : bool
+        If True, include the psf wings.
+    halo : int
+        The halo around each tile in pixels. Defaults to 4 sigma of the widest
+        Gaussian of the psf, or to a quarter of the tile size with wings
+        since the wings are only truncated at the halo.
+    response : float or `~astropy.units.Quantity`
+        A factor applied to every pixel, e.g. the effective area.
+    rebin : int
+        Sum the result over blocks of rebin x rebin pixels.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+
+    Returns
+    -------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        The convolved map, of the type of the input.
+    """
+    image = as_image(sunpy_map)
+    scale = image.pixel_scale
+    pixel = scale.to_value(u.arcsec / u.pix)
+    # resolve the global setting here so that workers do not depend on it
+    precision = get_dtype(precision).name
+    unit = None
+    if isinstance(response, u.Quantity):
+        unit = response.unit
+        response = response.value
+    if wings:
+        func = functools.partial(_convolve_tile_wings, scale=scale,
+                                 factor=response, precision=precision)
+        if halo is None:
+            halo = tile_size // 4
+    else:
+        comp = psf_components(0 * u.arcmin, 0 * u.arcmin)
+        func = functools.partial(_convolve_tile, weight=comp['weight'],
+                                 sigma_x=comp['sigma_x'] / pixel,
+                                 sigma_y=comp['sigma_y'] / pixel,
+                                 theta=comp['theta'], factor=response,
+                                 precision=precision)
+        if halo is None:
+            width = max(comp['sigma_x'].max(), comp['sigma_y'].max()) / pixel
+            halo = int(np.ceil(4 * width))
+    result = tiled_apply(image.data, func, tile_size=tile_size, halo=halo,
+                         processes=processes, rebin=rebin, precision=precision)
+
+    updates = {'telescop': pyfoxsi.mission_title}
+    if unit is not None:
+        updates['earea'] = response
+    return image.with_data(result, rebin=rebin, **updates).like(sunpy_map)
@@ -0,0 +1,252 @@
+"""
+Reconstruction is a module to recover source maps from FOXSI images
+"""
+
+from __future__ import absolute_import
+import logging
+
+import numpy as np
+import astropy.units as u
+from scipy import fft
+
+from pyfoxsi.psf import get_dtype, psf_components, psf_otf
+from pyfoxsi.profiling import stage
+from pyfoxsi.image import as_image
+
+__all__ = ['kernel_otf', 'richardson_lucy', 'deconvolve']
+
+log = logging.getLogger(__name__)
+
+
+def kernel_otf(kernel, shape, precision=None):
+    """Return the transfer function of a spatial psf kernel.
+
+    Parameters
+    ----------
+    kernel : `~numpy.ndarray` or `~astropy.convolution.Kernel2D`
+        A centred kernel with odd dimensions, or a stack of them with the
+        leading axis matching the slices of the data.
+    shape : tuple of int
+        The (ny, nx) shape of the padded array on which the transfer
+        function will be used.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+
+    Returns
+    -------
+    otf : `~numpy.ndarray`
+        The transfer function on the rfft2 grid of shape.
+    """
+    kernel = np.asarray(getattr(kernel, 'array', kernel), dtype=float)
+    ky, kx = kernel.shape[-2:]
+    padded = np.zeros(kernel.shape[:-2] + tuple(shape), dtype=get_dtype(precision))
+    padded[..., :ky, :kx] = kernel / kernel.sum(axis=(-2, -1), keepdims=True)
+    # move the kernel centre to the origin
+    padded = np.roll(padded, (-(ky // 2), -(kx // 2)), axis=(-2, -1))
+    return fft.rfft2(padded, workers=-1)
+
+
+def _tv_term(estimate, weight):
+    """The total variation regularization denominator of Dey et al. (2006)."""
+    eps = 1e-8 * estimate.max(axis=(-2, -1), keepdims=True) + 1e-30
+    gy, gx = np.gradient(estimate, axis=(-2, -1))
+    norm = np.sqrt(gx ** 2 + gy ** 2) + eps
+    div = (np.gradient(gx / norm, axis=-1) + np.gradient(gy / norm, axis=-2))
+    return np.clip(1. - weight * div, 0.1, None)
+
+
+def _tikhonov_term(estimate, weight):
+    """The Tikhonov-Miller (Laplacian) regularization denominator."""
+    lap = (np.roll(estimate, 1, -1) + np.roll(estimate, -1, -1) +
+           np.roll(estimate, 1, -2) + np.roll(estimate, -1, -2) - 4 * estimate)
+    floor = _floor(estimate)
+    return np.clip(1. - 2 * weight * lap / np.maximum(estimate, floor), 0.1, None)
+
+
+def _floor(x):
+    """A small positive value relative to the peak of each slice."""
+    peak = x.max(axis=(-2, -1), keepdims=True)
+    return 1e-6 * peak + np.finfo(x.dtype).tiny
+
+
+_regularizations = {'tv': _tv_term, 'tikhonov': _tikhonov_term}
+
+
+def richardson_lucy(data, otf=None, scale=1 * u.arcsec / u.pix, kernel=None,
+                    iterations=50, tol=1e-4, regularization=None,
+                    regularization_weight=0.002, pad=None, wings=False,
+                    return_iterations=False, precision=None):
+    r"""Reconstruct source maps with the Richardson-Lucy algorithm.
+
+    All of the slices of a cube are reconstructed together as one array with
+    batched FFTs over the last two axes. The psf transfer function is computed
+    once and reused in every iteration. Each slice stops updating once the
+    relative change of its estimate falls below tol. The data are zero padded
+    and only the observed pixels enter the likelihood so that flux near the
+    edges is not wrapped around.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        A 2-D image or an (energy, y, x) cube of counts. Negative values
+        are set to zero.
+    otf : `~numpy.ndarray` or callable
+        The psf transfer function on the rfft2 grid of the padded data, a
+        function returning it given the padded shape, or None to use the
+        FOXSI psf from `~pyfoxsi.psf.psf_otf` at the given scale. It can have a
+        leading axis to give each slice its own psf.
+    scale : `~astropy.units.Quantity`
+        The pixel scale, used if otf and kernel are not given.
+    kernel : `~numpy.ndarray` or `~astropy.convolution.Kernel2D`
+        A spatial psf kernel to use instead of otf.
+    iterations : int
+        The maximum number of iterations.
+    tol : float
+        The relative L1 change of a slice below which it is converged.
+    regularization : None, 'tv' or 'tikhonov'
+        Regularize with total variation or the Laplacian (Tikhonov-Miller)
+        to suppress noise amplification.
+    regularization_weight : float
+        The strength of the regularization.
+    pad : int or tuple of int
+        The number of zero pixels added along (y, x). Defaults to the extent
+        of the psf core.
+    wings : bool
+        If True, the default FOXSI psf includes the wings.
+    return_iterations : bool
+        If True, also return the number of iterations run for each slice.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`. Single precision
+        halves the memory and FFT cost. Totals used for normalization and
+        convergence are accumulated in double precision.
+
+    Returns
+    -------
+    estimate : `~numpy.ndarray`
+        The reconstructed source with the shape of data.
+    iterations : `~numpy.ndarray`
+        The iterations run per slice, if return_iterations is set.
+
+    Examples
+    --------
+    >>> cube = np.random.poisson(10, size=(60, 512, 512)).astype(float)
+    >>> source = richardson_lucy(cube, scale=2 * u.arcsec / u.pix)  # doctest: +SKIP
+    """
+    dtype = get_dtype(precision)
+    # FFT convolved images have small negative values around sharp features
+    data = np.clip(np.asarray(data, dtype=dtype), 0., None)
+    if regularization is not None and regularization not in _regularizations:
+        raise ValueError('Not a valid regularization. Must be tv or tikhonov')
+    single = data.ndim == 2
+    if single:
+        data = data[np.newaxis]
+    nslice, ny, nx = data.shape
+
+    if pad is None:
+        if otf is None and kernel is None:
+            comp = psf_components(0 * u.arcmin, 0 * u.arcmin)
+            width = max(comp['sigma_x'].max(), comp['sigma_y'].max())
+            pad = int(np.ceil(4 * width / scale.to_value(u.arcsec / u.pix)))
+        elif kernel is not None:
+            pad = max(np.shape(getattr(kernel, 'array', kernel))[-2:])
+        else:
+            pad = (ny // 2, nx // 2)
+    pad = np.broadcast_to(pad, 2)
+    shape = (fft.next_fast_len(int(ny + pad[0]), real=True),
+             fft.next_fast_len(int(nx + pad[1]), real=True))
+
+    with stage('reconstruction.otf'):
+        if kernel is not None:
+            otf = kernel_otf(kernel, shape, precision=precision)
+        elif otf is None:
+            otf = psf_otf(shape, scale=scale, wings=wings, precision=precision)
+        elif callable(otf):
+            otf = otf(shape)
+        otf = np.asarray(otf)
+        otf = otf.astype(dtype if otf.dtype.kind == 'f' else np.result_type(dtype, np.complex64),
+                         copy=False)
+        if otf.ndim == 2:
+            otf = otf[np.newaxis]
+        otf_conj = np.conj(otf)
+
+    def select(x, idx):
+        # the psf arrays shared by all slices have a leading axis of length one
+        if len(x) == 1 and nslice > 1:
+            return x[0]
+        if len(idx) == len(x):
+            return x
+        return x[idx]
+
+    def forward(x, idx):
+        return fft.irfft2(fft.rfft2(x, s=shape, workers=-1) * select(otf, idx),
+                          s=shape, workers=-1)
+
+    def adjoint(x, idx):
+        return fft.irfft2(fft.rfft2(x, workers=-1) * select(otf_conj, idx),
+                          s=shape, workers=-1)
+
+    observed = np.zeros(shape, dtype=bool)
+    observed[:ny, :nx] = True
+    padded_data = np.zeros((nslice,) + shape, dtype=dtype)
+    padded_data[:, :ny, :nx] = data
+    all_slices = np.arange(nslice)
+    # the sensitivity of each source pixel to the observed region
+    norm = adjoint(np.broadcast_to(observed, (len(otf),) + shape).astype(dtype),
+                   np.arange(len(otf)))
+    norm = np.clip(norm, 1e-6 * norm.max(), None)
+    estimate = np.empty((nslice,) + shape, dtype=dtype)
+    estimate[:] = np.clip(padded_data.sum(axis=(-2, -1), keepdims=True, dtype=np.float64) /
+                          observed.sum(), 1e-12, None)
+
+    active = all_slices
+    done = np.zeros(nslice, dtype=int)
+    with stage('reconstruction.richardson_lucy') as s:
+        for i in range(iterations):
+            est = select(estimate, active)
+            blurred = forward(est, active)
+            np.maximum(blurred, _floor(blurred), out=blurred)
+            ratio = np.divide(select(padded_data, active), blurred, out=blurred)
+            ratio[..., ~observed] = 0.
+            update = est * adjoint(ratio, active)
+            update /= select(norm, active)
+            if regularization is not None:
+                update /= _regularizations[regularization](est, regularization_weight)
+            np.clip(update, 0., None, out=update)
+            change = (np.abs(update - est).sum(axis=(-2, -1), dtype=np.float64) /
+                      np.clip(est.sum(axis=(-2, -1), dtype=np.float64), 1e-30, None))
+            estimate[active] = update
+            done[active] = i + 1
+            active = active[change > tol]
+            if len(active) == 0:
+                break
+        s.add_array(estimate)
+    log.debug('Richardson-Lucy stopped after %i iterations', done.max())
+
+    result = estimate[:, :ny, :nx]
+    if single:
+        result = result[0]
+        done = done[0]
+    if return_iterations:
+        return result, done
+    return result
+
+
+def deconvolve(sunpy_map, **kwargs):
+    """Reconstruct the source of a FOXSI map with `richardson_lucy`.
+
+    Parameters
+    ----------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        A map convolved with the FOXSI psf.
+    kwargs
+        Passed to `richardson_lucy`. The scale is taken from the map.
+
+    Returns
+    -------
+    sunpy_map : `~sunpy.map.GenericMap` or `~pyfoxsi.image.Image`
+        The reconstructed source map, of the type of the input.
+    """
+    image = as_image(sunpy_map)
+    kwargs.setdefault('scale', image.pixel_scale)
+    result = richardson_lucy(image.data, **kwargs)
+    return image.with_data(result).like(sunpy_map)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyfoxsi.psf import psf_otf, otf_convolve
+from pyfoxsi.reconstruction import richardson_lucy
+
+scale = 2 * u.arcsec / u.pix
+
+
+def blurred_source():
+    source = np.zeros((64, 64))
+    source[20, 20] = 1000.
+    source[35:40, 35:45] = 10.
+    image = otf_convolve(source, lambda shape: psf_otf(shape, scale=scale, wings=False))
+    return source, image
+
+
+@pytest.mark.parametrize('precision', ['double', 'single'])
+@pytest.mark.parametrize('regularization', [None, 'tv', 'tikhonov'])
+def test_noise_free_image_converges_and_keeps_flux(precision, regularization):
+    source, image = blurred_source()
+    result, done = richardson_lucy(image, scale=scale, iterations=200,
+                                   regularization=regularization,
+                                   precision=precision, return_iterations=True)
+    assert np.all(np.isfinite(result))
+    # the regularized updates are not exactly flux conserving
+    rel = 1e-3 if regularization is None else 1e-2
+    assert result.sum() == pytest.approx(source.sum(), rel=rel)
+    # the point source is sharpened back towards its true position
+    assert np.unravel_index(result.argmax(), result.shape) == (20, 20)
+    assert result[20, 20] > 2 * image[20, 20]
+
+
+def test_cube_slices_match_single_images():
+    _, image = blurred_source()
+    cube = np.stack([image, 0.5 * image])
+    result = richardson_lucy(cube, scale=scale, iterations=30, tol=0)
+    for i in range(2):
+        single = richardson_lucy(cube[i], scale=scale, iterations=30, tol=0)
+        np.testing.assert_allclose(result[i], single, rtol=1e-6, atol=1e-9)
@@ -4,3 +4,4 @@ __author__ = "Steven D. Christe"
 __email__ = "steven.christe@nasa.gov"
 
 from pyfoxsi.response.response import *
+from pyfoxsi.response.ogip import *
@@ -0,0 +1,389 @@
+"""
+OGIP is a module to export the FOXSI responses as OGIP ARF and RMF files
+
+The files follow the OGIP calibration memo CAL/GEN/92-002 so that they can be
+used by standard spectral fitting tools. The redistribution matrix is stored
+in the compressed form, where each row only holds the groups of consecutive
+channels with a non-negligible response (N_GRP, F_CHAN, N_CHAN).
+
+Examples
+--------
+>>> from pyfoxsi.response import generate_response_set, load_response_set
+>>> files = generate_response_set('responses')  # doctest: +SKIP
+>>> responses = load_response_set('responses')  # doctest: +SKIP
+>>> energy_edges, area = responses['foxsi_dsi_shutter0']  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+import os
+import glob
+import datetime
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from scipy.special import erf
+from roentgen.absorption import Material
+
+import pyfoxsi
+from pyfoxsi.response.response import DSIResponse, STCResponse, _bin_average
+from pyfoxsi.profiling import stage
+
+__all__ = ['redistribution_matrix', 'write_arf', 'write_rmf', 'read_arf',
+           'read_rmf', 'generate_response_set', 'load_response_set']
+
+# the default energy grids of the response files
+dsi_energy_edges = np.arange(1., 80.05, 0.1) * u.keV
+# the STC table of STCResponse starts at 1 keV, the lowest energy of the
+# roentgen attenuation tables
+stc_energy_edges = np.arange(1., 19.91, 0.05) * u.keV
+
+# matrix elements below this are not stored
+default_threshold = 1e-6
+
+
+def _fwhm_to_sigma(fwhm):
+    return fwhm / (2 * np.sqrt(2 * np.log(2)))
+
+
+def redistribution_matrix(energy_edges, channel_edges, resolution):
+    """The probability of a photon being detected in each channel.
+
+    A photon of the energy at the centre of each input bin is detected with
+    a Gaussian energy resolution.
+
+    Parameters
+    ----------
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the photon energy bins.
+    channel_edges : `~astropy.units.Quantity` <keV>
+        The m + 1 edges of the detector channels.
+    resolution : `~astropy.units.Quantity` <keV>
+        The FWHM energy resolution. If zero, each photon is put in the channel
+        which contains its energy.
+
+    Returns
+    -------
+    matrix : `~numpy.ndarray`
+        The (n, m) redistribution matrix.
+    """
+    edges = energy_edges.to_value(u.keV)
+    channels = channel_edges.to_value(u.keV)
+    energy = 0.5 * (edges[:-1] + edges[1:])
+    sigma = _fwhm_to_sigma(u.Quantity(resolution, u.keV).value)
+    if sigma == 0:
+        matrix = np.zeros((len(energy), len(channels) - 1))
+        index = np.searchsorted(channels, energy, side='right') - 1
+        inside = (index >= 0) & (index < len(channels) - 1)
+        matrix[np.flatnonzero(inside), index[inside]] = 1.
+        return matrix
+    cdf = erf((channels[np.newaxis, :] - energy[:, np.newaxis]) / (np.sqrt(2) * sigma))
+    return 0.5 * np.diff(cdf, axis=1)
+
+
+def _header(hdu, instrument, filt=None, **kwargs):
+    hdu.header['TELESCOP'] = pyfoxsi.mission_title
+    hdu.header['INSTRUME'] = instrument
+    hdu.header['FILTER'] = filt or 'NONE'
+    hdu.header['HDUCLASS'] = 'OGIP'
+    hdu.header['HDUCLAS1'] = 'RESPONSE'
+    for key, value in kwargs.items():
+        hdu.header[key] = value
+    hdu.header['CREATOR'] = 'pyfoxsi'
+    hdu.header['DATE'] = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _write(hdus, filename):
+    """Write the HDUs to a temporary file and atomically move it into place."""
+    part = filename + '.part'
+    fits.HDUList([fits.PrimaryHDU()] + hdus).writeto(part, overwrite=True)
+    os.replace(part, filename)
+
+
+def write_arf(filename, energy_edges, effective_area, instrument='DSI',
+              filt=None):
+    """Write an ancillary response (ARF) file.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the energy bins.
+    effective_area : `~astropy.units.Quantity` <cm2>
+        The effective area in each of the n bins.
+    instrument : str
+        The INSTRUME keyword, e.g. DSI or STC.
+    filt : str
+        The FILTER keyword, e.g. the shutter state.
+    """
+    edges = energy_edges.to_value(u.keV)
+    columns = [fits.Column('ENERG_LO', 'E', unit='keV', array=edges[:-1]),
+               fits.Column('ENERG_HI', 'E', unit='keV', array=edges[1:]),
+               fits.Column('SPECRESP', 'E', unit='cm**2',
+                           array=u.Quantity(effective_area, u.cm ** 2).value)]
+    hdu = fits.BinTableHDU.from_columns(columns, name='SPECRESP')
+    _header(hdu, instrument, filt, HDUCLAS2='SPECRESP', HDUVERS='1.1.0')
+    _write([hdu], filename)
+
+
+def write_rmf(filename, energy_edges, channel_edges, matrix=None,
+              resolution=None, instrument='DSI', threshold=default_threshold,
+              first_channel=0):
+    """Write a redistribution matrix (RMF) file in compressed form.
+
+    The groups of consecutive channels above threshold in every row are found
+    at once with array operations, so large matrices are written quickly.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the photon energy bins.
+    channel_edges : `~astropy.units.Quantity` <keV>
+        The m + 1 edges of the detector channels.
+    matrix : `~numpy.ndarray`
+        The (n, m) redistribution matrix. Defaults to
+        `redistribution_matrix` with resolution.
+    resolution : `~astropy.units.Quantity` <keV>
+        The FWHM energy resolution if matrix is not given. Defaults to that of
+        the instrument.
+    instrument : str
+        The INSTRUME keyword, DSI or STC.
+    threshold : float
+        Matrix elements at or below this are not stored.
+    first_channel : int
+        The number of the first channel.
+    """
+    if matrix is None:
+        if resolution is None:
+            resolution = (pyfoxsi.stc_energy_resolution if instrument == 'STC'
+                          else pyfoxsi.dsi_energy_resolution)
+        matrix = redistribution_matrix(energy_edges, channel_edges, resolution)
+    edges = energy_edges.to_value(u.keV)
+    channels = channel_edges.to_value(u.keV)
+    nrow, nchan = matrix.shape
+
+    with stage('response.write_rmf') as s:
+        mask = matrix > threshold
+        padded = np.zeros((nrow, nchan + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask
+        step = np.diff(padded, axis=1)
+        # the starts and (exclusive) ends of the groups, in row order
+        row, start = np.nonzero(step == 1)
+        _, end = np.nonzero(step == -1)
+        n_grp = np.bincount(row, minlength=nrow)
+        width = max(n_grp.max(), 1)
+        # the position of each group within its row
+        offset = np.concatenate([[0], np.cumsum(n_grp)[:-1]])
+        slot = np.arange(len(row)) - offset[row]
+        f_chan = np.zeros((nrow, width), dtype=np.int32)
+        n_chan = np.zeros((nrow, width), dtype=np.int32)
+        f_chan[row, slot] = start + first_channel
+        n_chan[row, slot] = end - start
+        values = matrix[mask].astype(np.float32)
+        rows = np.split(values, np.cumsum(mask.sum(axis=1))[:-1])
+        # a ragged object array even if all the rows have the same length
+        rows = np.array(rows + [None], dtype=object)[:-1]
+        s.add_array(values)
+
+    columns = [fits.Column('ENERG_LO', 'E', unit='keV', array=edges[:-1]),
+               fits.Column('ENERG_HI', 'E', unit='keV', array=edges[1:]),
+               fits.Column('N_GRP', 'I', array=n_grp),
+               fits.Column('F_CHAN', '{0}J'.format(width), array=f_chan),
+               fits.Column('N_CHAN', '{0}J'.format(width), array=n_chan),
+               fits.Column('MATRIX', 'PE()', array=rows)]
+    matrix_hdu = fits.BinTableHDU.from_columns(columns, name='MATRIX')
+    _header(matrix_hdu, instrument, HDUCLAS2='RSP_MATRIX', HDUCLAS3='REDIST',
+            HDUVERS='1.3.0', CHANTYPE='PI', DETCHANS=nchan,
+            LO_THRES=threshold, TLMIN4=first_channel,
+            TLMAX4=first_channel + nchan - 1)
+    columns = [fits.Column('CHANNEL', 'J',
+                           array=np.arange(nchan) + first_channel),
+               fits.Column('E_MIN', 'E', unit='keV', array=channels[:-1]),
+               fits.Column('E_MAX', 'E', unit='keV', array=channels[1:])]
+    ebounds_hdu = fits.BinTableHDU.from_columns(columns, name='EBOUNDS')
+    _header(ebounds_hdu, instrument, HDUCLAS2='EBOUNDS', HDUVERS='1.2.0',
+            CHANTYPE='PI', DETCHANS=nchan)
+    _write([matrix_hdu, ebounds_hdu], filename)
+
+
+def read_arf(filename):
+    """Read an ARF file.
+
+    The table is memory-mapped rather than read into memory.
+
+    Returns
+    -------
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the energy bins, assumed contiguous.
+    effective_area : `~astropy.units.Quantity` <cm2>
+        The effective area in each bin.
+    """
+    with fits.open(filename, memmap=True) as hdul:
+        data = hdul['SPECRESP'].data
+        lo = data['ENERG_LO']
+        edges = np.append(lo, data['ENERG_HI'][-1:]) * u.keV
+        area = u.Quantity(data['SPECRESP'], u.cm ** 2, copy=False)
+    return edges, area
+
+
+def _as_rows(column, nrow):
+    """The groups of a fixed or variable length column as a padded 2-D array."""
+    if column.dtype == object:
+        lengths = np.array([len(c) for c in column])
+        result = np.zeros((nrow, max(lengths.max(), 1)), dtype=np.int64)
+        result[np.arange(result.shape[1]) < lengths[:, np.newaxis]] = np.concatenate(column)
+        return result
+    return np.asarray(column).reshape(nrow, -1)
+
+
+def read_rmf(filename):
+    """Read an RMF file into a dense matrix.
+
+    The tables are memory-mapped and the matrix is expanded from the
+    compressed groups with array operations.
+
+    Returns
+    -------
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the photon energy bins.
+    channel_edges : `~astropy.units.Quantity` <keV>
+        The m + 1 edges of the channels.
+    matrix : `~numpy.ndarray`
+        The (n, m) redistribution matrix.
+    """
+    with fits.open(filename, memmap=True) as hdul:
+        matrix_hdu = hdul['MATRIX'] if 'MATRIX' in hdul else hdul['SPECRESP MATRIX']
+        data = matrix_hdu.data
+        ebounds = hdul['EBOUNDS'].data
+        energy_edges = np.append(data['ENERG_LO'], data['ENERG_HI'][-1:]) * u.keV
+        channel_edges = np.append(ebounds['E_MIN'], ebounds['E_MAX'][-1:]) * u.keV
+        nrow = len(data)
+        nchan = len(ebounds)
+        first_channel = matrix_hdu.header.get('TLMIN4', 1)
+
+        with stage('response.read_rmf') as s:
+            n_grp = np.asarray(data['N_GRP'])
+            f_chan = _as_rows(data['F_CHAN'], nrow)
+            n_chan = _as_rows(data['N_CHAN'], nrow)
+            used = np.arange(f_chan.shape[1]) < n_grp[:, np.newaxis]
+            group_row = np.nonzero(used)[0]
+            group_start = f_chan[used] - first_channel
+            group_length = n_chan[used]
+            values = np.concatenate(list(data['MATRIX']))
+            # the channel of every stored element
+            total = group_length.sum()
+            position = np.arange(total) - np.repeat(np.cumsum(group_length) - group_length,
+                                                    group_length)
+            matrix = np.zeros((nrow, nchan), dtype=np.float32)
+            matrix[np.repeat(group_row, group_length),
+                   np.repeat(group_start, group_length) + position] = values[:total]
+            s.add_array(matrix)
+    return energy_edges, channel_edges, matrix
+
+
+def _attenuation(material, energy):
+    """The linear attenuation coefficient (1 / mm) of a material."""
+    reference = 1 * u.micron
+    transmission = u.Quantity(Material(material, reference).transmission(energy)).value
+    return -np.log(np.clip(transmission, 1e-300, None)) / reference.to_value(u.mm)
+
+
+def _dsi_areas(energy_edges):
+    """The DSI effective area in each bin for every shutter state at once.
+
+    As in `~pyfoxsi.response.Response.bin_effective_area` the area is computed
+    on the tabulated energies and averaged over each bin.
+    """
+    edges = energy_edges.to_value(u.keV)
+    # the response without shutter times the transmission of every shutter
+    # thickness from a single attenuation coefficient
+    resp = DSIResponse(shutter_state=0)
+    table = resp._optic_effective_area.value * resp._calc_factor_from_optical_path()
+    thickness = pyfoxsi.shutter_thickness.to_value(u.mm)
+    attenuation = _attenuation(pyfoxsi.shutter_material, resp.energy)
+    table = table * np.exp(-thickness[:, np.newaxis] * attenuation[np.newaxis, :])
+    return _bin_average(edges[:-1], edges[1:], resp.energy.to_value(u.keV), table) * u.cm ** 2
+
+
+def _stc_areas(energy_edges):
+    """The STC effective area in each bin for every kind at once."""
+    edges = energy_edges.to_value(u.keV)
+    kinds = sorted(pyfoxsi.stc_aperture_area)
+    # the STC responses share their energies and detector
+    table_energy = STCResponse(kinds[0]).energy
+    absorption = u.Quantity(Material(pyfoxsi.stc_detector_material,
+                                     pyfoxsi.stc_detector_thickness).absorption(table_energy)).value
+    attenuation = _attenuation(pyfoxsi.stc_filter_material, table_energy)
+    thickness = u.Quantity([pyfoxsi.stc_filter_thickness[k] for k in kinds]).to_value(u.mm)
+    aperture = u.Quantity([pyfoxsi.stc_aperture_area[k] for k in kinds]).to_value(u.cm ** 2)
+    table = (aperture[:, np.newaxis] * absorption[np.newaxis, :] *
+             np.exp(-thickness[:, np.newaxis] * attenuation[np.newaxis, :]))
+    return kinds, _bin_average(edges[:-1], edges[1:], table_energy.to_value(u.keV),
+                               table) * u.cm ** 2
+
+
+def generate_response_set(directory, dsi_edges=dsi_energy_edges,
+                          stc_edges=stc_energy_edges):
+    """Write the ARF and RMF files of every FOXSI configuration.
+
+    One ARF is written per DSI shutter state and STC kind, and one RMF per
+    detector type, since the redistribution does not depend on the shutter
+    or filter. The areas of all shutter states (and of both STC kinds) are
+    computed in one array operation from a single attenuation coefficient
+    rather than from a response object per configuration.
+
+    Parameters
+    ----------
+    directory : str
+        The output directory.
+    dsi_edges, stc_edges : `~astropy.units.Quantity` <keV>
+        The energy bin edges of the DSI and STC responses, also used as the
+        channel edges.
+
+    Returns
+    -------
+    filenames : list of str
+        The files written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    with stage('response.generate_set'):
+        for state, area in enumerate(_dsi_areas(dsi_edges)):
+            filename = os.path.join(directory, 'foxsi_dsi_shutter{0}.arf'.format(state))
+            write_arf(filename, dsi_edges, area, instrument='DSI',
+                      filt='SHUTTER{0}'.format(state))
+            filenames.append(filename)
+        filename = os.path.join(directory, 'foxsi_dsi.rmf')
+        write_rmf(filename, dsi_edges, dsi_edges, instrument='DSI')
+        filenames.append(filename)
+
+        kinds, areas = _stc_areas(stc_edges)
+        for kind, area in zip(kinds, areas):
+            filename = os.path.join(directory, 'foxsi_stc_{0}.arf'.format(kind))
+            write_arf(filename, stc_edges, area, instrument='STC', filt=kind)
+            filenames.append(filename)
+        filename = os.path.join(directory, 'foxsi_stc.rmf')
+        write_rmf(filename, stc_edges, stc_edges, instrument='STC')
+        filenames.append(filename)
+    return filenames
+
+
+def load_response_set(directory):
+    """Read every ARF and RMF file in a directory.
+
+    Returns
+    -------
+    responses : dict
+        The result of `read_arf` or `read_rmf` keyed by the file name without
+        extension, e.g. 'foxsi_dsi_shutter0' or 'foxsi_dsi'.
+    """
+    responses = {}
+    for filename in sorted(glob.glob(os.path.join(directory, '*.arf'))):
+        responses[os.path.splitext(os.path.basename(filename))[0]] = read_arf(filename)
+    for filename in sorted(glob.glob(os.path.join(directory, '*.rmf'))):
+        responses[os.path.splitext(os.path.basename(filename))[0]] = read_rmf(filename)
+    return responses
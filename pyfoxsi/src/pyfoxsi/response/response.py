@@ -11,8 +11,11 @@ import matplotlib.pyplot as plt
 from scipy import interpolate
 
 import astropy.units as u
+import roentgen
 from roentgen.absorption import Material
 import pyfoxsi
+from pyfoxsi.profiling import stage, timed
+from pyfoxsi.cache import get_cache
 
 __all__ = ['dsi_background', 'DSIResponse', 'STCResponse']
 
@@ -25,6 +28,42 @@ def dsi_background(energy, in_hpd=True):
     return result * u.count / u.s / u.keV
 
 
+def _cumulative_trapezoid(x, y):
+    """The integral of the piecewise linear y(x) from x[0] to each x."""
+    result = np.zeros(np.shape(y))
+    result[..., 1:] = np.cumsum(0.5 * (y[..., 1:] + y[..., :-1]) * np.diff(x), axis=-1)
+    return result
+
+
+def _integral_to(x, xp, fp, cumulative):
+    """The integral of the piecewise linear fp(xp) from xp[0] to x."""
+    if np.any(x < xp[0]) or np.any(x > xp[-1]):
+        raise ValueError('Energies must be within {0} and {1} keV'.format(xp[0], xp[-1]))
+    i = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    dx = x - xp[i]
+    slope = (fp[..., i + 1] - fp[..., i]) / (xp[i + 1] - xp[i])
+    return cumulative[..., i] + fp[..., i] * dx + 0.5 * slope * dx ** 2
+
+
+def _bin_average(lo, hi, xp, fp, cumulative=None):
+    """The mean of the piecewise linear fp(xp) over the bins [lo, hi].
+
+    fp can have leading axes, e.g. one curve per configuration.
+    """
+    if cumulative is None:
+        cumulative = _cumulative_trapezoid(xp, fp)
+    lo = np.asarray(lo, dtype=float)
+    hi = np.asarray(hi, dtype=float)
+    width = hi - lo
+    integral = _integral_to(hi, xp, fp, cumulative) - _integral_to(lo, xp, fp, cumulative)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = integral / width
+    if np.any(width == 0):
+        point = np.array([np.interp(lo, xp, row) for row in np.reshape(fp, (-1, len(xp)))])
+        mean = np.where(width == 0, point.reshape(np.shape(mean)), mean)
+    return mean
+
+
 class Response(object):
     """A generic object to provide the response of a FOXSI instrument.
     """
@@ -39,6 +78,7 @@ class Response(object):
         self._optic_effective_area = u.Quantity(self.data['effective_area'],
                                                 'cm**2')
         self.optical_path = optical_path
+        self._cumulative = None
 
     def plot(self, energy=None, axes=None, color=None):
         """Plot the effective area"""
@@ -58,6 +98,7 @@ class Response(object):
     def energy(self):
         return self._energies
 
+    @timed('response.effective_area')
     def effective_area(self, energy):
         """Given an energy return the effective area."""
         factor = self._calc_factor_from_optical_path()
@@ -66,16 +107,65 @@ class Response(object):
                                  effarea)
         return f(energy) * u.cm ** 2
 
+    def _area_integral(self):
+        """The tabulated area and its cumulative integral, computed once."""
+        if self._cumulative is None:
+            factor = self._calc_factor_from_optical_path()
+            energy = self._energies.to_value('keV')
+            area = self._optic_effective_area.value * factor
+            self._cumulative = (energy, area, _cumulative_trapezoid(energy, area))
+        return self._cumulative
+
+    def bin_effective_area(self, energy_edges):
+        """The effective area averaged over each of a set of energy bins.
+
+        The mean is the exact integral of the linearly interpolated area (as
+        used by `effective_area`) over each bin divided by its width. It is
+        found from the cumulative integral of the tabulated area, which is
+        computed once, so any number of bins of any width cost one
+        `~numpy.searchsorted` lookup.
+
+        Parameters
+        ----------
+        energy_edges : `~astropy.units.Quantity` or array_like (keV)
+            The n + 1 edges of n bins, or an (n, 2) array of (lower, upper)
+            band edges.
+
+        Returns
+        -------
+        area : `~astropy.units.Quantity` <cm2>
+            The mean area in each bin. Zero width bins give the area at that
+            energy.
+        """
+        edges = u.Quantity(energy_edges, u.keV).value
+        energy, area, cumulative = self._area_integral()
+        if edges.ndim == 2:
+            lo, hi = edges[:, 0], edges[:, 1]
+        else:
+            lo, hi = edges[:-1], edges[1:]
+        return _bin_average(lo, hi, energy, area, cumulative) * u.cm ** 2
+
+    @timed('response.optical_path_factor')
     def _calc_factor_from_optical_path(self):
         """Calculate the effect of material on the optical path."""
+        cache = get_cache()
+        if cache is not None:
+            key = cache.make_key('optical_path_factor', self._energies,
+                                 [(mat.name, mat.thickness) for mat in self.optical_path],
+                                 roentgen.__version__)
+            factor = cache.get(key, mmap=False)
+            if factor is not None:
+                return factor
         factor = np.ones_like(self._energies.value)
         # Apply all of the materials in the optical path to factor
         for mat in self.optical_path:
             if mat.name.count('Cadmium Telluride') or mat.name.count('Silicon'):  # should not hard code
                 # if it is the detector than we want the absorption
-                factor *= mat.absorption(self._energies).value
+                factor *= u.Quantity(mat.absorption(self._energies)).value
             else:
-                factor *= mat.transmission(self._energies).value
+                factor *= u.Quantity(mat.transmission(self._energies)).value
+        if cache is not None:
+            cache.set(key, factor)
         return factor
 
 
@@ -97,17 +187,19 @@ class STCResponse(Response):
     """
     def __init__(self, kind='Q'):
 
-        energies = np.arange(0.2, 20, 0.1)
+        # the roentgen attenuation tables start at 1 keV
+        energies = np.arange(1., 20, 0.1)
 
         if (kind != 'Q') and (kind != 'F'):
             raise ValueError('Not a valid STC kind. Must be Q or F')
 
-        # add the detector to the path
-        optical_path = []
-        optical_path.append(Material(pyfoxsi.stc_detector_material, pyfoxsi.stc_detector_thickness))
-        # add the kind specific filter to the path
-        optical_path.append(Material(pyfoxsi.stc_filter_material,
-                                     pyfoxsi.stc_filter_thickness.get(kind)))
+        with stage('response.materials'):
+            # add the detector to the path
+            optical_path = []
+            optical_path.append(Material(pyfoxsi.stc_detector_material, pyfoxsi.stc_detector_thickness))
+            # add the kind specific filter to the path
+            optical_path.append(Material(pyfoxsi.stc_filter_material,
+                                         pyfoxsi.stc_filter_thickness.get(kind)))
         effective_area = np.ones_like(energies) * pyfoxsi.stc_aperture_area.get(kind)
 
         super().__init__(energies * u.keV, effective_area, optical_path)
@@ -143,17 +235,20 @@ class DSIResponse(Response):
         path = os.path.join(path, 'data/')
         filename = 'effective_area_per_module.csv'
         effarea_file = os.path.join(path, filename)
-        data = pd.read_csv(effarea_file, index_col=0, skiprows=4)
+        with stage('response.load_data') as s:
+            data = pd.read_csv(effarea_file, index_col=0, skiprows=4)
+            s.add_array(data.values)
         energy = u.Quantity(data.index, u.keV)
         effective_area = data['effective_area'].values * u.cm ** 2
-        # the default optical path
-        optical_path = [Material(pyfoxsi.blanket_material, pyfoxsi.blanket_thickness),
-                        Material(pyfoxsi.detector_material, pyfoxsi.detector_thickness)]
-        if (shutter_state >= 0) and (shutter_state < len(pyfoxsi.shutter_thickness)):
-            optical_path.append(Material(pyfoxsi.shutter_material, pyfoxsi.shutter_thickness[shutter_state]))
-            self.__shutter_state = shutter_state
-        else:
-            raise ValueError('Not a valid shutter state, must be 0 to {0}'.format(len(pyfoxsi.shutter_thickness)))
+        with stage('response.materials'):
+            # the default optical path
+            optical_path = [Material(pyfoxsi.blanket_material, pyfoxsi.blanket_thickness),
+                            Material(pyfoxsi.detector_material, pyfoxsi.detector_thickness)]
+            if (shutter_state >= 0) and (shutter_state < len(pyfoxsi.shutter_thickness)):
+                optical_path.append(Material(pyfoxsi.shutter_material, pyfoxsi.shutter_thickness[shutter_state]))
+                self.__shutter_state = shutter_state
+            else:
+                raise ValueError('Not a valid shutter state, must be 0 to {0}'.format(len(pyfoxsi.shutter_thickness)))
         super().__init__(energy, effective_area, optical_path)
         self.__number_of_telescopes = number_of_telescopes
         self._optic_effective_area = u.Quantity(self.data['effective_area'], 'cm**2') * self.number_of_telescopes
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+
+import pyfoxsi
+from pyfoxsi.response import (DSIResponse, STCResponse, redistribution_matrix,
+                              write_arf, write_rmf, read_arf, read_rmf,
+                              generate_response_set, load_response_set)
+
+
+def test_arf_round_trip(tmpdir):
+    filename = str(tmpdir.join('test.arf'))
+    edges = np.linspace(4, 20, 33) * u.keV
+    area = np.linspace(1, 2, 32) * u.cm ** 2
+    write_arf(filename, edges, area, instrument='DSI', filt='SHUTTER2')
+    read_edges, read_area = read_arf(filename)
+    np.testing.assert_allclose(read_edges, edges, rtol=1e-7)
+    np.testing.assert_allclose(read_area, area, rtol=1e-7)
+    assert not os.path.exists(filename + '.part')
+    header = fits.getheader(filename, 'SPECRESP')
+    assert header['TELESCOP'] == pyfoxsi.mission_title
+    assert header['INSTRUME'] == 'DSI'
+    assert header['FILTER'] == 'SHUTTER2'
+    assert (header['HDUCLASS'], header['HDUCLAS1'], header['HDUCLAS2']) == \
+        ('OGIP', 'RESPONSE', 'SPECRESP')
+    assert header['TUNIT3'] == 'cm**2'
+
+
+def test_redistribution_matrix():
+    edges = np.arange(4, 20.05, 0.1) * u.keV
+    matrix = redistribution_matrix(edges, edges, 0.8 * u.keV)
+    # rows away from the ends keep all of their photons
+    np.testing.assert_allclose(matrix[20:-20].sum(axis=1), 1., rtol=1e-6)
+    assert np.all(matrix.argmax(axis=1) == np.arange(len(edges) - 1))
+    np.testing.assert_array_equal(redistribution_matrix(edges, edges, 0 * u.keV),
+                                  np.eye(len(edges) - 1))
+
+
+@pytest.mark.parametrize('first_channel', [0, 1])
+def test_rmf_round_trip(tmpdir, first_channel):
+    filename = str(tmpdir.join('test.rmf'))
+    edges = np.arange(4, 20.05, 0.2) * u.keV
+    channels = np.arange(3, 21.05, 0.5) * u.keV
+    matrix = redistribution_matrix(edges, channels, 0.8 * u.keV)
+    # a row with two groups of channels
+    matrix[5, 4] = 0.
+    write_rmf(filename, edges, channels, matrix, threshold=1e-4,
+              first_channel=first_channel)
+    read_edges, read_channels, read_matrix = read_rmf(filename)
+    np.testing.assert_allclose(read_edges, edges, rtol=1e-7)
+    np.testing.assert_allclose(read_channels, channels, rtol=1e-7)
+    expected = np.where(matrix > 1e-4, matrix, 0.)
+    np.testing.assert_allclose(read_matrix, expected, rtol=1e-7, atol=0)
+    with fits.open(filename) as hdul:
+        header = hdul['MATRIX'].header
+        assert header['HDUCLAS3'] == 'REDIST'
+        assert header['DETCHANS'] == len(channels) - 1
+        assert header['TLMIN4'] == first_channel
+        assert header['LO_THRES'] == 1e-4
+        assert hdul['MATRIX'].data['N_GRP'][5] == 2
+        assert hdul['EBOUNDS'].data['CHANNEL'][0] == first_channel
+
+
+def test_response_set_matches_the_responses(tmpdir):
+    directory = str(tmpdir.join('responses'))
+    dsi_edges = np.arange(4., 30.05, 0.5) * u.keV
+    stc_edges = np.arange(2., 15.05, 0.5) * u.keV
+    filenames = generate_response_set(directory, dsi_edges=dsi_edges, stc_edges=stc_edges)
+    assert len(filenames) == len(pyfoxsi.shutter_thickness) + len(pyfoxsi.stc_aperture_area) + 2
+    responses = load_response_set(directory)
+    for state in range(len(pyfoxsi.shutter_thickness)):
+        edges, area = responses['foxsi_dsi_shutter{0}'.format(state)]
+        expected = DSIResponse(shutter_state=state).bin_effective_area(dsi_edges)
+        np.testing.assert_allclose(area, expected, rtol=1e-6, atol=1e-30 * u.cm ** 2)
+    for kind in pyfoxsi.stc_aperture_area:
+        edges, area = responses['foxsi_stc_{0}'.format(kind)]
+        np.testing.assert_allclose(area, STCResponse(kind).bin_effective_area(stc_edges),
+                                   rtol=1e-6)
+    energy_edges, channel_edges, matrix = responses['foxsi_dsi']
+    assert matrix.shape == (len(dsi_edges) - 1,) * 2
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from scipy.integrate import trapezoid
+
+from pyfoxsi.response import DSIResponse, STCResponse
+
+
+@pytest.fixture(scope='module', params=['dsi', 'stc'])
+def response(request):
+    if request.param == 'dsi':
+        return DSIResponse(shutter_state=1)
+    return STCResponse('Q')
+
+
+def _numerical_average(response, lo, hi, samples=20001):
+    energy = np.linspace(lo, hi, samples)
+    area = response.effective_area(energy).to_value(u.cm ** 2)
+    return trapezoid(area, energy) / (hi - lo)
+
+
+def test_bin_effective_area_is_the_mean_over_the_bin(response):
+    # bins narrower and wider than the table, not aligned with it
+    edges = np.array([4.03, 4.07, 5.51, 9.99, 15.])
+    result = response.bin_effective_area(edges * u.keV).to_value(u.cm ** 2)
+    expected = [_numerical_average(response, lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+
+def test_bin_effective_area_of_bands_and_points(response):
+    edges = [5., 6., 8., 12.] * u.keV
+    bands = np.column_stack([edges[:-1], edges[1:]])
+    np.testing.assert_allclose(response.bin_effective_area(bands),
+                               response.bin_effective_area(edges))
+    point = response.bin_effective_area([[7.3, 7.3]] * u.keV)
+    np.testing.assert_allclose(point, response.effective_area(7.3))
@@ -0,0 +1,201 @@
+"""
+Sensitivity is a module to calculate the faintest sources FOXSI can detect
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+from scipy import stats, special
+
+from pyfoxsi.response import DSIResponse, dsi_background
+from pyfoxsi.profiling import stage
+
+__all__ = ['SensitivityGrid', 'minimum_detectable_flux', 'required_counts']
+
+# the angular size of the half power diameter of the DSI optics and the
+# field of view over which dsi_background is given
+hpd = 25 * u.arcsec
+field_of_view = 9 * u.arcmin
+
+_responses = {}
+
+
+class SensitivityGrid(object):
+    """A labelled N-dimensional array of sensitivities.
+
+    Parameters
+    ----------
+    values : `~astropy.units.Quantity`
+        The values on the grid.
+    dims : tuple of str
+        The name of each axis.
+    coords : dict
+        The coordinate values along each axis, keyed by name.
+    """
+    def __init__(self, values, dims, coords):
+        self.values = values
+        self.dims = tuple(dims)
+        self.coords = coords
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def sel(self, **kwargs):
+        """Select by coordinate value along one or more axes.
+
+        The nearest coordinate value is used. Selected axes are dropped.
+
+        Examples
+        --------
+        >>> grid.sel(shutter=0, size=10 * u.arcsec)  # doctest: +SKIP
+        """
+        index = [slice(None)] * len(self.dims)
+        dims = list(self.dims)
+        coords = dict(self.coords)
+        for name, value in kwargs.items():
+            axis = self.dims.index(name)
+            coord = coords.pop(name)
+            if isinstance(coord, u.Quantity):
+                value = u.Quantity(value, coord.unit).value
+                coord = coord.value
+            coord = np.asarray(coord)
+            if coord.ndim > 1:
+                # energy bands are selected by their centre
+                coord = coord.mean(axis=-1)
+            index[axis] = int(np.argmin(np.abs(coord - value)))
+            dims.remove(name)
+        return SensitivityGrid(self.values[tuple(index)], dims, coords)
+
+    def __repr__(self):
+        return '<SensitivityGrid {0} {1} [{2}]>'.format(
+            dict(zip(self.dims, self.shape)), self.values.unit, self.dims)
+
+
+def _get_response(shutter_state):
+    resp = _responses.get(shutter_state)
+    if resp is None:
+        resp = DSIResponse(shutter_state=shutter_state)
+        _responses[shutter_state] = resp
+    return resp
+
+
+def required_counts(background, significance=3., detection_probability=0.5,
+                    method='poisson'):
+    """The expected source counts needed for a detection.
+
+    Parameters
+    ----------
+    background : array_like
+        The expected background counts in the source region.
+    significance : float
+        The significance in Gaussian sigma. With the Poisson method it sets
+        the false alarm probability, the one sided Gaussian tail beyond it.
+    detection_probability : float
+        With the Poisson method, the probability that a source of the
+        returned strength exceeds the detection threshold.
+    method : str
+        'poisson' uses exact Poisson statistics, valid for few counts.
+        'gaussian' requires S / sqrt(S + B) = significance.
+
+    Returns
+    -------
+    counts : `~numpy.ndarray`
+        The expected source counts.
+    """
+    background = np.asarray(background, dtype=float)
+    if method == 'gaussian':
+        n2 = significance ** 2
+        return 0.5 * (n2 + np.sqrt(n2 ** 2 + 4 * n2 * background))
+    elif method == 'poisson':
+        false_alarm = stats.norm.sf(significance)
+        # the smallest number of counts which background alone exceeds
+        # with at most the false alarm probability
+        threshold = stats.poisson.isf(false_alarm, background) + 1
+        # P(N >= n | mu) is the regularized lower incomplete gamma function
+        total = special.gammaincinv(threshold, detection_probability)
+        return np.clip(total - background, 0., None)
+    raise ValueError('Not a valid method. Must be poisson or gaussian')
+
+
+def minimum_detectable_flux(energy_band, integration_time, source_size=0 * u.arcsec,
+                            shutter_state=0, significance=3.,
+                            detection_probability=0.5, method='poisson',
+                            encircled_fraction=0.5, samples=32):
+    """The minimum detectable flux of the DSI telescopes over a grid.
+
+    The whole grid of energy band x integration time x source size x shutter
+    state is computed in one broadcast calculation. The source is counted
+    within a circle of diameter sqrt(hpd^2 + size^2) which is assumed to hold
+    encircled_fraction of its counts and in which the background is given by
+    `~pyfoxsi.response.dsi_background` scaled by area.
+
+    Parameters
+    ----------
+    energy_band : `~astropy.units.Quantity` <keV>
+        The (lower, upper) edges of one band or an array of shape (n, 2).
+    integration_time : `~astropy.units.Quantity` <s>
+        One or more integration times.
+    source_size : `~astropy.units.Quantity` <arcsec>
+        One or more source diameters.
+    shutter_state : int or list of int
+        One or more shutter states.
+    significance, detection_probability, method
+        The detection criterion, see `required_counts`.
+    encircled_fraction : float
+        The fraction of the source counts inside the source region.
+    samples : int
+        The number of energies at which the background is averaged per band.
+        The effective area is averaged exactly.
+
+    Returns
+    -------
+    grid : `SensitivityGrid`
+        The minimum detectable photon flux density (ph / cm2 / s / keV),
+        assumed flat over each band, with dimensions
+        ('energy', 'time', 'size', 'shutter').
+
+    Examples
+    --------
+    >>> bands = [[4, 6], [6, 10], [10, 20]] * u.keV
+    >>> grid = minimum_detectable_flux(bands, np.logspace(0, 4, 20) * u.s,
+    ...                                [0, 10, 60] * u.arcsec,
+    ...                                shutter_state=[0, 1, 2])  # doctest: +SKIP
+    """
+    band = np.atleast_2d(u.Quantity(energy_band, u.keV).value)
+    time = np.atleast_1d(u.Quantity(integration_time, u.s).value)
+    size = np.atleast_1d(u.Quantity(source_size, u.arcsec).value)
+    shutter = np.atleast_1d(shutter_state)
+
+    with stage('sensitivity.response') as s:
+        # the background is averaged over the centres of equal sub-bands
+        frac = (np.arange(samples) + 0.5) / samples
+        energy = band[:, :1] + frac * (band[:, 1:] - band[:, :1])
+        width = band[:, 1] - band[:, 0]
+        area = np.array([_get_response(int(state)).bin_effective_area(band).to_value('cm2')
+                         for state in shutter]).T
+        background = dsi_background(energy * u.keV, in_hpd=False).value.mean(axis=-1) * width
+        s.add_array(area)
+
+    with stage('sensitivity.grid') as s:
+        # axes are (energy, time, size, shutter)
+        area = area[:, np.newaxis, np.newaxis, :]
+        width = width[:, np.newaxis, np.newaxis, np.newaxis]
+        time = time[np.newaxis, :, np.newaxis, np.newaxis]
+        diameter2 = hpd.to_value(u.arcsec) ** 2 + size ** 2
+        region = np.pi / 4. * diameter2 / field_of_view.to_value(u.arcsec) ** 2
+        region = region[np.newaxis, np.newaxis, :, np.newaxis]
+        bkg_counts = background[:, np.newaxis, np.newaxis, np.newaxis] * region * time
+        bkg_counts = np.broadcast_to(bkg_counts, np.broadcast(bkg_counts, area).shape)
+        counts = required_counts(bkg_counts, significance=significance,
+                                 detection_probability=detection_probability,
+                                 method=method)
+        with np.errstate(divide='ignore'):
+            flux = counts / (encircled_fraction * area * width * time)
+        s.add_array(flux)
+
+    coords = {'energy': band * u.keV, 'time': time.ravel() * u.s,
+              'size': size * u.arcsec, 'shutter': shutter}
+    return SensitivityGrid(flux * u.ph / u.cm ** 2 / u.s / u.keV,
+                           ('energy', 'time', 'size', 'shutter'), coords)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from scipy import stats
+
+from pyfoxsi.response import DSIResponse, dsi_background
+from pyfoxsi.sensitivity import minimum_detectable_flux, required_counts
+from pyfoxsi.sensitivity.sensitivity import hpd, field_of_view
+
+background = np.array([0., 0.1, 1., 7.5, 30., 400.])
+
+
+def test_poisson_counts_meet_the_criterion():
+    significance, probability = 3., 0.9
+    false_alarm = stats.norm.sf(significance)
+    counts = required_counts(background, significance, probability)
+    for b, s in zip(background, counts):
+        # the smallest threshold which the background alone exceeds rarely
+        n = 0
+        while stats.poisson.sf(n - 1, b) > false_alarm:
+            n += 1
+        assert stats.poisson.sf(n - 2, b) > false_alarm
+        # the source plus background reach it with the detection probability
+        assert stats.poisson.sf(n - 1, b + s) == pytest.approx(probability)
+
+
+def test_gaussian_counts_meet_the_criterion():
+    counts = required_counts(background, 5., method='gaussian')
+    np.testing.assert_allclose(counts / np.sqrt(counts + background), 5.)
+    with pytest.raises(ValueError):
+        required_counts(background, method='bayes')
+
+
+def test_poisson_approaches_gaussian_for_large_background():
+    counts = required_counts(1e6, 3., 0.5)
+    assert counts == pytest.approx(required_counts(1e6, 3., method='gaussian'), rel=1e-2)
+
+
+def test_minimum_detectable_flux_grid():
+    bands = [[4, 6], [10, 20]] * u.keV
+    times = [10, 1000] * u.s
+    grid = minimum_detectable_flux(bands, times, [0, 60] * u.arcsec, shutter_state=[0, 1])
+    assert grid.dims == ('energy', 'time', 'size', 'shutter')
+    assert grid.shape == (2, 2, 2, 2)
+    assert grid.values.unit == u.ph / u.cm ** 2 / u.s / u.keV
+    # longer integrations, smaller sources and no shutter are more sensitive
+    assert np.all(np.diff(grid.values, axis=1) < 0)
+    assert np.all(np.diff(grid.values, axis=2) > 0)
+    assert np.all(np.diff(grid.values, axis=3) > 0)
+
+    # one point computed by hand
+    flux = grid.sel(energy=15 * u.keV, time=1000 * u.s, size=60 * u.arcsec, shutter=1)
+    area = DSIResponse(shutter_state=1).bin_effective_area([10, 20] * u.keV)[0]
+    energy = 10 + (np.arange(32) + 0.5) / 32 * 10
+    bkg = dsi_background(energy * u.keV, in_hpd=False).value.mean() * 10
+    region = np.pi / 4 * ((hpd ** 2 + (60 * u.arcsec) ** 2) / field_of_view ** 2).decompose()
+    counts = required_counts(bkg * region * 1000)
+    expected = counts / (0.5 * area.to_value(u.cm ** 2) * 10 * 1000)
+    assert flux.values.value == pytest.approx(expected)
@@ -0,0 +1,653 @@
+"""
+Server is a module to run pyfoxsi as a long lived local service
+
+Short simulation jobs spend most of their time importing pyfoxsi, reading
+the data files and building responses and psf kernels. A server does this
+once and keeps the results in memory, and jobs send it requests through the
+thin `Client` instead.
+
+Requests and replies are JSON objects, one per line, on a Unix socket or a
+localhost TCP connection. Arrays are sent as base64 encoded bytes with their
+dtype and shape. Requests which arrive within a short window of each other
+and can be computed together (e.g. effective areas of the same response, or
+convolutions of images of the same shape and scale) are merged into one
+vectorized call.
+
+Examples
+--------
+Start the server from the command line::
+
+    pyfoxsi serve --address /tmp/pyfoxsi.sock
+
+and send it requests from any number of jobs
+
+>>> from pyfoxsi.server import Client
+>>> with Client('/tmp/pyfoxsi.sock') as client:  # doctest: +SKIP
+...     area = client.effective_area([10, 20, 30] * u.keV)
+"""
+
+from __future__ import absolute_import
+import os
+import json
+import stat
+import base64
+import socket
+import logging
+import threading
+import ipaddress
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import astropy.units as u
+
+from pyfoxsi.profiling import stage
+
+__all__ = ['default_address', 'parse_address', 'SimulationServer', 'serve',
+           'Client']
+
+log = logging.getLogger(__name__)
+
+default_address = 'localhost:7625'
+
+
+def parse_address(address):
+    """Return the socket family and address of a server address.
+
+    Parameters
+    ----------
+    address : str
+        A path to a Unix socket (containing a /) or host:port.
+
+    Returns
+    -------
+    family : int
+        `socket.AF_UNIX` or `socket.AF_INET`.
+    address : str or tuple
+        The socket path or the (host, port) pair.
+    """
+    if '/' in address or not address.rpartition(':')[2].isdigit():
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix sockets are not available, use host:port')
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (socket.error, ValueError):
+        return False
+
+
+def _remove_stale_socket(path):
+    """Remove a Unix socket left behind by a server which did not shut down.
+
+    Raises
+    ------
+    OSError
+        If the path is not a socket or a server is still listening on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError('{0} exists and is not a socket'.format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise OSError('A server is already listening on {0}'.format(path))
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def _encode_array(array):
+    array = np.ascontiguousarray(array)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape),
+            'data': base64.b64encode(array.data).decode('ascii')}
+
+
+def _decode_array(obj):
+    if isinstance(obj, dict):
+        array = np.frombuffer(base64.b64decode(obj['data']), dtype=obj['dtype'])
+        return array.reshape(obj['shape'])
+    return np.asarray(obj, dtype=float)
+
+
+def _encode(obj):
+    """Replace the arrays in a reply by their encoding."""
+    if isinstance(obj, u.Quantity):
+        return _encode(obj.value)
+    if isinstance(obj, np.ndarray):
+        return _encode_array(obj)
+    if isinstance(obj, dict):
+        return dict((k, _encode(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _bands(params):
+    """The (n, 2) energy bands (keV) of a bin_effective_area request."""
+    edges = _decode_array(params['energy_edges'])
+    if edges.ndim == 1:
+        edges = np.column_stack([edges[:-1], edges[1:]])
+    return edges
+
+
+class SimulationServer(object):
+    """A server which keeps the pyfoxsi products warm between requests.
+
+    Each connection is served by its own thread, but the requests are
+    computed by a single worker thread. The worker takes the next request,
+    waits batch_window for more and computes every group of compatible
+    requests in one call. Simulations of whole files are run by a separate
+    pool of simulate_workers threads so that they do not hold up the quick
+    requests. Responses, psf transfer functions and the psf and response
+    caches of `pyfoxsi.batch` stay in memory for the life of the server.
+    Requests which have not started when the server stops fail with an
+    error.
+
+    A TCP server only listens on a loopback address, as the requests name
+    files which the server reads and writes.
+
+    The methods are
+
+    ``ping``
+        Returns the process id and the number of requests served.
+    ``effective_area``
+        energy (keV), instrument ('dsi' or 'stc'), shutter_state, kind.
+    ``bin_effective_area``
+        energy_edges (keV), as n + 1 edges or (n, 2) bands, and the
+        parameters of ``effective_area``.
+    ``convolve``
+        data, scale (arcsec / pixel), wings, energy (keV) and precision.
+        The image is convolved with the psf through its transfer function
+        (see `~pyfoxsi.psf.psf_otf`) with half the image size of padding.
+    ``simulate``
+        input, output and the keywords of `~pyfoxsi.batch.simulate_file`.
+    ``shutdown``
+        Stops the server.
+
+    Parameters
+    ----------
+    address : str
+        A path to a Unix socket or host:port, see `parse_address`.
+    batch_window : float
+        How long (s) to wait for compatible requests before computing.
+    max_batch : int
+        The largest number of requests computed together.
+    simulate_workers : int
+        The number of simulations run at once.
+    """
+    def __init__(self, address=default_address, batch_window=0.005,
+                 max_batch=64, simulate_workers=1):
+        self.address = address
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests_served = 0
+        self._responses = {}
+        self._otfs = OrderedDict()
+        self._max_otfs = 32
+        self._queue = []
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._methods = {
+            'ping': (None, self._ping),
+            'effective_area': (self._response_key, self._effective_area),
+            'bin_effective_area': (self._response_key, self._bin_effective_area),
+            'convolve': (self._convolve_key, self._convolve),
+            'simulate': (None, self._simulate),
+            'shutdown': (None, self._shutdown),
+        }
+        # the methods run by the executor rather than the batching worker
+        self._slow_methods = {'simulate'}
+        self._executor = ThreadPoolExecutor(max_workers=simulate_workers,
+                                            thread_name_prefix='pyfoxsi-simulate')
+
+        family, sock_address = parse_address(address)
+        self._socket_id = None
+        if family == socket.AF_INET:
+            if not _is_loopback(sock_address[0]):
+                raise ValueError('The server can only listen on a loopback address')
+            self._server = _TCPServer(sock_address, self._handler_class())
+        else:
+            _remove_stale_socket(sock_address)
+            self._server = _UnixServer(sock_address, self._handler_class())
+            info = os.stat(sock_address)
+            self._socket_id = (info.st_dev, info.st_ino)
+        self._worker = threading.Thread(target=self._work, name='pyfoxsi-server')
+        self._worker.daemon = True
+
+    def warm(self, shutter_states=(0,), stc_kinds=()):
+        """Build the responses which will be requested before serving.
+
+        Parameters
+        ----------
+        shutter_states : list of int
+            The DSI shutter states.
+        stc_kinds : list of str
+            The STC detectors, 'Q' or 'F'.
+        """
+        with stage('server.warm'):
+            # the psf and batch modules import sunpy
+            import pyfoxsi.batch
+            for shutter_state in shutter_states:
+                self._response({'instrument': 'dsi', 'shutter_state': shutter_state})
+            for kind in stc_kinds:
+                self._response({'instrument': 'stc', 'kind': kind})
+
+    def serve_forever(self):
+        """Serve requests until a shutdown request or `shutdown`."""
+        self._worker.start()
+        log.info('pyfoxsi server listening on %s', self.address)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop()
+            self._server.server_close()
+            if self._socket_id is not None:
+                self._remove_socket()
+
+    def _stop(self):
+        """Stop the workers and fail the requests which have not started."""
+        with self._condition:
+            self._stopping.set()
+            self._condition.notify()
+        if self._worker.is_alive():
+            self._worker.join()
+        with self._condition:
+            pending = self._queue
+            self._queue = []
+        for _, future in pending:
+            future.set_exception(RuntimeError('The server is shutting down'))
+        # simulations which have started are completed, the rest cancelled
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _remove_socket(self):
+        """Remove the socket file, unless another server has replaced it."""
+        path = self._server.server_address
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return
+        if (info.st_dev, info.st_ino) == self._socket_id:
+            os.remove(path)
+
+    def shutdown(self):
+        """Stop serving. Must be called from another thread."""
+        self._server.shutdown()
+
+    def submit(self, request):
+        """Queue a request and return a `~concurrent.futures.Future` of its result."""
+        future = Future()
+        method = request.get('method')
+        if method not in self._methods:
+            future.set_exception(ValueError('Unknown method {0}'.format(method)))
+            return future
+        with self._condition:
+            if self._stopping.is_set():
+                future.set_exception(RuntimeError('The server is shutting down'))
+            elif method in self._slow_methods:
+                return self._executor.submit(self._run_one, method,
+                                             request.get('params', {}))
+            else:
+                self._queue.append((request, future))
+                self._condition.notify()
+        return future
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = {}
+                    request = {}
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                        reply['id'] = request.get('id')
+                        reply['result'] = _encode(server.submit(request).result())
+                    except Exception as e:
+                        reply['error'] = '{0}: {1}'.format(type(e).__name__, e)
+                    self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+                    if request.get('method') == 'shutdown':
+                        # only once the reply is sent
+                        threading.Thread(target=server.shutdown).start()
+                        return
+
+        return Handler
+
+    def _take_batch(self):
+        """Wait for requests and return the queued ones, at most max_batch."""
+        with self._condition:
+            while not self._queue and not self._stopping.is_set():
+                self._condition.wait()
+        # let concurrent compatible requests arrive
+        if self._stopping.wait(self.batch_window):
+            return []
+        with self._condition:
+            batch = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+        return batch
+
+    def _work(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            groups = OrderedDict()
+            for request, future in batch:
+                key_func, _ = self._methods[request['method']]
+                params = request.get('params', {})
+                try:
+                    key = None if key_func is None else key_func(params)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                # requests which cannot be merged get a group of their own
+                key = (request['method'], key if key is not None else id(future))
+                groups.setdefault(key, []).append((params, future))
+            for (method, _), members in groups.items():
+                self._run(method, members)
+
+    def _run(self, method, members):
+        _, func = self._methods[method]
+        with stage('server.' + method):
+            try:
+                results = func([params for params, _ in members])
+            except Exception as e:
+                if len(members) == 1:
+                    members[0][1].set_exception(e)
+                    return
+                # find the request at fault by computing them one by one
+                for member in members:
+                    self._run(method, [member])
+                return
+        for (_, future), result in zip(members, results):
+            future.set_result(result)
+        with self._condition:
+            self.requests_served += len(members)
+
+    def _run_one(self, method, params):
+        """Compute a single request which is not batched."""
+        _, func = self._methods[method]
+        with stage('server.' + method):
+            result = func([params])[0]
+        with self._condition:
+            self.requests_served += 1
+        return result
+
+    def _ping(self, params):
+        return [{'pid': os.getpid(), 'requests_served': self.requests_served}
+                for _ in params]
+
+    def _shutdown(self, params):
+        # the connection handler stops the server after replying
+        return [True for _ in params]
+
+    @staticmethod
+    def _response_key(params):
+        instrument = params.get('instrument', 'dsi')
+        if instrument == 'dsi':
+            return instrument, int(params.get('shutter_state', 0))
+        if instrument == 'stc':
+            return instrument, params.get('kind', 'Q')
+        raise ValueError('Not a valid instrument. Must be dsi or stc')
+
+    def _response(self, params):
+        key = self._response_key(params)
+        resp = self._responses.get(key)
+        if resp is None:
+            from pyfoxsi.response import DSIResponse, STCResponse
+            if key[0] == 'dsi':
+                resp = DSIResponse(shutter_state=key[1])
+            else:
+                resp = STCResponse(kind=key[1])
+            self._responses[key] = resp
+        return resp
+
+    def _effective_area(self, params):
+        energies = [np.atleast_1d(_decode_array(p['energy'])) for p in params]
+        area = self._response(params[0]).effective_area(np.concatenate(energies))
+        return np.split(area.to_value(u.cm ** 2), np.cumsum([len(e) for e in energies])[:-1])
+
+    def _bin_effective_area(self, params):
+        bands = [_bands(p) for p in params]
+        area = self._response(params[0]).bin_effective_area(np.concatenate(bands))
+        return np.split(area.to_value(u.cm ** 2), np.cumsum([len(b) for b in bands])[:-1])
+
+    @staticmethod
+    def _convolve_key(params):
+        from pyfoxsi.psf import get_dtype
+        shape = tuple(_decode_array(params['data']).shape)
+        if len(shape) != 2:
+            raise ValueError('Only 2-D images can be convolved')
+        energy = params.get('energy')
+        return (shape, float(params.get('scale', 1.)), bool(params.get('wings', False)),
+                None if energy is None else float(energy),
+                get_dtype(params.get('precision')).name)
+
+    def _otf(self, shape, scale, wings, energy, precision):
+        """The psf transfer function, remembering the most recent ones."""
+        from pyfoxsi.psf import psf_otf
+        key = (shape, scale, wings, energy, precision)
+        otf = self._otfs.pop(key, None)
+        if otf is None:
+            otf = psf_otf(shape, scale=scale * u.arcsec / u.pix, wings=wings,
+                          energy=None if energy is None else energy * u.keV,
+                          precision=precision)
+            if len(self._otfs) >= self._max_otfs:
+                self._otfs.popitem(last=False)
+        self._otfs[key] = otf
+        return otf
+
+    def _convolve(self, params):
+        from scipy import fft
+        (ny, nx), scale, wings, energy, precision = self._convolve_key(params[0])
+        shape = (fft.next_fast_len(ny + ny // 2, real=True),
+                 fft.next_fast_len(nx + nx // 2, real=True))
+        otf = self._otf(shape, scale, wings, energy, precision)
+        stack = np.stack([_decode_array(p['data']) for p in params]).astype(otf.dtype, copy=False)
+        result = fft.irfft2(fft.rfft2(stack, s=shape, workers=-1) * otf,
+                            s=shape, workers=-1)[:, :ny, :nx]
+        return list(result)
+
+    def _simulate(self, params):
+        from pyfoxsi.batch import simulate_file
+        kwargs = dict(params[0])
+        energy = kwargs.get('energy')
+        if energy is not None:
+            kwargs['energy'] = tuple(np.atleast_1d(_decode_array(energy)))
+        return [simulate_file(kwargs.pop('input'), kwargs.pop('output'), **kwargs)]
+
+
+def serve(address=default_address, batch_window=0.005, shutter_states=(0,),
+          stc_kinds=(), simulate_workers=1):
+    """Run a `SimulationServer` until it is shut down.
+
+    Parameters
+    ----------
+    address : str
+        A path to a Unix socket or host:port, see `parse_address`.
+    batch_window : float
+        How long (s) to wait for compatible requests before computing.
+    shutter_states, stc_kinds
+        The responses built before serving, see `SimulationServer.warm`.
+    simulate_workers : int
+        The number of simulations run at once.
+    """
+    server = SimulationServer(address, batch_window=batch_window,
+                              simulate_workers=simulate_workers)
+    server.warm(shutter_states=shutter_states, stc_kinds=stc_kinds)
+    server.serve_forever()
+
+
+class Client(object):
+    """A connection to a `SimulationServer`.
+
+    A client sends one request at a time. Open one client per thread or job
+    to have requests computed together by the server.
+
+    Parameters
+    ----------
+    address : str
+        The address of the server, see `parse_address`.
+    timeout : float
+        The time (s) to wait for the connection and each reply.
+
+    Examples
+    --------
+    >>> with Client() as client:  # doctest: +SKIP
+    ...     client.ping()
+    """
+    def __init__(self, address=default_address, timeout=None):
+        family, sock_address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(sock_address)
+        self._file = self._socket.makefile('rwb')
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the connection."""
+        self._file.close()
+        self._socket.close()
+
+    def call(self, method, **params):
+        """Send a request and return its result.
+
+        Raises
+        ------
+        RuntimeError
+            If the server failed to compute the request.
+        """
+        with self._lock:
+            self._next_id += 1
+            request = {'id': self._next_id, 'method': method, 'params': _encode(params)}
+            self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('The server closed the connection')
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+
+    def ping(self):
+        """Return the process id and the number of requests served."""
+        return self.call('ping')
+
+    def effective_area(self, energy, instrument='dsi', shutter_state=0, kind='Q'):
+        """The effective area, see `~pyfoxsi.response.Response.effective_area`.
+
+        Parameters
+        ----------
+        energy : `~astropy.units.Quantity`
+            The energies.
+        instrument : str
+            'dsi' or 'stc'.
+        shutter_state : int
+            The DSI shutter state.
+        kind : str
+            The STC detector, 'Q' or 'F'.
+
+        Returns
+        -------
+        effective_area : `~astropy.units.Quantity` <cm**2>
+        """
+        result = self.call('effective_area', energy=energy.to_value(u.keV),
+                           instrument=instrument, shutter_state=shutter_state,
+                           kind=kind)
+        return _decode_array(result) * u.cm ** 2
+
+    def bin_effective_area(self, energy_edges, instrument='dsi', shutter_state=0,
+                           kind='Q'):
+        """The effective area averaged over energy bins, see
+        `~pyfoxsi.response.Response.bin_effective_area`.
+
+        Parameters
+        ----------
+        energy_edges : `~astropy.units.Quantity`
+            The n + 1 edges of n bins, or (n, 2) bands.
+        instrument, shutter_state, kind
+            See `effective_area`.
+
+        Returns
+        -------
+        effective_area : `~astropy.units.Quantity` <cm**2>
+        """
+        result = self.call('bin_effective_area',
+                           energy_edges=energy_edges.to_value(u.keV),
+                           instrument=instrument, shutter_state=shutter_state,
+                           kind=kind)
+        return _decode_array(result) * u.cm ** 2
+
+    def convolve(self, data, scale=1 * u.arcsec / u.pix, wings=False,
+                 energy=None, precision=None):
+        """Convolve an image with the FOXSI psf.
+
+        Parameters
+        ----------
+        data : `~numpy.ndarray`
+            The 2-D image.
+        scale : `~astropy.units.Quantity`
+            The pixel scale.
+        wings : bool
+            If True, include the psf wings.
+        energy : `~astropy.units.Quantity`
+            The photon energy, see `~pyfoxsi.psf.psf_width_scale`.
+        precision : str
+            'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+
+        Returns
+        -------
+        result : `~numpy.ndarray`
+        """
+        result = self.call('convolve', data=np.asarray(data),
+                           scale=scale.to_value(u.arcsec / u.pix), wings=wings,
+                           energy=None if energy is None else energy.to_value(u.keV),
+                           precision=precision)
+        return _decode_array(result)
+
+    def simulate(self, input_path, output_path, **kwargs):
+        """Simulate one input map, see `~pyfoxsi.batch.simulate_file`.
+
+        Relative paths are taken relative to the working directory of the
+        client.
+
+        Returns
+        -------
+        output_path : str
+        """
+        return self.call('simulate', input=os.path.abspath(input_path),
+                         output=os.path.abspath(output_path), **kwargs)
+
+    def shutdown(self):
+        """Stop the server."""
+        return self.call('shutdown')
@@ -0,0 +1,239 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyfoxsi.server import SimulationServer, Client
+from pyfoxsi.response import DSIResponse
+from pyfoxsi.psf import otf_convolve, psf_otf
+
+
+@pytest.fixture
+def server(tmp_path):
+    address = str(tmp_path / 'pyfoxsi.sock')
+    server = SimulationServer(address, batch_window=0.2)
+    groups = []
+    run = server._run
+
+    def record(method, members):
+        groups.append((method, len(members)))
+        run(method, members)
+
+    server._run = record
+    server.groups = groups
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    if thread.is_alive():
+        server.shutdown()
+    thread.join(10)
+
+
+def test_effective_area(server):
+    energy = [5., 10., 20.5] * u.keV
+    with Client(server.address, timeout=30) as client:
+        area = client.effective_area(energy)
+        band_area = client.bin_effective_area([5., 10., 20.] * u.keV)
+    resp = DSIResponse()
+    np.testing.assert_allclose(area, resp.effective_area(energy.value))
+    np.testing.assert_allclose(band_area, resp.bin_effective_area([5., 10., 20.]))
+
+
+def test_concurrent_requests_are_batched(server):
+    image = np.random.RandomState(0).rand(32, 32)
+    scale = 2 * u.arcsec / u.pix
+    nclient = 8
+    barrier = threading.Barrier(nclient)
+    results = {}
+
+    def job(i):
+        with Client(server.address, timeout=30) as client:
+            barrier.wait()
+            results[i] = client.convolve(image * (i + 1), scale)
+
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(nclient)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = otf_convolve(image, lambda shape: psf_otf(shape, scale=scale, wings=False))
+    for i in range(nclient):
+        np.testing.assert_allclose(results[i], (i + 1) * expected, rtol=1e-10, atol=1e-12)
+    sizes = [n for method, n in server.groups if method == 'convolve']
+    assert sum(sizes) == nclient
+    assert len(sizes) < nclient
+
+
+def test_errors(server):
+    with Client(server.address, timeout=30) as client:
+        with pytest.raises(RuntimeError, match='Unknown method'):
+            client.call('no_such_method')
+        with pytest.raises(RuntimeError):
+            client.effective_area([500.] * u.keV)
+        with pytest.raises(RuntimeError, match='Not a valid instrument'):
+            client.effective_area([10.] * u.keV, instrument='xyz')
+        # the connection is still usable after an error
+        assert client.ping()['pid'] == os.getpid()
+
+
+def test_bad_request_does_not_fail_its_batch(server):
+    outcomes = {}
+    barrier = threading.Barrier(3)
+
+    def job(i, energy):
+        with Client(server.address, timeout=30) as client:
+            barrier.wait()
+            try:
+                outcomes[i] = client.effective_area([energy] * u.keV)
+            except RuntimeError as e:
+                outcomes[i] = e
+
+    threads = [threading.Thread(target=job, args=(i, e))
+               for i, e in enumerate([10., 500., 20.])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert isinstance(outcomes[1], RuntimeError)
+    resp = DSIResponse()
+    np.testing.assert_allclose(outcomes[0], resp.effective_area([10.]))
+    np.testing.assert_allclose(outcomes[2], resp.effective_area([20.]))
+
+
+def test_shutdown(tmp_path):
+    address = str(tmp_path / 'pyfoxsi.sock')
+    server = SimulationServer(address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    with Client(address, timeout=30) as client:
+        assert client.shutdown() is True
+    thread.join(10)
+    assert not thread.is_alive()
+    assert not os.path.exists(address)
+
+
+def test_existing_path_is_not_removed(tmp_path, server):
+    path = tmp_path / 'not_a_socket'
+    path.write_text('data')
+    with pytest.raises(OSError, match='not a socket'):
+        SimulationServer(str(path))
+    assert path.read_text() == 'data'
+    # the socket of a running server
+    with pytest.raises(OSError, match='already listening'):
+        SimulationServer(server.address)
+    with Client(server.address, timeout=30) as client:
+        client.ping()
+
+
+def test_tcp_loopback_only():
+    with pytest.raises(ValueError, match='loopback'):
+        SimulationServer('8.8.8.8:7625')
+
+
+def _blocking_simulate(server):
+    """Replace simulate by a job which runs until released."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def simulate(params):
+        started.set()
+        assert release.wait(30)
+        return [params[0]['output']]
+
+    server._methods['simulate'] = (None, simulate)
+    return started, release
+
+
+def test_simulate_does_not_block_batched_requests(server):
+    started, release = _blocking_simulate(server)
+    simulated = {}
+
+    def simulate():
+        with Client(server.address, timeout=30) as client:
+            simulated['result'] = client.call('simulate', input='in.fits', output='out.fits')
+
+    simulation = threading.Thread(target=simulate)
+    simulation.start()
+    assert started.wait(30)
+
+    nclient = 4
+    barrier = threading.Barrier(nclient)
+    results = {}
+
+    def job(i):
+        with Client(server.address, timeout=30) as client:
+            barrier.wait()
+            results[i] = client.effective_area([5. * (i + 1)] * u.keV)
+
+    try:
+        with Client(server.address, timeout=30) as client:
+            assert client.ping()['pid'] == os.getpid()
+        threads = [threading.Thread(target=job, args=(i,)) for i in range(nclient)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        # all answered and batched while the simulation is still running
+        assert len(results) == nclient
+        assert not release.is_set()
+        sizes = [n for method, n in server.groups if method == 'effective_area']
+        assert sum(sizes) == nclient
+        assert len(sizes) < nclient
+    finally:
+        release.set()
+    simulation.join(30)
+    assert simulated['result'] == 'out.fits'
+    resp = DSIResponse()
+    for i in range(nclient):
+        np.testing.assert_allclose(results[i], resp.effective_area([5. * (i + 1)]))
+
+
+def test_shutdown_fails_pending_requests(tmp_path):
+    address = str(tmp_path / 'pyfoxsi.sock')
+    # a long batch window so that a request is still queued at shutdown
+    server = SimulationServer(address, batch_window=30)
+    started, release = _blocking_simulate(server)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    outcomes = {}
+
+    def job(name, method, **params):
+        with Client(address, timeout=30) as client:
+            try:
+                outcomes[name] = client.call(method, **params)
+            except RuntimeError as e:
+                outcomes[name] = e
+
+    running = threading.Thread(target=job, args=('running', 'simulate'),
+                               kwargs={'input': 'a.fits', 'output': 'a.out'})
+    running.start()
+    assert started.wait(30)
+    jobs = [threading.Thread(target=job, args=('waiting', 'simulate'),
+                             kwargs={'input': 'b.fits', 'output': 'b.out'}),
+            threading.Thread(target=job, args=('queued', 'ping'))]
+    for t in jobs:
+        t.start()
+    for _ in range(3000):
+        if server._queue:
+            break
+        threading.Event().wait(0.01)
+
+    stopper = threading.Thread(target=server.shutdown)
+    stopper.start()
+    for t in jobs:
+        t.join(10)
+        assert not t.is_alive()
+    assert isinstance(outcomes['queued'], RuntimeError)
+    assert 'shutting down' in str(outcomes['queued'])
+    assert isinstance(outcomes['waiting'], RuntimeError)
+    # the simulation which had started is completed
+    release.set()
+    running.join(10)
+    assert outcomes['running'] == 'a.out'
+    stopper.join(10)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert server.submit({'method': 'ping'}).exception() is not None
@@ -0,0 +1,360 @@
+"""
+Sources is a module to render parametric source models as FOXSI images
+
+The psf is a mixture of elliptical Gaussians (see
+`~pyfoxsi.psf.psf_components`) so the image of a Gaussian source is itself a
+mixture of Gaussians whose covariances are the sums of those of the source
+and of the psf. Images are therefore computed directly from this closed form,
+integrated over each pixel, without building a source map or convolving it.
+
+Examples
+--------
+>>> from pyfoxsi.sources import PointSource, GaussianSource, render
+>>> sources = [PointSource(-50 * u.arcsec, 0 * u.arcsec, spectrum=0.1 * u.ph / u.cm ** 2 / u.s / u.keV),
+...            GaussianSource(50 * u.arcsec, 0 * u.arcsec, 10 * u.arcsec, 5 * u.arcsec)]
+>>> cube = render(sources, np.arange(4, 21) * u.keV, (256, 256), 1 * u.arcsec / u.pix)  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+import astropy.units as u
+from scipy.special import erf
+
+from pyfoxsi.psf import psf_components, get_dtype
+from pyfoxsi.response import DSIResponse
+from pyfoxsi.profiling import stage
+
+__all__ = ['Source', 'PointSource', 'GaussianSource', 'GaussianChain',
+           'render']
+
+flux_unit = u.ph / u.cm ** 2 / u.s / u.keV
+
+# the number of sigma beyond which a component is not rendered
+truncate = 6.
+
+_responses = {}
+
+
+def _covariance(sigma_x, sigma_y, theta):
+    """The covariance (xx, xy, yy) of the Gaussians of `~pyfoxsi.psf.gauss2d`."""
+    sigma_x, sigma_y, theta = np.broadcast_arrays(sigma_x, sigma_y, theta)
+    # the inverse covariance is twice the quadratic form of gauss2d
+    a = np.cos(theta) ** 2 / sigma_x ** 2 + np.sin(theta) ** 2 / sigma_y ** 2
+    b = -np.sin(2 * theta) / (2 * sigma_x ** 2) + np.sin(2 * theta) / (2 * sigma_y ** 2)
+    c = np.sin(theta) ** 2 / sigma_x ** 2 + np.cos(theta) ** 2 / sigma_y ** 2
+    det = a * c - b ** 2
+    return c / det, -b / det, a / det
+
+
+class Source(object):
+    """A source made of one or more Gaussian components with one spectrum.
+
+    Parameters
+    ----------
+    x, y : `~astropy.units.Quantity`
+        The position of each component (e.g. helioprojective arcsec).
+    sigma_x, sigma_y : `~astropy.units.Quantity`
+        The width of each component in its unrotated x and y directions.
+    theta : float or array_like
+        The rotation of each component (radian), as in `~pyfoxsi.psf.gauss2d`.
+    weight : array_like
+        The fraction of the flux in each component. Normalized to sum to one.
+    spectrum : `~astropy.units.Quantity` or callable
+        The photon flux density of the whole source (ph / cm2 / s / keV). A
+        scalar is a flat spectrum, an array gives the value in each energy
+        bin and a callable is evaluated at energies in keV.
+    """
+    def __init__(self, x, y, sigma_x, sigma_y, theta=0., weight=None,
+                 spectrum=1 * flux_unit):
+        x = np.atleast_1d(x.to_value(u.arcsec))
+        y = np.atleast_1d(y.to_value(u.arcsec))
+        sigma_x = sigma_x.to_value(u.arcsec)
+        sigma_y = sigma_y.to_value(u.arcsec)
+        self.x, self.y, sigma_x, sigma_y, theta = np.broadcast_arrays(
+            x, y, sigma_x, sigma_y, np.asarray(theta, dtype=float))
+        if weight is None:
+            weight = np.ones(len(self.x))
+        weight = np.broadcast_to(np.asarray(weight, dtype=float), self.x.shape)
+        self.weight = weight / weight.sum()
+        self.covariance = np.stack(_covariance(np.maximum(sigma_x, 1e-6),
+                                               np.maximum(sigma_y, 1e-6), theta))
+        self.spectrum = spectrum
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def position(self):
+        """The flux weighted centre of the source"""
+        return (np.sum(self.weight * self.x) * u.arcsec,
+                np.sum(self.weight * self.y) * u.arcsec)
+
+    def flux(self, energy_edges):
+        """The photon flux of the source in each energy bin.
+
+        Callable spectra are integrated over each bin with Simpson's rule.
+
+        Parameters
+        ----------
+        energy_edges : `~astropy.units.Quantity` <keV>
+            The n + 1 edges of n energy bins.
+
+        Returns
+        -------
+        flux : `~astropy.units.Quantity` <ph / cm2 / s>
+        """
+        edges = energy_edges.to_value(u.keV)
+        lo, hi = edges[:-1], edges[1:]
+        width = (hi - lo) * u.keV
+        if callable(self.spectrum):
+            def f(e):
+                return u.Quantity(self.spectrum(e * u.keV), flux_unit).value
+            density = (f(lo) + 4 * f(0.5 * (lo + hi)) + f(hi)) / 6. * flux_unit
+        else:
+            density = u.Quantity(self.spectrum, flux_unit) * np.ones(lo.shape)
+        return (density * width).to(u.ph / u.cm ** 2 / u.s)
+
+    def __repr__(self):
+        x, y = self.position
+        return '<{0} at ({1:.1f}, {2:.1f}) with {3} components>'.format(
+            self.__class__.__name__, x, y, len(self))
+
+
+class PointSource(Source):
+    """A point source.
+
+    Parameters
+    ----------
+    x, y : `~astropy.units.Quantity`
+        The position of the source.
+    spectrum : `~astropy.units.Quantity` or callable
+        The photon flux density, see `Source`.
+    """
+    def __init__(self, x, y, spectrum=1 * flux_unit):
+        Source.__init__(self, x, y, 0 * u.arcsec, 0 * u.arcsec,
+                        spectrum=spectrum)
+
+
+class GaussianSource(Source):
+    """An elliptical Gaussian source, e.g. a footpoint.
+
+    Parameters
+    ----------
+    x, y : `~astropy.units.Quantity`
+        The centre of the source.
+    sigma_x, sigma_y : `~astropy.units.Quantity`
+        The width along the unrotated x and y directions.
+    theta : float
+        The rotation (radian).
+    spectrum : `~astropy.units.Quantity` or callable
+        The photon flux density, see `Source`.
+    """
+    def __init__(self, x, y, sigma_x, sigma_y=None, theta=0.,
+                 spectrum=1 * flux_unit):
+        if sigma_y is None:
+            sigma_y = sigma_x
+        Source.__init__(self, x, y, sigma_x, sigma_y, theta=theta,
+                        spectrum=spectrum)
+
+
+class GaussianChain(Source):
+    """A chain of circular Gaussians sharing one spectrum, e.g. a loop.
+
+    Parameters
+    ----------
+    x, y : `~astropy.units.Quantity`
+        The centres of the Gaussians.
+    sigma : `~astropy.units.Quantity`
+        The width of each Gaussian.
+    weight : array_like
+        The relative flux of each Gaussian. Defaults to equal.
+    spectrum : `~astropy.units.Quantity` or callable
+        The photon flux density of the whole chain, see `Source`.
+    """
+    def __init__(self, x, y, sigma, weight=None, spectrum=1 * flux_unit):
+        Source.__init__(self, x, y, sigma, sigma, weight=weight,
+                        spectrum=spectrum)
+
+    @classmethod
+    def loop(cls, start, end, height, sigma, number=None, spectrum=1 * flux_unit):
+        """A loop between two footpoints as seen projected on the sky.
+
+        The loop is a parabola which rises height above the line joining the
+        footpoints, to the left when going from start to end.
+
+        Parameters
+        ----------
+        start, end : tuple of `~astropy.units.Quantity`
+            The (x, y) positions of the footpoints.
+        height : `~astropy.units.Quantity`
+            The projected height of the loop top.
+        sigma : `~astropy.units.Quantity`
+            The width of the loop.
+        number : int
+            The number of Gaussians. Defaults to one per sigma along the loop.
+
+        Raises
+        ------
+        ValueError
+            If the footpoints are at the same position.
+        """
+        x0, y0 = [c.to_value(u.arcsec) for c in start]
+        x1, y1 = [c.to_value(u.arcsec) for c in end]
+        h = height.to_value(u.arcsec)
+        length = np.hypot(x1 - x0, y1 - y0)
+        if length == 0:
+            raise ValueError('The footpoints of a loop must be at different positions')
+        if number is None:
+            number = max(int(np.ceil((length + 2 * abs(h)) / sigma.to_value(u.arcsec))), 2)
+        t = np.linspace(0, 1, number)
+        nx, ny = -(y1 - y0) / length, (x1 - x0) / length
+        bulge = 4 * h * t * (1 - t)
+        x = x0 + t * (x1 - x0) + bulge * nx
+        y = y0 + t * (y1 - y0) + bulge * ny
+        # weight by the length of loop each Gaussian stands for
+        step = np.hypot(np.gradient(x), np.gradient(y))
+        return cls(x * u.arcsec, y * u.arcsec, sigma, weight=step,
+                   spectrum=spectrum)
+
+
+def _get_response(shutter_state):
+    resp = _responses.get(shutter_state)
+    if resp is None:
+        resp = DSIResponse(shutter_state=shutter_state)
+        _responses[shutter_state] = resp
+    return resp
+
+
+def _pixel_fraction(edges, mean, sigma):
+    """The fraction of 1-D Gaussians falling between successive edges."""
+    cdf = erf((edges[np.newaxis, :] - mean[:, np.newaxis]) /
+              (np.sqrt(2) * sigma[:, np.newaxis]))
+    return 0.5 * np.diff(cdf, axis=1)
+
+
+def _render_image(source, shape, pixel, origin, pointing, precision=None):
+    """The normalized expected image of a source in pixels.
+
+    origin is the position (arcsec) of the lower left corner of the image and
+    pointing that of the optical axis.
+    """
+    dtype = get_dtype(precision)
+    ny, nx = shape
+    image = np.zeros(shape, dtype=np.float64)
+    # the psf is taken at the position of the source in the field of view
+    x, y = source.position
+    comp = psf_components(x - pointing[0], y - pointing[1])
+    psf_cov = np.stack(_covariance(comp['sigma_x'], comp['sigma_y'], comp['theta']))
+    # every pair of source and psf components, in pixels
+    weight = (source.weight[:, np.newaxis] * comp['weight'][np.newaxis, :]).ravel()
+    cov = ((source.covariance[:, :, np.newaxis] +
+            psf_cov[:, np.newaxis, :]) / pixel ** 2).reshape(3, -1)
+    mx = np.repeat((source.x - origin[0]) / pixel, len(comp['weight']))
+    my = np.repeat((source.y - origin[1]) / pixel, len(comp['weight']))
+    sx = np.sqrt(cov[0])
+    sy = np.sqrt(cov[2])
+    aligned = np.abs(cov[1]) <= 1e-9 * sx * sy
+
+    x0 = np.clip(np.floor(mx - truncate * sx).astype(int), 0, nx)
+    x1 = np.clip(np.ceil(mx + truncate * sx).astype(int) + 1, 0, nx)
+    y0 = np.clip(np.floor(my - truncate * sy).astype(int), 0, ny)
+    y1 = np.clip(np.ceil(my + truncate * sy).astype(int) + 1, 0, ny)
+    if aligned.any():
+        # axis aligned components are integrated exactly and separably
+        fx = _pixel_fraction(np.arange(nx + 1.), mx[aligned], sx[aligned])
+        fy = _pixel_fraction(np.arange(ny + 1.), my[aligned], sy[aligned])
+        for i, gx, gy in zip(np.flatnonzero(aligned), fx, fy):
+            if x0[i] >= x1[i] or y0[i] >= y1[i]:
+                continue
+            image[y0[i]:y1[i], x0[i]:x1[i]] += weight[i] * np.outer(gy[y0[i]:y1[i]],
+                                                                    gx[x0[i]:x1[i]])
+    for i in np.flatnonzero(~aligned):
+        if x0[i] >= x1[i] or y0[i] >= y1[i]:
+            continue
+        # rotated components are sampled at pixel centres with the variance of
+        # the pixel added, which is accurate to order (pixel / sigma) ** 4
+        cxx, cxy, cyy = cov[0, i] + 1 / 12., cov[1, i], cov[2, i] + 1 / 12.
+        det = cxx * cyy - cxy ** 2
+        dx = np.arange(x0[i], x1[i]) + 0.5 - mx[i]
+        dy = np.arange(y0[i], y1[i]) + 0.5 - my[i]
+        q = (cyy * dx[np.newaxis, :] ** 2 - 2 * cxy * dy[:, np.newaxis] * dx[np.newaxis, :] +
+             cxx * dy[:, np.newaxis] ** 2) / det
+        image[y0[i]:y1[i], x0[i]:x1[i]] += (weight[i] / (2 * np.pi * np.sqrt(det)) *
+                                            np.exp(-0.5 * q))
+    return image.astype(dtype, copy=False)
+
+
+def render(sources, energy_edges, shape, scale=1 * u.arcsec / u.pix,
+           center=(0, 0) * u.arcsec, pointing=None, integration_time=1 * u.s,
+           effective_area=None, shutter_state=0, precision=None):
+    """Render the expected FOXSI counts of parametric sources.
+
+    Each source is imaged once from the closed form convolution of its
+    Gaussian components with the Gaussian components of the psf, integrated
+    over the pixels, and the cube is assembled from these images and the
+    source spectra with a single matrix product. No map is convolved so the
+    cost does not depend on the psf size and scenes of many sources over
+    many energy bins are fast. The psf wings are not included.
+
+    Parameters
+    ----------
+    sources : list of `Source`
+        The sources.
+    energy_edges : `~astropy.units.Quantity` <keV>
+        The n + 1 edges of the n energy bins of the cube.
+    shape : tuple of int
+        The (ny, nx) shape of the images.
+    scale : `~astropy.units.Quantity`
+        The pixel scale (e.g. arcsec / pixel).
+    center : `~astropy.units.Quantity`
+        The (x, y) position of the centre of the images.
+    pointing : `~astropy.units.Quantity`
+        The (x, y) position of the optical axis, which sets the off-axis psf
+        of each source. Defaults to center.
+    integration_time : `~astropy.units.Quantity`
+        The integration time.
+    effective_area : `~astropy.units.Quantity` or `~pyfoxsi.response.Response`
+        The effective area in each bin or a response from which it is
+        averaged over each bin. Defaults to the DSI response with
+        shutter_state.
+    shutter_state : int
+        The shutter state of the default response.
+    precision : str
+        'single' or 'double', see `~pyfoxsi.psf.get_dtype`.
+
+    Returns
+    -------
+    cube : `~numpy.ndarray`
+        The expected counts with shape (energy, y, x).
+    """
+    dtype = get_dtype(precision)
+    pixel = scale.to_value(u.arcsec / u.pix)
+    center = u.Quantity(center, u.arcsec)
+    pointing = center if pointing is None else u.Quantity(pointing, u.arcsec)
+    ny, nx = shape
+    origin = (center[0].value - nx * pixel / 2., center[1].value - ny * pixel / 2.)
+    energy = energy_edges.to(u.keV)
+
+    with stage('sources.spectra') as s:
+        if effective_area is None:
+            effective_area = _get_response(shutter_state)
+        if hasattr(effective_area, 'bin_effective_area'):
+            effective_area = effective_area.bin_effective_area(energy)
+        area = u.Quantity(effective_area, u.cm ** 2) * np.ones(len(energy) - 1)
+        # expected counts per bin of each source, (source, energy)
+        counts = np.array([(src.flux(energy) * area * integration_time).to_value(u.ph)
+                           for src in sources]).reshape(len(sources), -1)
+        s.add_array(counts)
+
+    with stage('sources.images') as s:
+        images = np.empty((len(sources), ny * nx), dtype=dtype)
+        for i, src in enumerate(sources):
+            images[i] = _render_image(src, shape, pixel, origin,
+                                      pointing, precision=precision).ravel()
+        s.add_array(images)
+
+    with stage('sources.cube') as s:
+        cube = np.dot(counts.T.astype(dtype), images).reshape(-1, ny, nx)
+        s.add_array(cube)
+    return cube
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyfoxsi.sources import GaussianChain, GaussianSource, PointSource, render
+from pyfoxsi.sources.sources import flux_unit
+
+
+def test_loop_joins_its_footpoints():
+    loop = GaussianChain.loop((0, 0) * u.arcsec, (40, 0) * u.arcsec, 10 * u.arcsec,
+                              2 * u.arcsec, number=21)
+    assert (loop.x[0], loop.y[0]) == (0, 0)
+    assert loop.x[-1] == pytest.approx(40)
+    # the top is height to the left of the direction from start to end
+    assert (loop.x[10], loop.y[10]) == pytest.approx((20, 10))
+    assert loop.weight.sum() == pytest.approx(1)
+
+
+def test_loop_needs_two_footpoints():
+    with pytest.raises(ValueError, match='different positions'):
+        GaussianChain.loop((5, 5) * u.arcsec, (5, 5) * u.arcsec, 10 * u.arcsec,
+                           2 * u.arcsec)
+
+
+def _expected_image(source, shape, pixel, origin, oversample=8):
+    """The psf convolved source integrated over pixels by oversampling."""
+    from pyfoxsi.psf import psf_components
+    from pyfoxsi.sources.sources import _covariance
+
+    comp = psf_components(0 * u.arcmin, 0 * u.arcmin)
+    psf_cov = np.stack(_covariance(comp['sigma_x'], comp['sigma_y'], comp['theta']))
+    ny, nx = shape
+    sub = (np.arange(oversample) + 0.5) / oversample
+    xs = origin[0] + (np.arange(nx)[:, np.newaxis] + sub).ravel() * pixel
+    ys = origin[1] + (np.arange(ny)[:, np.newaxis] + sub).ravel() * pixel
+    image = np.zeros((ny * oversample, nx * oversample))
+    for i in range(len(source)):
+        for k in range(len(comp['weight'])):
+            cxx, cxy, cyy = source.covariance[:, i] + psf_cov[:, k]
+            det = cxx * cyy - cxy ** 2
+            dx = xs[np.newaxis, :] - source.x[i]
+            dy = ys[:, np.newaxis] - source.y[i]
+            q = (cyy * dx ** 2 - 2 * cxy * dx * dy + cxx * dy ** 2) / det
+            image += (source.weight[i] * comp['weight'][k] / (2 * np.pi * np.sqrt(det)) *
+                      np.exp(-0.5 * q))
+    return image.reshape(ny, oversample, nx, oversample).sum(axis=(1, 3)) * (pixel / oversample) ** 2
+
+
+@pytest.mark.parametrize('source', [
+    PointSource(3 * u.arcsec, -5 * u.arcsec),
+    GaussianSource(-10 * u.arcsec, 4 * u.arcsec, 6 * u.arcsec, 3 * u.arcsec, theta=0.6),
+    GaussianChain.loop((-20, -10) * u.arcsec, (20, -5) * u.arcsec, 15 * u.arcsec,
+                       3 * u.arcsec),
+])
+def test_render_matches_numerical_convolution(source):
+    shape, pixel = (40, 48), 2.
+    area = 10 * u.cm ** 2
+    cube = render([source], [4, 6, 10] * u.keV, shape, pixel * u.arcsec / u.pix,
+                  integration_time=5 * u.s, effective_area=area)
+    assert cube.shape == (2,) + shape
+    # a flat spectrum of 1 ph / cm2 / s / keV
+    counts = np.array([2., 4.]) * 10 * 5
+    expected = _expected_image(source, shape, pixel, (-48., -40.))
+    for plane, total in zip(cube, counts):
+        np.testing.assert_allclose(plane, total * expected, rtol=0,
+                                   atol=2e-3 * total * expected.max())
+        assert plane.sum() == pytest.approx(total, rel=1e-3)
+
+
+def test_render_adds_sources_and_integrates_spectra():
+    sources = [PointSource(0 * u.arcsec, 0 * u.arcsec, spectrum=lambda e: e.value ** -2 * flux_unit),
+               GaussianSource(20 * u.arcsec, 0 * u.arcsec, 4 * u.arcsec, spectrum=[1, 2] * flux_unit)]
+    edges = [4, 8, 12] * u.keV
+    both = render(sources, edges, (128, 128), effective_area=1 * u.cm ** 2)
+    each = [render([s], edges, (128, 128), effective_area=1 * u.cm ** 2) for s in sources]
+    np.testing.assert_allclose(both, each[0] + each[1])
+    # Simpson's rule integrates e ** -2 over the bins to a few parts in a thousand
+    exact = 1 / edges[:-1].value - 1 / edges[1:].value
+    np.testing.assert_allclose(each[0].sum(axis=(1, 2)), exact, rtol=1e-2)
+    np.testing.assert_allclose(each[1].sum(axis=(1, 2)), [4, 8], rtol=1e-3)
@@ -8,10 +8,17 @@ import pandas as pd
 from astropy.units import Unit
 import os.path
 import numpy as np
+import astropy.units as u
+from pyfoxsi.profiling import stage
+
+__all__ = ['Optic']
 
 
 class Optic(object):
-    """A FOXSI Optic class definition."""
+    """A FOXSI Optic class definition.
+
+    Only the shells listed in `pyfoxsi.shell_ids` are kept.
+    """
     def __init__(self):
         path = os.path.dirname(pyfoxsi.__file__)
         for i in np.arange(3):
@@ -19,14 +26,20 @@ class Optic(object):
         path = os.path.join(path, 'data/')
         filename = 'shell_parameters.csv'
         params_file = os.path.join(path, filename)
-        self.shell_params = pd.read_csv(params_file, index_col=0)
+        with stage('telescope.load_shell_parameters') as s:
+            self.shell_params = pd.read_csv(params_file, index_col=0)
+            s.add_array(self.shell_params.values)
+            self.module_area = pd.read_csv(os.path.join(path, 'effective_area_per_module.csv'),
+                                           index_col=0, skiprows=4)
+            s.add_array(self.module_area.values)
+        self.shell_params.columns = self.shell_params.columns.str.strip()
         the_units = [Unit(this_unit) for this_unit in self.shell_params.loc[np.nan].values]
         self.units = {}
         for i, col in enumerate(self.shell_params):
             self.units.update({col: the_units[i]})
         self.shell_params.drop(self.shell_params.index[0], inplace=True)
         missing_shells = np.setdiff1d(self.shell_params.index, pyfoxsi.shell_ids)
-        self.shell_params.drop(missing_shells)
+        self.shell_params = self.shell_params.drop(missing_shells)
         for col in self.shell_params.columns:
             self.shell_params[col] = self.shell_params[col].astype(float)
 
@@ -34,10 +47,55 @@ class Optic(object):
         """Return the parameters of one shell"""
         try:
             this_shell = self.shell_params.loc[shell_number]
-        except:
-            ValueError('Shell %i is missing.' % shell_number)
+        except KeyError:
+            raise ValueError('Shell %i is missing.' % shell_number)
         return this_shell
 
     @property
     def mass(self):
         return self.shell_params['Mass'].sum() * self.units.get("Mass")
+
+    @property
+    def radius(self):
+        """The radius of each shell at the intersection of its two sections"""
+        return u.Quantity(self.shell_params['Int rad'].values, self.units.get('Int rad'))
+
+    @property
+    def graze_angle(self):
+        """The graze angle of each shell"""
+        return u.Quantity(self.shell_params['grazeang'].values, self.units.get('grazeang'))
+
+    @property
+    def geometric_area(self):
+        """The geometric area of each shell including the spider"""
+        return u.Quantity(self.shell_params['geoarea-10%vign'].values,
+                          self.units.get('geoarea-10%vign'))
+
+    def shell_effective_area(self, energy):
+        """The effective area of each shell.
+
+        The reflectivity of a shell depends on the product of the energy and
+        its graze angle, and falls steeply above a critical energy which is
+        higher for the inner shells with their smaller graze angles. The
+        reflectivity of every shell is therefore taken from the module
+        effective area, divided by the geometric area, at the energy scaled
+        by the ratio of the graze angle of the shell to the mean graze angle.
+
+        Parameters
+        ----------
+        energy : `~astropy.units.Quantity`
+            The photon energies.
+
+        Returns
+        -------
+        effective_area : `~astropy.units.Quantity` <cm**2>
+            The area of each shell (last axis) at each energy.
+        """
+        geometric_area = self.geometric_area.to_value(u.cm ** 2)
+        graze_angle = self.graze_angle.value
+        mean_angle = np.average(graze_angle, weights=geometric_area)
+        reflectivity = self.module_area['effective_area'].values / geometric_area.sum()
+        scaled = np.multiply.outer(energy.to_value(u.keV), graze_angle / mean_angle)
+        result = np.interp(scaled, self.module_area.index.values, reflectivity,
+                           right=0.) * geometric_area
+        return result * u.cm ** 2